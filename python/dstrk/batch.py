@@ -0,0 +1,97 @@
+# Run a stream of commands against one DSDatabase
+#
+# Each input line is a JSON object naming the operation and its arguments:
+#
+#   {"op": "addDS", "files": [<file or glob>, ...], "parents": [...], "tags": [...], "gitinfo": [...]}
+#   {"op": "addfiles", "dataset": <file or hash>, "files": [...]}
+#   {"op": "DSinfo", "dataset": <file or hash>}
+#   {"op": "delDS", "dataset": <file or hash>}
+#   {"op": "delfiles", "files": [...]}
+#
+# addDS, addfiles and delfiles also take the "recursive", "include" and "exclude" options.
+#
+# and gives one line of JSON in the output:
+#
+#   {"ok": true, "op": <op>, "ds_hash": <hash>}                    addDS and addfiles
+#   {"ok": true, "op": "DSinfo", "info": {...}}                   DSinfo
+#   {"ok": true, "op": <op>}                                      delDS and delfiles
+#   {"ok": false, "op": <op>, "error": <exception type>, "message": <text>}
+#
+# Any "id" in a command is copied to its result. Commands are run in groups inside a single
+# storage transaction so their writes are made together, but a failing command doesn't stop the
+# rest of the stream. Each command runs in its own nested transaction, so none of the writes of a
+# failing command are made, with either storage engine. On the loose engine each command's objects
+# are written as it finishes, so an update that can only be made then still fails just that
+# command and a command reported as done has been written.
+
+# system imports
+import itertools
+import json
+import os
+
+# number of commands run in each transaction
+DEFAULT_GROUP_SIZE = 100
+
+# -----------------------------------------------------------------------------
+def run_command(ds, cmd):
+    """Run a single batch command and return the result dictionary"""
+    op = cmd.get('op')
+    result = {'ok':True, 'op':op}
+    walk_options = {'recursive':cmd.get('recursive', False), 'include':cmd.get('include'), 'exclude':cmd.get('exclude')}
+    if op == 'addDS':
+        gitinfo = [os.path.abspath(os.path.expanduser(repo)) for repo in cmd.get('gitinfo', [])]
+        result['ds_hash'] = ds.add_ds(cmd['files'], parents=cmd.get('parents', []), tags=cmd.get('tags', []), gitinfo=gitinfo, **walk_options)
+    elif op == 'addfiles':
+        result['ds_hash'] = ds.add_files(cmd['files'], dataset=cmd['dataset'], **walk_options)
+    elif op == 'DSinfo':
+        result['info'] = ds.get_ds_info(cmd['dataset'])
+    elif op == 'delDS':
+        ds.del_ds(cmd['dataset'])
+    elif op == 'delfiles':
+        ds.del_files(cmd['files'], **walk_options)
+    else:
+        raise ValueError("Unknown batch operation: {0}".format(op))
+    return result
+
+# -----------------------------------------------------------------------------
+def run_line(ds, ln):
+    """Run the command on the given input line in its own nested transaction and return the
+    result dictionary, recording any error rather than raising it"""
+    cmd = {}
+    result = {'op':None}
+    try:
+        cmd = json.loads(ln)
+        if not isinstance(cmd, dict):
+            raise ValueError("Batch commands must be JSON objects")
+        result['op'] = cmd.get('op')
+        with ds.transaction(commit=True):
+            result = run_command(ds, cmd)
+    except Exception as e:
+        result.update(ok=False, error=type(e).__name__, message=str(e))
+
+    if 'id' in cmd:
+        result['id'] = cmd['id']
+    return result
+
+# -----------------------------------------------------------------------------
+def run_batch(ds, in_file, out_file, group_size=DEFAULT_GROUP_SIZE):
+    """Run the JSON line commands from in_file, writing a JSON result line for each to out_file.
+    The results of each group are written once its transaction has finished. Returns the number
+    of commands that failed"""
+    failures = 0
+    lines = (ln for ln in in_file if ln.strip())
+    while True:
+        group = list(itertools.islice(lines, group_size))
+        if not group:
+            break
+
+        with ds.transaction():
+            results = [run_line(ds, ln) for ln in group]
+
+        for result in results:
+            if not result['ok']:
+                failures += 1
+            out_file.write(json.dumps(result, sort_keys=True) + "\n")
+        out_file.flush()
+
+    return failures
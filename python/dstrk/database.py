@@ -1,121 +1,466 @@
 # Database class and related functions
 
 # system imports
+from collections import deque
+from contextlib import contextmanager
 import os
 from datetime import datetime
-import hashlib
-import glob
-import subprocess
+import errno
+import functools
+import itertools
 
 # DT imports
-from dstrk.exceptions import DatabaseExists, DatabaseDoesNotExist, FileNotFound, NotValidFileOrHash, GitRepoDoesNotExist
+from dstrk.exceptions import DatabaseExists, DatabaseDoesNotExist, FileNotFound, NotValidFileOrHash, GitRepoDoesNotExist, AmbiguousHash, UnknownHashAlgorithm, UnknownManifestEncoding
+from dstrk.hashing import hash_files, hash_string, new_hash, partial_hash, algorithm_of, RateLimiter, DEFAULT_BUFFER_SIZE, DEFAULT_HASH, HASH_ALGORITHMS, PARTIAL_HASH_MIN_SIZE
+from dstrk.hashcache import HashCache, DEFAULT_MAX_ENTRIES
+from dstrk.storage import make_storage, is_hex, DEFAULT_ENGINE
+from dstrk.timings import Recorder
+from dstrk.walk import iter_files
+from dstrk.records import parse_file_record, format_ds_header, format_ds_manifest_line, parse_ds_header
+from dstrk.records import encode_ds_record, open_ds_record, decode_ds_record, append_ds_files, TEXT_MANIFEST, MANIFEST_ENCODINGS
+from dstrk.records import add_file_dataset, remove_file_dataset, move_file_record, merge_ds_record, move_ds_files, remove_ds_files, parse_iso_time
+from dstrk.fsutil import atomic_write, file_stamp
+from dstrk.gitinfo import read_git_info
+from dstrk.recordcache import RecordCache, MISSING, DEFAULT_CACHE_SIZE
+
+# name of the DB config file
+DB_CONFIG_FILE = 'config'
+
+# number of files found by a walk to hash at a time
+HASH_CHUNK_SIZE = 1000
+
+# maximum number of candidates reported for an ambiguous hash
+MAX_AMBIGUOUS_REPORT = 10
 
 # -----------------------------------------------------------------------------
 # class to handle all DB operations
-class DSDatabase:
-    def __init__(self, db_base_path):
+class DSDatabase(object):
+    def __init__(self, db_base_path, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False, jobs=1,
+                 use_hash_cache=True, hash_cache_size=DEFAULT_MAX_ENTRIES, recorder=None):
         assert db_base_path
+        assert buffer_size > 0
+        assert jobs > 0
         self.db_base_path = db_base_path
+        self.buffer_size = buffer_size
+        self.use_mmap = use_mmap
+        self.jobs = jobs
+        self.hash_cache = None
+        if use_hash_cache:
+            self.hash_cache = HashCache(os.path.join(db_base_path, 'hashcache'), max_entries=hash_cache_size)
+        self._storage = None
+        self._hash_algorithms = None
+        self._manifest_encoding = None
+        self._config_stamp = None
+        self.cache = None
+        self.recorder = recorder or Recorder()
+
+    def add_hook(self, hook):
+        """Call hook(phase, seconds, counters) as each phase of an operation finishes. See dstrk.timings"""
+        self.recorder.add_hook(hook)
+
+    def phase(self, name):
+        """Return a context manager timing the given phase for the hooks"""
+        return self.recorder.phase(name)
+
+    def count(self, counter, n=1):
+        """Add to a counter of the current phase"""
+        self.recorder.count(counter, n)
+
+    @contextmanager
+    def session(self, cache_size=DEFAULT_CACHE_SIZE):
+        """Return a context manager for a run of operations that keeps up to cache_size of the
+        records read in memory (see recordcache.py). Writes, updates and deletes made through this
+        object are always seen, but changes made by other processes during the session may not be.
+        The cache is dropped when the session ends. Nested sessions share the outer one's cache"""
+        if self.cache is not None:
+            yield self.cache
+            return
+
+        self.cache = RecordCache(cache_size)
+        try:
+            yield self.cache
+        finally:
+            self.cache = None
+
+    def cached(self, kind, obj_hash, load):
+        """Return load(), or in a session the value it gave for the same kind of record and hash
+        if that's still cached"""
+        if self.cache is None:
+            return load()
+
+        value = self.cache.lookup((kind, obj_hash))
+        if value is not MISSING:
+            self.count('cache_hits')
+            return value
+
+        self.count('cache_misses')
+        value = load()
+        self.cache.store((kind, obj_hash), value)
+        return value
+
+    def invalidate(self, obj_hash):
+        """Drop anything cached about the object once it has changed"""
+        if self.cache is not None:
+            self.cache.invalidate(obj_hash)
+
+    @contextmanager
+    def transaction(self, commit=False):
+        """Return a context manager grouping the writes made in it, as storage.transaction(). If
+        they're rolled back the session cache is dropped as it may hold records they changed"""
+        try:
+            with self.storage.transaction(commit):
+                yield
+        except:
+            if self.cache is not None:
+                self.cache.clear()
+            raise
 
     def check_db(self):
         """Check that the DB is present"""
-        if not os.path.exists(self.db_base_path):
-            raise DatabaseDoesNotExist
+        def load():
+            if not os.path.exists(self.db_base_path):
+                raise DatabaseDoesNotExist
+            return True
+        self.cached('db', self.db_base_path, load)
+
+    def refresh(self):
+        """Drop the settings read from the DB config if another process has changed it since, e.g.
+        for a DSDatabase kept by a long running process. The indexes check for changes themselves"""
+        if file_stamp(os.path.join(self.db_base_path, DB_CONFIG_FILE)) == self._config_stamp:
+            return
+        self._hash_algorithms = None
+        self._manifest_encoding = None
+        if self._storage is not None and self._storage.name != self.read_config().get('engine', DEFAULT_ENGINE):
+            self._storage = None
+
+    def read_config(self):
+        """Return the DB config as a dictionary. DBs created before the config file existed
+        have an empty config"""
+        config = {}
+        config_path = os.path.join(self.db_base_path, DB_CONFIG_FILE)
+        self._config_stamp = file_stamp(config_path)
+        if os.path.exists(config_path):
+            for ln in open(config_path).readlines():
+                if ':' in ln:
+                    key, val = ln.split(':', 1)
+                    config[key.strip()] = val.strip()
+        return config
+
+    def write_config(self, config):
+        """Write the DB config"""
+        config_str = ""
+        for key in sorted(config):
+            config_str += "{0}: {1}\n".format(key, config[key])
+        atomic_write(os.path.join(self.db_base_path, DB_CONFIG_FILE), config_str.encode('utf-8'))
+
+    @property
+    def storage(self):
+        """The storage engine holding the DB objects"""
+        if self._storage is None:
+            self.check_db()
+            self._storage = make_storage(self.db_base_path, self.read_config().get('engine', DEFAULT_ENGINE))
+        return self._storage
+
+    @property
+    def hash_algorithm(self):
+        """The algorithm new files and records are hashed with"""
+        return self.hash_algorithms()[0]
+
+    def hash_algorithms(self):
+        """Return all the algorithms objects in the DB may have been hashed with, current first"""
+        if self._hash_algorithms is None:
+            config = self.read_config()
+            current = config.get('hash', DEFAULT_HASH)
+            self._hash_algorithms = [current] + [a for a in config.get('old_hashes', '').split() if a != current]
+        return self._hash_algorithms
+
+    @property
+    def manifest_encoding(self):
+        """The encoding the file lists of dataset records are written with (see records.py)"""
+        if self._manifest_encoding is None:
+            self._manifest_encoding = self.read_config().get('manifest', TEXT_MANIFEST)
+        return self._manifest_encoding
+
+    def add_hash_algorithms(self, algorithms):
+        """Record that objects in the DB may also have been hashed with the given algorithms"""
+        new_algorithms = sorted(set(a for a in algorithms if not a in self.hash_algorithms()))
+        if new_algorithms:
+            config = self.read_config()
+            config['old_hashes'] = ' '.join(self.hash_algorithms()[1:] + new_algorithms)
+            self.write_config(config)
+            self._hash_algorithms = None
+
+    def hash_file(self, fname, algorithm=None):
+        """Return the hash of the given file without loading it all into memory"""
+        return self.hash_files([fname], algorithm=algorithm)[fname]
+
+    def hash_files(self, fnames, use_cache=True, limiter=None, algorithm=None):
+        """Return a dictionary of file name to hash, hashing on self.jobs threads with the given
+        algorithm (default: the DB's). Files that are unchanged since they were last hashed are
+        taken from the hash cache unless use_cache is False. Reads are throttled by the given
+        hashing.RateLimiter"""
+        algorithm = algorithm or self.hash_algorithm
+        with self.phase('hash'):
+            file_hash = {}
+            file_stat = {}
+            to_hash = []
+            store_cache = self.hash_cache and os.path.exists(self.db_base_path)
+            for f in fnames:
+                if f in file_hash:
+                    continue
+                file_hash[f] = ''
+                if store_cache:
+                    file_stat[f] = os.stat(f)
+                if store_cache and use_cache:
+                    cached = self.hash_cache.lookup(f, file_stat[f], algorithm)
+                    if cached:
+                        file_hash[f] = cached
+                        self.count('hash_cache_hits')
+                        continue
+                to_hash.append(f)
+
+            hashes = hash_files(to_hash, buffer_size=self.buffer_size, use_mmap=self.use_mmap, jobs=self.jobs, limiter=limiter, algorithm=algorithm)
+            for f, fhash in zip(to_hash, hashes):
+                file_hash[f] = fhash
+                if store_cache:
+                    self.hash_cache.store(f, fhash, file_stat[f])
+
+            if self.recorder.hooks:
+                self.count('files_hashed', len(to_hash))
+                self.count('bytes_hashed', sum(file_stat[f].st_size if f in file_stat else os.path.getsize(f) for f in to_hash))
+
+        return file_hash
+
+    def hash_files_iter(self, fnames, file_hash=None, algorithm=None):
+        """Yield (file name, hash) for each of the files as they're hashed in chunks, so hashing
+        can start before all the files are known. Files in the file_hash dictionary aren't rehashed"""
+        file_hash = file_hash or {}
+        fnames = iter(fnames)
+        while True:
+            chunk = list(itertools.islice(fnames, HASH_CHUNK_SIZE))
+            if not chunk:
+                break
+            self.count('files_found', len(chunk))
+            chunk_hash = self.hash_files([f for f in chunk if not f in file_hash], algorithm=algorithm)
+            for f in chunk:
+                yield f, file_hash.get(f) or chunk_hash[f]
         
     def write_hash_file(self, file_str, file_hash=''):
         """Write a hash file in the appropriate place given the contents"""
+        data = file_str
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
         if not file_hash:
-            file_hash = hashlib.sha1(file_str).hexdigest()
-            
-        if not os.path.exists(os.path.join(self.db_base_path, file_hash[:2])):
-            os.mkdir(os.path.join(self.db_base_path, file_hash[:2]))
-            
-        if not os.path.exists(os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4])):
-            os.mkdir(os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4]))
+            file_hash = hash_string(data, self.hash_algorithm)
 
-        open(os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4], file_hash), "w").write(file_str)
+        self.storage.write_object(file_hash, data)
+        self.invalidate(file_hash)
+        self.count('objects_written')
+        self.count('bytes_written', len(data))
 
         return file_hash
+
+    def read_hash_file(self, file_hash):
+        """Return the contents of the given hash file or None if it doesn't exist"""
+        data = self.storage.read_object(file_hash)
+        if data is None:
+            return None
+        self.count('objects_read')
+        self.count('bytes_read', len(data))
+        return data.decode('utf-8')
+
+    def update_hash_file(self, file_hash, update):
+        """Replace the given hash file with update(current contents or None), removing it if that
+        gives None. The storage makes the update under a lock on the object so updates made by
+        other processes at the same time aren't lost. update may be called more than once"""
+        def update_data(data):
+            file_str = update(data.decode('utf-8') if data else None)
+            return file_str.encode('utf-8') if file_str else None
+
+        self.storage.update_object(file_hash, update_data)
+        self.invalidate(file_hash)
+        self.count('objects_updated')
+
+    def update_ds_record(self, ds_hash, update):
+        """Replace the given dataset record with update(current dataset info or None), removing it
+        if that gives None. As for update_hash_file, but the record is written with the DB's
+        manifest encoding"""
+        manifest = self.manifest_encoding
+        def update_data(data):
+            ds_info = update(decode_ds_record(data, ds_hash) if data else None)
+            return encode_ds_record(ds_info, manifest) if ds_info else None
+
+        self.storage.update_object(ds_hash, update_data)
+        self.invalidate(ds_hash)
+        self.count('objects_updated')
+
+    def delete_hash_file(self, file_hash):
+        """Remove the given hash file"""
+        self.storage.delete_object(file_hash)
+        self.invalidate(file_hash)
+        self.count('objects_deleted')
     
-    def init_db(self):
+    def init_db(self, engine=DEFAULT_ENGINE, hash_algorithm=DEFAULT_HASH, manifest=TEXT_MANIFEST):
         """Initialise the database at the given location
         Note: This will throw an exception if DB exists"""
 
-        # is there a DB already?
-        if os.path.exists(self.db_base_path):
-            raise DatabaseExists
+        if not hash_algorithm in HASH_ALGORITHMS:
+            raise UnknownHashAlgorithm(hash_algorithm)
+        if not manifest in MANIFEST_ENCODINGS:
+            raise UnknownManifestEncoding(manifest)
         
-        # create the dir
-        os.mkdir(self.db_base_path)
+        # create the dir - if it's already there, so is a DB
+        try:
+            os.mkdir(self.db_base_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            raise DatabaseExists
+
+        # record and set up the storage engine
+        self.write_config({'engine': engine, 'hash': hash_algorithm, 'manifest': manifest})
+        if self.cache is not None:
+            self.cache.clear()
+        self._storage = None
+        self._hash_algorithms = None
+        self._manifest_encoding = None
+        self.storage.init_storage()
+
+    def migrate_db(self, engine=None, hash_algorithm=None, manifest=None):
+        """Move all the objects in the DB to the given storage engine, start hashing new files and
+        records with the given algorithm and/or rewrite every dataset with the given manifest
+        encoding. Existing objects keep their hashes and are still found by trying each algorithm
+        the DB has used"""
+        self.check_db()
+        if self.cache is not None:
+            self.cache.clear()
+
+        if manifest and manifest != self.manifest_encoding:
+            if not manifest in MANIFEST_ENCODINGS:
+                raise UnknownManifestEncoding(manifest)
+            config = self.read_config()
+            config['manifest'] = manifest
+            self.write_config(config)
+            self._manifest_encoding = None
+            with self.phase('write'), self.transaction():
+                for ds_hash in list(self.storage.iter_datasets()):
+                    self.update_ds_record(ds_hash, lambda ds_info: ds_info)
+
+        if hash_algorithm and hash_algorithm != self.hash_algorithm:
+            if not hash_algorithm in HASH_ALGORITHMS:
+                raise UnknownHashAlgorithm(hash_algorithm)
+            config = self.read_config()
+            config['old_hashes'] = ' '.join(a for a in self.hash_algorithms() if a != hash_algorithm)
+            config['hash'] = hash_algorithm
+            self.write_config(config)
+            self._hash_algorithms = None
+
+        old_storage = self.storage
+        if not engine or old_storage.name == engine:
+            return
+
+        new_storage = make_storage(self.db_base_path, engine)
+        try:
+            new_storage.init_storage()
+            with new_storage.transaction():
+                for obj_hash in old_storage.iter_objects():
+                    new_storage.write_object(obj_hash, old_storage.read_object(obj_hash))
+        except:
+            new_storage.destroy()
+            raise
+
+        # switch over and then remove the old objects
+        config = self.read_config()
+        config['engine'] = engine
+        self.write_config(config)
+        self._storage = new_storage
+        old_storage.destroy()
+
+    def gc(self, full=False):
+        """Compact the object storage, e.g. fold loose objects into packs"""
+        self.check_db()
+        self.storage.gc(full=full)
+
+    def ds_record_hash(self, ds_info):
+        """Return the hash identifying a new dataset: the hash of its record in the text format,
+        whatever encoding it's stored with. The record is hashed a line at a time"""
+        obj_hash = new_hash(self.hash_algorithm)
+        obj_hash.update(format_ds_header(ds_info).encode('utf-8'))
+        for path, fhash in zip(ds_info['file_paths'], ds_info['file_hashes']):
+            obj_hash.update(format_ds_manifest_line(path, fhash).encode('utf-8'))
+        return obj_hash.hexdigest()
 
     def write_ds_info(self, ds_info):
         """Modify the given dataset info file"""
         
-        ds_file_str = ""
-
-        # add creation time
-        ds_file_str += "Creation:  " + ds_info['creation'] + "\n\n"
-
-        # add parents
-        ds_file_str += "Parents:  " + ' '.join(ds_info['parents']) + "\n\n"
-
-        # add tags
-        ds_file_str += "Tags:  \n"
-        for tag in ds_info['tags']:
-            ds_file_str += ' - ' + tag + "\n"
-            
-        ds_file_str += "\n"
-
-        # add the list of DS files
-        for i in range(0, len(ds_info['file_paths'])):
-            ds_file_str += ds_info['file_paths'][i] + "  " + ds_info['file_hashes'][i] + "\n"
-            
         # hash the contents and create the file
-        ds_hash = self.write_hash_file(ds_file_str, ds_info['ds_hash'])
+        ds_hash = self.write_hash_file(encode_ds_record(ds_info, self.manifest_encoding), ds_info['ds_hash'] or self.ds_record_hash(ds_info))
         return ds_hash
     
-    def add_ds(self, filelist, parents=[], tags=[], file_hash={}, ds_hash='', gitinfo=[]):
-        """Add the given dataset and all associated files"""
+    def add_ds(self, filelist, parents=[], tags=None, file_hash=None, ds_hash='', gitinfo=[],
+               recursive=False, include=None, exclude=None):
+        """Add the given dataset and all associated files. Returns the dataset hash.
+        file_hash gives files already known to be in the dataset, along with their hashes"""
 
         self.check_db()
+        if file_hash is None:
+            file_hash = {}
 
         ds_info = {}
         ds_info['creation'] = datetime.now().isoformat()
-        ds_info['parents'] = parents
-
-        # add tags
+        # store the full hash of each parent so the lineage can be followed both ways
+        ds_info['parents'] = []
+        for p in parents:
+            parent_hash = self.get_ds_hash_from_file_or_hash(p)
+            if not parent_hash:
+                raise NotValidFileOrHash("Parent {0} is not a dataset or a file in one".format(p))
+            ds_info['parents'].append(parent_hash)
+
+        # add tags, copying them as the git tags are added to the list
+        tags = list(tags or [])
         ds_info['tags'] = tags
         
-        for repo_path in gitinfo:
-            if not os.path.exists(repo_path):
-                raise GitRepoDoesNotExist
-            tags.append( 'GIT HEAD: ' + subprocess.check_output("git -C {0} rev-parse HEAD".format(repo_path), shell=True).strip())
-            tags.append( 'GIT Branch: ' + subprocess.check_output("git -C {0} rev-parse --abbrev-ref HEAD".format(repo_path), shell=True).strip())
-            tags.append( 'GIT Remote: ' + subprocess.check_output("git -C {0} remote -v".format(repo_path), shell=True).replace('\n', ' ').strip())
-            tags.append( 'GIT Path: ' + repo_path)
+        with self.phase('git'):
+            for repo_path in gitinfo:
+                if not os.path.exists(repo_path):
+                    raise GitRepoDoesNotExist
+                git_info = read_git_info(repo_path)
+                tags.append( 'GIT HEAD: ' + git_info['head'])
+                tags.append( 'GIT Branch: ' + git_info['branch'])
+                tags.append( 'GIT Remote: ' + git_info['remote'])
+                tags.append( 'GIT Path: ' + repo_path)
             
-        # add the list of DS files
-        ds_files = []
-        for fname in filelist:
-            ds_files += glob.glob(fname)
-        ds_files = sorted(ds_files)
-        if not ds_files:
+        # find the DS files, hashing anything we don't know about yet as they're found
+        with self.phase('scan'):
+            file_hash = dict(file_hash)
+            found = False
+            for f, fhash in self.hash_files_iter(iter_files(filelist, recursive, include, exclude), file_hash):
+                file_hash[f] = fhash
+                found = True
+        if not found:
             raise FileNotFound
 
-        ds_info['file_paths'] =[]
-        ds_info['file_hashes'] =[]
-        for f in ds_files:
-            if not f in file_hash:
-                file_hash[f] = hashlib.sha1(open(f, "rb").read()).hexdigest()
-
-            ds_info['file_paths'].append(f)
-            ds_info['file_hashes'].append(file_hash[f])
+        ds_files = sorted(file_hash)
+        ds_info['file_paths'] = ds_files
+        ds_info['file_hashes'] = [file_hash[f] for f in ds_files]
             
-        # hash the contents and create the file
-        ds_info['ds_hash'] = ds_hash
-        ds_hash = self.write_ds_info(ds_info)
+        with self.phase('write'), self.transaction():
+            # hash the contents and create the file
+            ds_info['ds_hash'] = ds_hash
+            if ds_hash and self.check_ds_hash(ds_hash):
+                # adding to an existing dataset so keep any files another process has just added
+                self.update_ds_record(ds_hash, functools.partial(merge_ds_record, ds_info=ds_info))
+            else:
+                ds_hash = self.write_ds_info(ds_info)
         
-        # create a hash for each of the given files
+            self.add_file_records(ds_hash, ds_files, file_hash)
+
+        return ds_hash
+
+    def add_file_records(self, ds_hash, ds_files, file_hash):
+        """Add the dataset to the record of each of the given files, given a dictionary of file name
+        to hash"""
         for f in ds_files:
             # check if we have a duplicate file
             file_info = self.get_file_info(f, file_hash[f])
@@ -123,14 +468,22 @@ class DSDatabase:
                 # attempting to add file to same ds
                 if ds_hash in file_info['ds']:
                     continue
-                
+
                 print("WARNING: File {0} already present in dataset(s) {1}".format(f, file_info['ds']))
-                file_info['ds'].insert(0, ds_hash)
-                file_str = "{0}\n{1}\n".format(" ".join(file_info['ds']), f)
             else:
-                file_str = "{0}\n{1}\n".format(ds_hash, f)
-                
-            self.write_hash_file(file_str, file_hash=file_hash[f])
+                file_info = {'size':None, 'partial':''}
+
+            # remember enough to find the file again if it moves (see locate_ds). Small files are
+            # just hashed in full there so only big ones need the partial hash
+            size, partial = file_info['size'], file_info['partial']
+            if size is None and os.path.isfile(f):
+                size = os.path.getsize(f)
+                partial = partial_hash(f) if size > PARTIAL_HASH_MIN_SIZE else ''
+
+            # the record is updated rather than rewritten so other datasets the file is being
+            # added to at the same time aren't lost
+            self.update_hash_file(file_hash[f], functools.partial(add_file_dataset, file_hash=file_hash[f], ds_hash=ds_hash,
+                                                                  path=f, size=size, partial=partial))
 
     def get_file_info(self, fname, file_hash=""):
         """get the file info of the given file"""
@@ -139,20 +492,26 @@ class DSDatabase:
         if not os.path.exists(fname) and not file_hash:
             return {}
 
-        # what is it's hash?
-        if not file_hash:
-            file_hash = hashlib.sha1(open(fname, "rb").read()).hexdigest()
+        # what is it's hash? It could have been added with any algorithm the DB has used
+        if file_hash:
+            file_hashes = [file_hash]
+        else:
+            file_hashes = (self.hash_file(fname, algorithm) for algorithm in self.hash_algorithms())
         
         # open the file info
-        if not os.path.exists( os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4], file_hash) ):
-            return {}
+        for file_hash in file_hashes:
+            file_info = self.read_file_info(file_hash)
+            if file_info:
+                return file_info
 
-        file_info_lines = open( os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4], file_hash) ).readlines()
-        file_info = {'ds':[], 'path':file_info_lines[1].strip(), 'hash':file_hash}
-        for ds in file_info_lines[0].split():
-            file_info['ds'].append(ds.strip())
-            
-        return file_info
+        return {}
+
+    def read_file_info(self, file_hash):
+        """Return the parsed record of the file with the given hash or {} if there isn't one"""
+        def load():
+            file_str = self.read_hash_file(file_hash)
+            return parse_file_record(file_str, file_hash) if file_str is not None else {}
+        return self.cached('file', file_hash, load)
         
     def find_ds_from_file(self, fname):
         """return the hash of a DS given the file"""
@@ -168,25 +527,22 @@ class DSDatabase:
 
     def check_ds_hash(self, ds_hash):
         """check that a ds hash is valid"""
-        return os.path.exists(os.path.join(self.db_base_path, ds_hash[:2], ds_hash[2:4], ds_hash))
+        return self.cached('has_ds', ds_hash, lambda: self.storage.has_dataset(ds_hash))
 
     def expand_hash(self, ds_hash):
-        """Expand the given hash if we can, otherwise return nothing"""
-        if len(ds_hash) < 7:
-            return ''
-
-        # do we have the directory?
-        if not os.path.exists(os.path.join(self.db_base_path, ds_hash[:2], ds_hash[2:4])):
+        """Expand the given hash if we can, otherwise return nothing.
+        Raises AmbiguousHash if it matches more than one dataset"""
+        if not ds_hash or not is_hex(ds_hash):
             return ''
 
-        # can we match any files?
-        hash_list = glob.glob(os.path.join(self.db_base_path, ds_hash[:2], ds_hash[2:4], ds_hash+'*'))
+        # can we match any datasets?
+        hash_list = self.storage.hashes_with_prefix(ds_hash, limit=MAX_AMBIGUOUS_REPORT)
         if len(hash_list) == 0:
             return ''
         elif len(hash_list) != 1:
-            return hash
+            raise AmbiguousHash("{0} matches multiple datasets: {1}".format(ds_hash, ' '.join(hash_list)))
         
-        return os.path.basename(hash_list[0])
+        return hash_list[0]
     
     def get_ds_hash_from_file_or_hash(self, file_or_hash):
         """Given a filename or ds hash, return the ds hash if found
@@ -196,7 +552,7 @@ class DSDatabase:
         ds_hash = self.find_ds_from_file(file_or_hash)
         if not ds_hash:
             temp_hash = self.expand_hash(file_or_hash)
-            if file_or_hash[0] == '/' or not self.check_ds_hash(temp_hash):
+            if not temp_hash or not self.check_ds_hash(temp_hash):
                 ds_hash = ''
             else:
                 ds_hash = temp_hash
@@ -210,115 +566,377 @@ class DSDatabase:
         if not ds_hash:
             raise NotValidFileOrHash
         
-        # we have the DS hash so return the info
-        ds_info = {'file_paths':[], 'file_hashes':[], 'ds_hash': ds_hash, 'parents': [], 'tags': []}
-        for ln in open( os.path.join(self.db_base_path, ds_hash[:2], ds_hash[2:4], ds_hash)).readlines():
-            if ln.startswith("Creation"):
-                ds_info['creation'] = ' '.join(ln.split()[1:]).strip()
-            elif ln.startswith("Parents"):
-                ds_info['parents'] = ln.split()[1:]
-            elif ln.startswith("Tags"):
-                continue
-            elif ln.startswith(" - "):
-                ds_info['tags'].append(ln[3:].strip())
-            elif len(ln) > 4:
-                # file list
-                ds_info['file_paths'].append( ln.split()[0].strip() )
-                ds_info['file_hashes'].append( ln.split()[1].strip() )
-            
-        return ds_info
+        # we have the DS hash so return the info. The file list is always stored in path order
+        # (see add_files)
+        def load():
+            ds_info, manifest = self.read_ds_record(ds_hash)
+            ds_info['file_paths'] = []
+            ds_info['file_hashes'] = []
+            for path, fhash in manifest:
+                ds_info['file_paths'].append(path)
+                ds_info['file_hashes'].append(fhash)
+            return ds_info
+        return self.cached('ds', ds_hash, load)
+
+    def read_ds_header(self, ds_hash):
+        """Return the dataset info for the given full hash without the file list. Only the start of
+        the record is read"""
+        def load():
+            f = self.storage.open_object(ds_hash)
+            if f is None:
+                raise NotValidFileOrHash
+            self.count('objects_read')
+            try:
+                header = parse_ds_header((ln.decode('utf-8') for ln in f), ds_hash)
+                header.pop('manifest', None)
+                return header
+            finally:
+                f.close()
+        return self.cached('header', ds_hash, load)
+
+    def get_ds_header(self, file_or_hash):
+        """return the dataset info without the file list given a file or hash"""
+
+        ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
+        if not ds_hash:
+            raise NotValidFileOrHash
+
+        return self.read_ds_header(ds_hash)
+
+    def read_ds_record(self, ds_hash):
+        """Return the header of the dataset with the given full hash and an iterator over the
+        (path, hash) of each of its files. The file list is read as it's iterated over so memory
+        doesn't grow with the number of files"""
+        f = self.storage.open_object(ds_hash)
+        if f is None:
+            raise NotValidFileOrHash
+        self.count('objects_read')
+        try:
+            header, entries = open_ds_record(f, ds_hash)
+        except:
+            f.close()
+            raise
+
+        def manifest():
+            try:
+                for entry in entries:
+                    yield entry
+            finally:
+                f.close()
+
+        return header, manifest()
+
+    def read_ds_manifest(self, ds_hash):
+        """Return an iterator over the (path, hash) of each file of the dataset with the given full hash"""
+        return self.read_ds_record(ds_hash)[1]
 
-    def get_ds_tree(self, file_or_hash):
-        """Return a dictionary that contains the tree info for the given dataset"""
+    def get_ds_record(self, file_or_hash):
+        """return the dataset header and an iterator over its files given a file or hash"""
 
         ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
         if not ds_hash:
             raise NotValidFileOrHash
 
-        # grab the info
-        def get_parent_info(ds_hash):
-            ds_info = self.get_ds_info(ds_hash)
-            tree_info = {'ds_hash':ds_hash, 'parents':[], 'tags':ds_info['tags']}
-            for ds in ds_info['parents']:
-                tree_info['parents'].append( get_parent_info(ds) )
-            return tree_info
-        
-        return get_parent_info(ds_hash)
+        return self.read_ds_record(ds_hash)
+
+    def find_ds(self, tags=[], since=None, until=None, parents=[]):
+        """Return an iterator over the hashes of the datasets that have all the given tags (including
+        git info tags such as 'GIT Branch: <branch>') and parents (files or hashes) and were created
+        in [since, until). The times are datetimes or ISO time strings and either can be left out.
+        The query is answered from the storage indexes so only the matching datasets are read"""
+        parent_hashes = []
+        for parent in parents:
+            ds_hash = self.get_ds_hash_from_file_or_hash(parent)
+            if not ds_hash:
+                raise NotValidFileOrHash
+            parent_hashes.append(ds_hash)
+
+        def iso_time(t):
+            if t is None or isinstance(t, datetime):
+                return t and t.isoformat()
+            return parse_iso_time(t).isoformat()
+
+        return self.storage.find_datasets(tags=tags, since=iso_time(since), until=iso_time(until), parents=parent_hashes)
+
+    def walk_ds_graph(self, ds_hash, link_name, links, max_depth=None):
+        """Walk the dataset graph from the given dataset following links(ds_hash, header), which
+        returns the hashes to visit next and stores them in each node under link_name. Each dataset
+        header is read once and datasets reachable by more than one route are shared. Datasets at
+        max_depth aren't followed and are marked as truncated if they have any links. Returns the
+        node of the given dataset"""
+
+        def make_node(ds_hash):
+            header = self.read_ds_header(ds_hash)
+            return {'ds_hash':ds_hash, link_name:[], 'tags':header['tags'], 'truncated':False}, header
+
+        with self.phase('walk'):
+            root, header = make_node(ds_hash)
+            nodes = {ds_hash: root}
+            to_visit = deque([(ds_hash, header, 0)])
+            while to_visit:
+                ds_hash, header, depth = to_visit.popleft()
+                next_hashes = links(ds_hash, header)
+                if max_depth is not None and depth >= max_depth:
+                    nodes[ds_hash]['truncated'] = bool(next_hashes)
+                    continue
 
-    def add_files(self, filelist, dataset):
-        """Add the given files to the given dataset"""
+                for next_hash in next_hashes:
+                    if not next_hash in nodes:
+                        nodes[next_hash], next_header = make_node(next_hash)
+                        to_visit.append((next_hash, next_header, depth + 1))
+                    nodes[ds_hash][link_name].append(nodes[next_hash])
 
-        # first, does the dataset exist?
-        ds_info = self.get_ds_info(dataset)
+        return root
+
+    def get_ds_tree(self, file_or_hash, max_depth=None):
+        """Return a dictionary that contains the tree info for the given dataset. Ancestors reachable
+        by more than one route appear once and are shared by all their children"""
 
-        if not ds_info:
+        ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
+        if not ds_hash:
             raise NotValidFileOrHash
 
-        ds_info['file_paths'] += filelist
-        file_hash = {}
-        for i in range(0, len(ds_info['file_hashes'])):
-            file_hash[ ds_info['file_paths'][i] ] = ds_info['file_hashes'][i]
+        def parents(ds_hash, header):
+            # older records can have abbreviated parents
+            return [p if self.check_ds_hash(p) else self.get_ds_hash_from_file_or_hash(p) or p for p in header['parents']]
 
-        self.add_ds(ds_info['file_paths'], parents=ds_info['parents'], tags=ds_info['tags'], file_hash=file_hash, ds_hash=ds_info['ds_hash'])
-        
-    def del_ds(self, file_or_hash):
-        """Delete the given dataset from the DB"""
+        return self.walk_ds_graph(ds_hash, 'parents', parents, max_depth)
 
-        # first, does the dataset exist?
+    def get_ds_descendants(self, file_or_hash, max_depth=None):
+        """Return a dictionary that contains the tree of datasets derived from the given dataset.
+        A dataset reachable by more than one route appears once and is shared by all its parents"""
+
+        ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
+        if not ds_hash:
+            raise NotValidFileOrHash
+
+        def children(ds_hash, header):
+            return self.storage.get_children(ds_hash)
+
+        return self.walk_ds_graph(ds_hash, 'children', children, max_depth)
+
+    def verify_ds(self, file_or_hash, use_cache=True, max_rate=None):
+        """Check the files of the given dataset against what's on disk. Returns a dictionary of the
+        dataset hash and lists of the 'ok', 'modified' and 'missing' files. Files with unchanged
+        stat info are taken from the hash cache unless use_cache is False. max_rate limits the
+        bytes per second read"""
+        ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
+        if not ds_hash:
+            raise NotValidFileOrHash
+        result = {'ds_hash':ds_hash, 'ok':[], 'modified':[], 'missing':[]}
+        limiter = RateLimiter(max_rate) if max_rate else None
+
+        with self.phase('verify'):
+            entries = self.read_ds_manifest(ds_hash)
+            while True:
+                chunk = list(itertools.islice(entries, HASH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                file_hash = {}
+                for algorithm in set(algorithm_of(fhash) for f, fhash in chunk):
+                    present = [f for f, fhash in chunk if algorithm_of(fhash) == algorithm and os.path.isfile(f)]
+                    file_hash.update(self.hash_files(present, use_cache=use_cache, limiter=limiter, algorithm=algorithm))
+                for f, fhash in chunk:
+                    if not f in file_hash:
+                        result['missing'].append(f)
+                    elif file_hash[f] != fhash:
+                        result['modified'].append(f)
+                    else:
+                        result['ok'].append(f)
+
+        return result
+
+    def locate_ds(self, file_or_hash, search_paths, rewrite=False, include=None, exclude=None):
+        """Look under the given paths for the files of the dataset that are no longer at their
+        recorded paths. Only files with the size of a missing file are considered and, for big
+        files, only those whose partial hash also matches are fully hashed. Returns a dictionary of the dataset hash,
+        'found' mapping old paths to new ones, the 'missing' paths not found and the 'unknown_size'
+        paths that couldn't be searched for. If rewrite is True the records are updated to the new
+        paths"""
         ds_info = self.get_ds_info(file_or_hash)
+        ds_hash = ds_info['ds_hash']
+        result = {'ds_hash':ds_hash, 'found':{}, 'missing':[], 'unknown_size':[]}
 
-        # clear out DS info from the files
-        for fhash in ds_info['file_hashes']:
+        # the missing files grouped by size, so candidates of any other size can be skipped
+        lost = {}
+        for f, fhash in zip(ds_info['file_paths'], ds_info['file_hashes']):
+            if not os.path.isfile(f):
+                lost.setdefault(fhash, []).append(f)
+
+        by_size = {}
+        for fhash in sorted(lost):
             file_info = self.get_file_info('', file_hash=fhash)
-            file_info['ds'].remove(ds_info["ds_hash"])
-            if len(file_info['ds']) == 0:
-                # no other datasets so remove it
-                os.remove(os.path.join(self.db_base_path, file_hash[:2], file_hash[2:4], file_hash))
+            size, partial = file_info.get('size'), file_info.get('partial', '')
+            if size is None and self.hash_cache:
+                # recorded before sizes were - the hash cache may still remember it
+                size = self.hash_cache.cached_size(lost[fhash][0], fhash)
+            if size is None:
+                result['unknown_size'] += lost[fhash]
             else:
-                # re-write the info file with this change
-                file_str = "{0}\n{1}\n".format(" ".join(file_info['ds']), file_info['path'])
-                self.write_hash_file(file_str, file_hash=fhash)
-
-        # finally, remove the DS entry
-        os.remove(os.path.join(self.db_base_path, ds_info['ds_hash'][:2], ds_info['ds_hash'][2:4], ds_info['ds_hash']))
-    
-    def del_files(self, filelist):
-        """Remove these files from the DB"""
+                by_size.setdefault(size, {})[fhash] = partial
+
+        located = {}
+        algorithms = sorted(set(algorithm_of(fhash) for fhash in lost))
+        def check_candidates(candidates):
+            to_hash = []
+            for f, size in candidates:
+                partials = set(partial for fhash, partial in by_size[size].items() if not fhash in located)
+                if not partials:
+                    continue
+                if not '' in partials:
+                    self.count('partial_hashes')
+                    if not partial_hash(f) in partials:
+                        continue
+                to_hash.append(f)
+
+            for algorithm in algorithms:
+                for f, fhash in sorted(self.hash_files(to_hash, algorithm=algorithm).items()):
+                    if fhash in lost and not fhash in located:
+                        located[fhash] = f
+
+        searching = sum(len(hashes) for hashes in by_size.values())
+        with self.phase('locate'):
+            candidates = []
+            for f in iter_files(search_paths if by_size else [], True, include, exclude):
+                self.count('files_found')
+                try:
+                    size = os.path.getsize(f)
+                except OSError:
+                    continue
+                if not size in by_size:
+                    continue
+                candidates.append((f, size))
+                if len(candidates) >= HASH_CHUNK_SIZE:
+                    check_candidates(candidates)
+                    candidates = []
+                    if len(located) >= searching:
+                        # everything found so no need to look any further
+                        break
+            check_candidates(candidates)
+
+        for fhash in sorted(lost):
+            for f in lost[fhash]:
+                if fhash in located:
+                    result['found'][f] = located[fhash]
+                else:
+                    result['missing'].append(f)
+
+        if rewrite and result['found']:
+            # the records are updated rather than rewritten so files and datasets other processes
+            # add at the same time aren't lost
+            moved = dict(((f, fhash), located[fhash]) for fhash in located for f in lost[fhash])
+            with self.phase('write'), self.transaction():
+                self.update_ds_record(ds_hash, functools.partial(move_ds_files, moved=moved))
+                for fhash in sorted(located):
+                    self.update_hash_file(fhash, functools.partial(move_file_record, file_hash=fhash, old_paths=lost[fhash],
+                                                                   new_path=located[fhash]))
+
+        return result
+
+    def iter_ds_hashes(self):
+        """Iterate over the hashes of all the datasets in the DB"""
+        return self.storage.iter_datasets()
+
+    def add_files(self, filelist, dataset, recursive=False, include=None, exclude=None):
+        """Add the given files to the given dataset. Returns the dataset hash, which doesn't change.
+        Only the new files are hashed and have their records written, and they are appended to the
+        dataset record without rewriting its existing entries. A file that's already in the dataset
+        with other contents replaces its old entry and the dataset is taken off the old file record"""
 
-        # glob the files and check if they all exist
-        all_files = []
-        for fname in filelist:
-            all_files +=  glob.glob(fname)
+        # first, does the dataset exist?
+        ds_hash = self.get_ds_hash_from_file_or_hash(dataset)
+        if not ds_hash:
+            raise NotValidFileOrHash
 
-        if not all_files:
+        with self.phase('scan'):
+            file_hash = dict(self.hash_files_iter(iter_files(filelist, recursive, include, exclude)))
+        if not file_hash:
             raise FileNotFound
 
-        # now remove each one
-        ds_list = []
-        all_file_info = []
-        for fname in all_files:
-            file_info = self.get_file_info(fname)
-            all_file_info.append((file_info['path'], file_info['hash']))
-            
-            # keep track of the datasets to check afterwards
-            ds_list += file_info['ds']
+        new_files = sorted(file_hash)
+        new_hashes = [file_hash[f] for f in new_files]
+        manifest = self.manifest_encoding
+        def append_files(data):
+            if data is None:
+                # deleted in the meantime
+                return None
+            appended = append_ds_files(data, ds_hash, new_files, new_hashes)
+            if appended is None:
+                # some of the files have changed or sort before the existing ones so the record has
+                # to be rewritten to keep it in path order
+                current = decode_ds_record(data, ds_hash)
+                appended = encode_ds_record(merge_ds_record(current, dict(current, file_paths=new_files, file_hashes=new_hashes)), manifest)
+            return appended
+
+        with self.phase('write'), self.transaction():
+            replaced = self.replaced_file_hashes(ds_hash, file_hash)
+            self.storage.update_object(ds_hash, append_files)
+            self.invalidate(ds_hash)
+            self.count('objects_updated')
+            self.add_file_records(ds_hash, new_files, file_hash)
+
+            # files that have changed no longer have their old contents in the dataset
+            for fhash in sorted(replaced):
+                self.update_hash_file(fhash, functools.partial(remove_file_dataset, file_hash=fhash, ds_hash=ds_hash))
 
-            # remove the file info
-            os.remove(os.path.join(self.db_base_path, file_info['hash'][:2], file_info['hash'][2:4], file_info['hash']))
-            
-        # remove duplicate DS checks
-        ds_list = list(set(ds_list))
+        return ds_hash
+        
+    def replaced_file_hashes(self, ds_hash, file_hash):
+        """Return the hashes that the dataset will no longer have once the files in the dictionary of
+        file name to hash replace its entries for the same paths"""
+        replaced = set()
+        kept = set(file_hash.values())
+        for path, fhash in self.read_ds_manifest(ds_hash):
+            if file_hash.get(path, fhash) != fhash:
+                replaced.add(fhash)
+            else:
+                kept.add(fhash)
+        return replaced - kept
+
+    def del_ds(self, file_or_hash):
+        """Delete the given dataset from the DB. Each of its file records is read and rewritten once"""
+
+        # first, does the dataset exist?
+        ds_hash = self.get_ds_hash_from_file_or_hash(file_or_hash)
+        if not ds_hash:
+            raise NotValidFileOrHash
 
-        for ds in ds_list:
-            ds_info = self.get_ds_info(ds)
+        with self.phase('write'), self.transaction():
+            # clear out DS info from the files, removing those in no other datasets
+            for fhash in sorted(set(fhash for f, fhash in self.read_ds_manifest(ds_hash))):
+                self.update_hash_file(fhash, functools.partial(remove_file_dataset, file_hash=fhash, ds_hash=ds_hash))
 
-            for finfo in all_file_info:
-                ds_info['file_paths'].remove(finfo[0])
-                ds_info['file_hashes'].remove(finfo[1])
+            # finally, remove the DS entry
+            self.delete_hash_file(ds_hash)
+    
+    def del_files(self, filelist, recursive=False, include=None, exclude=None):
+        """Remove these files from the DB. Each affected dataset is read and rewritten once"""
 
-            if len(ds_info['file_paths']) == 0:
-                # the DS has no more files, remove it
-                os.remove(os.path.join(self.db_base_path, ds_info['ds_hash'][:2], ds_info['ds_hash'][2:4], ds_info['ds_hash']))
-            else:
-                # otherwise, rewrite the ds_info file
-                self.write_ds_info(ds_info)
+        # find and hash the files with each algorithm they could have been added with
+        with self.phase('scan'):
+            hashes = set()
+            for algorithm in self.hash_algorithms():
+                hashes.update(fhash for f, fhash in self.hash_files_iter(iter_files(filelist, recursive, include, exclude), algorithm=algorithm))
+
+        if not hashes:
+            raise FileNotFound
+
+        with self.phase('write'), self.transaction():
+            # remove each file record, keeping track of what to take out of each dataset
+            removed = {}
+            for fhash in sorted(hashes):
+                file_info = self.get_file_info('', file_hash=fhash)
+                if not file_info:
+                    # not in the DB
+                    continue
+                for ds in file_info['ds']:
+                    removed.setdefault(ds, set()).add(fhash)
+                self.delete_hash_file(fhash)
+
+            self.remove_from_datasets(removed)
+
+    def remove_from_datasets(self, removed):
+        """Take the files out of the datasets given a dictionary of dataset hash to the set of file
+        hashes to remove. Datasets with no files left are deleted"""
+        for ds_hash in sorted(removed):
+            self.update_ds_record(ds_hash, functools.partial(remove_ds_files, file_hashes=removed[ds_hash]))
@@ -12,5 +12,14 @@ class FileNotFound(Exception):
 class NotValidFileOrHash(Exception):
     pass
 
+class AmbiguousHash(NotValidFileOrHash):
+    pass
+
 class GitRepoDoesNotExist(Exception):
     pass
+
+class UnknownHashAlgorithm(Exception):
+    pass
+
+class UnknownManifestEncoding(Exception):
+    pass
@@ -0,0 +1,119 @@
+# Filesystem helpers for DBs that many processes write to at once
+#
+# Files are written to a temporary file alongside them and renamed into place so readers never
+# see a partial file, directories are created without a check-then-create race and updates are
+# serialised with POSIX record locks. A LockFile hands out an exclusive lock on one byte of the
+# lock file per key (e.g. an object hash) so unrelated updates don't wait for each other. Record
+# locks also work over NFS (with a working lock daemon), unlike flock on older systems. They are
+# held per process, so threads of the same process don't exclude each other - dstrk only ever
+# writes to a DB from one thread at a time.
+
+# system imports
+from contextlib import contextmanager
+import errno
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# times atomic_write tries to create its directory before giving up
+MAX_CREATE_ATTEMPTS = 10
+
+# -----------------------------------------------------------------------------
+def ensure_dir(path):
+    """Create the directory and any missing parents. Safe if another process creates it first"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+# -----------------------------------------------------------------------------
+def file_stamp(path):
+    """Return what's needed to tell if the file has changed, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+# -----------------------------------------------------------------------------
+def atomic_write(path, data):
+    """Write the bytes to path by renaming a temporary file into place. The directory is only
+    created if the first attempt to write fails, and again if a gc removes it as empty before the
+    temporary file is in it"""
+    tmp_path = "{0}.{1}-{2}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+    for attempt in range(0, MAX_CREATE_ATTEMPTS):
+        try:
+            f = open(tmp_path, "wb")
+            break
+        except IOError as e:
+            if e.errno != errno.ENOENT or attempt == MAX_CREATE_ATTEMPTS - 1:
+                raise
+        ensure_dir(os.path.dirname(path))
+
+    try:
+        with f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# -----------------------------------------------------------------------------
+# class to hand out locks on keys using a byte of a lock file each. Without fcntl (i.e. on
+# Windows) the locks do nothing
+class LockFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    @contextmanager
+    def lock(self, key='', shared=False):
+        """Context manager holding the lock for the given hex key, or the whole file if no key is
+        given. Locks don't nest - releasing the inner one releases the outer one too"""
+        if fcntl is None:
+            yield
+            return
+
+        # the first 60 bits of the key pick the byte - a length of 0 locks the whole file
+        offset, length = (int(key[:15], 16), 1) if key else (0, 0)
+        fcntl.lockf(self.open(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX, length, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    @contextmanager
+    def lock_all(self, keys):
+        """Context manager holding the exclusive locks for all the given hex keys. They're taken in
+        order so two processes doing this at once can't deadlock"""
+        if fcntl is None:
+            yield
+            return
+
+        locked = []
+        try:
+            for offset in sorted(set(int(key[:15], 16) for key in keys)):
+                fcntl.lockf(self.open(), fcntl.LOCK_EX, 1, offset)
+                locked.append(offset)
+            yield
+        finally:
+            for offset in locked:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, offset)
+
+    def open(self):
+        """Return the file descriptor of the lock file, creating it if needed"""
+        if self.fd is None:
+            ensure_dir(os.path.dirname(self.path))
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        return self.fd
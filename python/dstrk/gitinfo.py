@@ -0,0 +1,225 @@
+# Read the git metadata recorded for --gitinfo straight from a repository's .git directory
+#
+# This gives the same answers as
+#
+#   git rev-parse HEAD
+#   git rev-parse --abbrev-ref HEAD
+#   git remote -v
+#
+# without starting any processes: HEAD is followed to its branch, which is looked up as a loose
+# ref and then in packed-refs, and the remotes are read from .git/config. The results are kept
+# per process along with the stat info of every file they came from, so repeated datasets from
+# the same repository cost a few stats. Layouts that aren't read here (worktrees and submodules
+# with a .git file, reftables, config includes, url rewriting, ambiguous branch names, ...) fall
+# back to running git.
+
+# system imports
+import os
+import re
+import subprocess
+import threading
+
+# DT imports
+from dstrk.fsutil import file_stamp
+
+# number of symbolic refs followed before giving up
+MAX_SYMREF_DEPTH = 5
+
+# config files other than the repository's own that could change the remotes
+GLOBAL_CONFIGS = ['/etc/gitconfig', os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'git', 'config'),
+                  os.path.expanduser('~/.gitconfig')]
+
+SECTION_RE = re.compile(r'^\s*\[\s*([^\s\]"]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(.*)$')
+SHA_RE = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+# -----------------------------------------------------------------------------
+class Unsupported(Exception):
+    """Raised when the repository needs git itself to be read"""
+    pass
+
+# -----------------------------------------------------------------------------
+def run_git(repo_path, *args):
+    """Return the stripped output of the git command run in the repository"""
+    return subprocess.check_output(['git', '-C', repo_path] + list(args)).decode('utf-8').strip()
+
+def read_git_info_with_git(repo_path):
+    """Return the git info dictionary by running git"""
+    return {'head': run_git(repo_path, 'rev-parse', 'HEAD'),
+            'branch': run_git(repo_path, 'rev-parse', '--abbrev-ref', 'HEAD'),
+            'remote': run_git(repo_path, 'remote', '-v').replace('\n', ' ').strip()}
+
+# -----------------------------------------------------------------------------
+def read_file(path):
+    """Return the stripped contents of a file or None if it doesn't exist"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def find_git_dir(repo_path):
+    """Return the .git directory of the repository containing the given path, which may also be
+    the git directory of a bare repository"""
+    path = os.path.abspath(repo_path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.exists(dot_git):
+            # a gitdir: link from a worktree or submodule
+            raise Unsupported(dot_git)
+        if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+            return path
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise Unsupported("not in a git repository")
+        path = parent
+
+def parse_config(path):
+    """Return the list of (section, subsection, key, value) entries of a git config file. Values
+    continued over several lines aren't supported"""
+    entries = []
+    section = subsection = None
+    for ln in open(path).read().splitlines():
+        match = SECTION_RE.match(ln)
+        if match:
+            section, subsection, ln = match.group(1).lower(), match.group(2), match.group(3)
+        ln = ln.strip()
+        if not ln or ln[0] in '#;':
+            continue
+        if section is None or ln.endswith('\\'):
+            raise Unsupported(path)
+
+        key, sep, value = ln.partition('=')
+        value = value.strip()
+        if value.startswith('"') or '"' in value or '\\' in value:
+            raise Unsupported(path)
+        entries.append((section, subsection, key.strip().lower(), re.split(r'\s[#;]', value)[0].strip() if sep else 'true'))
+    return entries
+
+# -----------------------------------------------------------------------------
+class GitDirReader(object):
+    """Read the git info from a .git directory, remembering every file looked at"""
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.files = []
+        self._packed_refs = None
+
+    def path(self, name):
+        path = os.path.join(self.git_dir, name)
+        self.files.append((path, file_stamp(path)))
+        return path
+
+    def packed_refs(self):
+        if self._packed_refs is None:
+            self._packed_refs = {}
+            contents = read_file(self.path('packed-refs')) or ''
+            for ln in contents.splitlines():
+                if ln.startswith('#') or ln.startswith('^'):
+                    continue
+                fields = ln.split()
+                if len(fields) == 2:
+                    self._packed_refs[fields[1]] = fields[0]
+        return self._packed_refs
+
+    def read_ref(self, ref):
+        """Return the hash the ref points to or None if it doesn't exist"""
+        for depth in range(MAX_SYMREF_DEPTH):
+            value = read_file(self.path(ref))
+            if value is None:
+                return self.packed_refs().get(ref)
+            if not value.startswith('ref:'):
+                if not SHA_RE.match(value):
+                    raise Unsupported(ref)
+                return value
+            ref = value[4:].strip()
+        raise Unsupported(ref)
+
+    def read_remotes(self, config):
+        """Return the remote -v output joined into one line from the config entries"""
+        urls = {}
+        push_urls = {}
+        for section, subsection, key, value in config:
+            if section == 'remote' and key == 'url':
+                urls.setdefault(subsection, []).append(value)
+            elif section == 'remote' and key == 'pushurl':
+                push_urls.setdefault(subsection, []).append(value)
+
+        lines = []
+        for name in sorted(set(urls) | set(push_urls)):
+            if not name in urls:
+                raise Unsupported(name)
+            lines.append("{0}\t{1} (fetch)".format(name, urls[name][0]))
+            for url in push_urls.get(name, urls[name]):
+                lines.append("{0}\t{1} (push)".format(name, url))
+        return ' '.join(lines)
+
+    def read(self):
+        """Return the git info dictionary"""
+        if os.path.exists(self.path('commondir')) or os.path.exists(self.path('reftable')):
+            raise Unsupported(self.git_dir)
+        for name in ['remotes', 'branches']:
+            path = self.path(name)
+            if os.path.isdir(path) and os.listdir(path):
+                # remotes defined the old way
+                raise Unsupported(name)
+
+        config = []
+        for config_path in GLOBAL_CONFIGS + [self.path('config')]:
+            self.files.append((config_path, file_stamp(config_path)))
+            if os.path.isfile(config_path):
+                config += parse_config(config_path)
+        for section, subsection, key, value in config:
+            if section in ['include', 'includeif', 'url'] or (section == 'extensions' and key == 'refstorage'):
+                raise Unsupported(section)
+
+        head = read_file(self.path('HEAD'))
+        if head is None:
+            raise Unsupported("no HEAD")
+        if head.startswith('ref:'):
+            ref = head[4:].strip()
+            if not ref.startswith('refs/heads/'):
+                raise Unsupported(ref)
+            branch = ref[len('refs/heads/'):]
+
+            # git shortens the name differently if it could also mean another ref
+            for other in [branch, 'refs/' + branch, 'refs/tags/' + branch, 'refs/remotes/' + branch, 'refs/remotes/' + branch + '/HEAD']:
+                if self.read_ref(other) is not None:
+                    raise Unsupported(other)
+        else:
+            ref, branch = 'HEAD', 'HEAD'
+
+        head_hash = self.read_ref(ref)
+        if head_hash is None:
+            # no commits yet - let git give the error
+            raise Unsupported(ref)
+        return {'head': head_hash, 'branch': branch, 'remote': self.read_remotes(config)}
+
+# -----------------------------------------------------------------------------
+def read_git_info(repo_path):
+    """Return a dictionary of the 'head' hash, 'branch' (HEAD if detached) and 'remote' (the lines
+    of git remote -v joined by spaces) of the repository containing the given path. Results are
+    reused while none of the files they were read from change"""
+    try:
+        git_dir = find_git_dir(repo_path)
+    except Unsupported:
+        return read_git_info_with_git(repo_path)
+
+    with _cache_lock:
+        cached = _cache.get(git_dir)
+    if cached and all(file_stamp(path) == stamp for path, stamp in cached[0]):
+        return dict(cached[1])
+
+    reader = GitDirReader(git_dir)
+    try:
+        git_info = reader.read()
+    except (Unsupported, IOError, OSError, UnicodeDecodeError):
+        return read_git_info_with_git(repo_path)
+
+    with _cache_lock:
+        _cache[git_dir] = (reader.files, git_info)
+    return dict(git_info)
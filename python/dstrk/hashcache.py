@@ -0,0 +1,127 @@
+# Persistent cache of file hashes keyed on the file's stat info
+#
+# A file can have a hash for each algorithm the DB has used (see migrateDB --hash), so entries are
+# kept per path and algorithm, the algorithm being told by the length of the hash.
+
+# system imports
+import os
+from collections import OrderedDict
+import time
+
+# DT imports
+from dstrk.hashing import algorithm_of, DEFAULT_HASH
+
+# default maximum number of files to remember
+DEFAULT_MAX_ENTRIES = 100000
+
+# files modified this recently (in seconds) are not cached as they could be changed again
+# within the timestamp resolution of the filesystem without the mtime changing
+RACY_WINDOW = 2
+
+# -----------------------------------------------------------------------------
+def stat_key(st):
+    """Return the parts of the stat info that must be unchanged for a cached hash to be valid"""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+# -----------------------------------------------------------------------------
+# class to handle the hash cache. Entries are appended to a log file as they are added and the
+# log is compacted down to the most recent max_entries files once it gets too long
+class HashCache:
+    def __init__(self, cache_path, max_entries=DEFAULT_MAX_ENTRIES):
+        assert max_entries > 0
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.entries = None
+        self.log_lines = 0
+
+    def load(self):
+        """Read the cache log into memory. Later entries for a path and algorithm replace earlier ones"""
+        self.entries = OrderedDict()
+        self.log_lines = 0
+        if not os.path.exists(self.cache_path):
+            return
+
+        for ln in open(self.cache_path):
+            self.log_lines += 1
+            toks = ln.rstrip('\n').split(' ', 5)
+            if len(toks) != 6:
+                # partially written line - ignore it
+                continue
+            try:
+                key = (int(toks[1]), int(toks[2]), int(toks[3]), int(toks[4]))
+            except ValueError:
+                continue
+            entry_key = (toks[5], algorithm_of(toks[0]))
+            self.entries.pop(entry_key, None)
+            self.entries[entry_key] = (key, toks[0])
+
+    def lookup(self, fname, st=None, algorithm=DEFAULT_HASH):
+        """Return the cached hash of the given file with the given algorithm or an empty string
+        if the file has changed or isn't known"""
+        if self.entries is None:
+            self.load()
+
+        entry = self.entries.get((os.path.abspath(fname), algorithm))
+        if not entry:
+            return ''
+
+        if st is None:
+            st = os.stat(fname)
+        if entry[0] != stat_key(st):
+            return ''
+
+        return entry[1]
+
+    def cached_size(self, fname, file_hash):
+        """Return the size the given file had when it was last hashed to file_hash, or None if that
+        isn't known. The file doesn't have to exist any more"""
+        if self.entries is None:
+            self.load()
+
+        entry = self.entries.get((os.path.abspath(fname), algorithm_of(file_hash)))
+        if not entry or entry[1] != file_hash:
+            return None
+        return entry[0][2]
+
+    def store(self, fname, file_hash, st):
+        """Remember the hash of the given file. st must be the stat info taken *before* the file
+        was hashed so that changes made while hashing invalidate the entry"""
+        if self.entries is None:
+            self.load()
+
+        path = os.path.abspath(fname)
+        if '\n' in path or st.st_mtime > time.time() - RACY_WINDOW:
+            return
+
+        key = stat_key(st)
+        entry_key = (path, algorithm_of(file_hash))
+        if self.entries.get(entry_key) == (key, file_hash):
+            return
+        self.entries.pop(entry_key, None)
+        self.entries[entry_key] = (key, file_hash)
+
+        # a single small append so concurrent writers don't interleave lines
+        with open(self.cache_path, "a") as f:
+            f.write("{0} {1} {2} {3} {4} {5}\n".format(file_hash, key[0], key[1], key[2], key[3], path))
+        self.log_lines += 1
+
+        if self.log_lines > 2 * self.max_entries:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the log with only the most recently added max_entries file hashes"""
+        if self.entries is None:
+            self.load()
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        tmp_path = "{0}.{1}.tmp".format(self.cache_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            for (path, algorithm), (key, file_hash) in self.entries.items():
+                f.write("{0} {1} {2} {3} {4} {5}\n".format(file_hash, key[0], key[1], key[2], key[3], path))
+        os.rename(tmp_path, self.cache_path)
+        self.log_lines = len(self.entries)
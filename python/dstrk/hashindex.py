@@ -0,0 +1,287 @@
+# Sorted index of hashes for fast (abbreviated) hash lookups
+#
+# The index is a set of base files, one per digest size, each holding a short header and then
+# the sorted binary digests:
+#
+#   <name>-<digest size>     <magic> <digest size> <count> <digest> <digest> ...
+#
+# These are memory mapped and binary searched. Changes since the base files were written are
+# appended to a journal (<name>.log) as '+<hash>' or '-<hash>' lines and merged into the base
+# files once the journal gets long, so adding a hash doesn't mean rewriting the whole index.
+#
+# Other processes can be using the index at the same time so appending to the journal and merging
+# it are done under an exclusive lock on <name>.lock and loading the index under a shared one.
+# Long running processes (e.g. dstrk serve) see their changes as every lookup first stats the
+# index directory, journal and base files and reloads the index if any of them have changed.
+
+# system imports
+import binascii
+import heapq
+import mmap
+import os
+import struct
+
+# DT imports
+from dstrk.fsutil import ensure_dir, file_stamp, LockFile
+
+INDEX_MAGIC = b'DSTKHIX1'
+INDEX_HEADER = struct.Struct('>8sII')
+
+# number of journal entries before they are merged into the base files
+MERGE_THRESHOLD = 1000
+
+# -----------------------------------------------------------------------------
+# class to handle a single sorted base file
+class SortedHashFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest_size, self.count = INDEX_HEADER.unpack_from(self.map, 0)
+        assert magic == INDEX_MAGIC
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def digest(self, i):
+        start = INDEX_HEADER.size + i * self.digest_size
+        return self.map[start:start + self.digest_size]
+
+    def bisect(self, digest):
+        """Return the index of the first entry >= the given binary digest"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def with_prefix(self, prefix, limit=None):
+        """Return the hashes starting with the given hex prefix"""
+        low = binascii.unhexlify((prefix + '0' * (2 * self.digest_size))[:2 * self.digest_size])
+        hashes = []
+        for i in range(self.bisect(low), self.count):
+            obj_hash = binascii.hexlify(self.digest(i)).decode('ascii')
+            if not obj_hash.startswith(prefix) or (limit and len(hashes) >= limit):
+                break
+            hashes.append(obj_hash)
+        return hashes
+
+    def in_range(self, low, high):
+        """Yield the hashes from the first starting at or after the hex prefix low up to those
+        starting with high or later"""
+        start = binascii.unhexlify((low + '0' * (2 * self.digest_size))[:2 * self.digest_size])
+        for i in range(self.bisect(start), self.count):
+            obj_hash = binascii.hexlify(self.digest(i)).decode('ascii')
+            if obj_hash[:len(high)] >= high:
+                break
+            yield obj_hash
+
+    def __iter__(self):
+        for i in range(0, self.count):
+            yield binascii.hexlify(self.digest(i)).decode('ascii')
+
+# -----------------------------------------------------------------------------
+def write_sorted_hash_file(path, digest_size, hashes):
+    """Write a base file containing the given hashes, which must all be digest_size bytes long"""
+    digests = sorted(set(binascii.unhexlify(h) for h in hashes))
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, digest_size, len(digests)))
+        for digest in digests:
+            f.write(digest)
+    os.rename(tmp_path, path)
+
+# -----------------------------------------------------------------------------
+# class to handle a full index - the base files plus the journal
+class HashIndex:
+    def __init__(self, index_dir, name):
+        self.index_dir = index_dir
+        self.name = name
+        self.journal_path = os.path.join(index_dir, name + '.log')
+        self.lock_file = LockFile(os.path.join(index_dir, name + '.lock'))
+        self.bases = None
+        self.added = None
+        self.removed = None
+        self.journal_lines = 0
+        self.stamp = None
+
+    def exists(self):
+        """The journal is always present once the index has been built"""
+        return os.path.exists(self.journal_path)
+
+    def base_path(self, digest_size):
+        return os.path.join(self.index_dir, "{0}-{1}".format(self.name, digest_size))
+
+    def load(self):
+        """Map the base files and read the journal"""
+        with self.lock_file.lock(shared=True):
+            self.read_index()
+
+    def index_stamp(self):
+        """Return the state of the files the index was loaded from. Base files are replaced by
+        renaming, which also changes the directory"""
+        base_paths = sorted(base.path for base in self.bases.values()) if self.bases else []
+        return [file_stamp(path) for path in [self.index_dir, self.journal_path] + base_paths]
+
+    def is_stale(self):
+        """Whether the index has to be (re)loaded, e.g. as another process has changed it"""
+        return self.bases is None or self.index_stamp() != self.stamp
+
+    def refresh(self):
+        """Load the index if it isn't loaded or has changed since it was"""
+        if self.is_stale():
+            self.load()
+
+    def read_index(self):
+        """Load the index. The caller must hold the lock. The old base files aren't closed as
+        they may still be being iterated over"""
+        self.bases = {}
+        for fname in os.listdir(self.index_dir):
+            if fname.startswith(self.name + '-') and fname[len(self.name) + 1:].isdigit():
+                base = SortedHashFile(os.path.join(self.index_dir, fname))
+                self.bases[base.digest_size] = base
+
+        self.added = set()
+        self.removed = set()
+        self.journal_lines = 0
+        if os.path.exists(self.journal_path):
+            for ln in open(self.journal_path):
+                self.journal_lines += 1
+                obj_hash = ln[1:].strip()
+                if ln.startswith('+'):
+                    self.added.add(obj_hash)
+                    self.removed.discard(obj_hash)
+                elif ln.startswith('-'):
+                    self.removed.add(obj_hash)
+                    self.added.discard(obj_hash)
+        self.stamp = self.index_stamp()
+
+    def close(self):
+        if self.bases:
+            for base in self.bases.values():
+                base.close()
+        self.bases = None
+
+    def in_base(self, obj_hash):
+        base = self.bases.get(len(obj_hash) // 2)
+        return base is not None and base.with_prefix(obj_hash, limit=1) == [obj_hash]
+
+    def contains(self, obj_hash):
+        self.refresh()
+        if obj_hash in self.added:
+            return True
+        if obj_hash in self.removed:
+            return False
+        return self.in_base(obj_hash)
+
+    def with_prefix(self, prefix, limit=None):
+        """Return the sorted hashes starting with the given hex prefix. If limit is given, at most
+        that many are returned"""
+        self.refresh()
+
+        hashes = set(h for h in self.added if h.startswith(prefix))
+        for digest_size in sorted(self.bases):
+            if len(prefix) > 2 * digest_size:
+                continue
+            # ask for extra in case some have been removed
+            base_limit = limit + len(self.removed) if limit else None
+            hashes.update(h for h in self.bases[digest_size].with_prefix(prefix, base_limit) if not h in self.removed)
+
+        hashes = sorted(hashes)
+        if limit:
+            return hashes[:limit]
+        return hashes
+
+    def in_range(self, low, high):
+        """Yield the hashes between the hex prefixes low (inclusive) and high (exclusive) in order"""
+        self.refresh()
+
+        added = sorted(h for h in self.added if h[:len(low)] >= low and h[:len(high)] < high)
+        ranges = [base.in_range(low, high) for base in self.bases.values()]
+        last = None
+        for obj_hash in heapq.merge(added, *ranges):
+            # re-added hashes can be in both the journal and a base file
+            if obj_hash != last and not obj_hash in self.removed:
+                yield obj_hash
+            last = obj_hash
+
+    def __iter__(self):
+        self.refresh()
+        for base in self.bases.values():
+            for obj_hash in base:
+                if not obj_hash in self.removed and not obj_hash in self.added:
+                    yield obj_hash
+        for obj_hash in sorted(self.added):
+            yield obj_hash
+
+    def add(self, obj_hash):
+        """Add the hash, returning whether it wasn't already there"""
+        if self.contains(obj_hash):
+            return False
+        self.append_journal('+', obj_hash)
+        return True
+
+    def remove(self, obj_hash):
+        """Remove the hash, returning whether it was there"""
+        if not self.contains(obj_hash):
+            return False
+        self.append_journal('-', obj_hash)
+        return True
+
+    def append_journal(self, op, obj_hash):
+        with self.lock_file.lock():
+            if self.is_stale():
+                self.read_index()
+            with open(self.journal_path, "a") as f:
+                f.write(op + obj_hash + "\n")
+                # other processes append too so go by the size of the journal
+                journal_size = f.tell()
+            self.journal_lines += 1
+            if op == '+':
+                self.added.add(obj_hash)
+                self.removed.discard(obj_hash)
+            else:
+                self.removed.add(obj_hash)
+                self.added.discard(obj_hash)
+            self.stamp = self.index_stamp()
+
+            if journal_size >= MERGE_THRESHOLD * (len(obj_hash) + 2):
+                self.merge_journal()
+
+    def merge(self):
+        """Fold the journal into the base files"""
+        with self.lock_file.lock():
+            self.merge_journal()
+
+    def merge_journal(self):
+        """Fold the journal into the base files, including what other processes have added since
+        it was loaded. The caller must hold the lock"""
+        self.read_index()
+        self.write_base_files(list(self))
+
+    def rebuild(self, hashes):
+        """Replace the index contents with the given hashes"""
+        with self.lock_file.lock():
+            self.write_base_files(hashes)
+
+    def write_base_files(self, hashes):
+        """Replace the base files with the given hashes and empty the journal. The caller must
+        hold the lock"""
+        ensure_dir(self.index_dir)
+        self.close()
+
+        by_size = {20: []}
+        for obj_hash in hashes:
+            by_size.setdefault(len(obj_hash) // 2, []).append(obj_hash)
+        for fname in os.listdir(self.index_dir):
+            if fname.startswith(self.name + '-') and fname[len(self.name) + 1:].isdigit():
+                by_size.setdefault(int(fname[len(self.name) + 1:]), [])
+
+        for digest_size in by_size:
+            write_sorted_hash_file(self.base_path(digest_size), digest_size, by_size[digest_size])
+        open(self.journal_path, "w").close()
+        self.read_index()
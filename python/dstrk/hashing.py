@@ -0,0 +1,149 @@
+# Hashing functions shared by all DB operations
+#
+# A DB hashes its files and records with the algorithm chosen when it was created (see
+# DSDatabase.init_db). Every algorithm has a different digest size so the algorithm behind any
+# hash in the DB can be told from its length, which lets DBs that have switched algorithm keep
+# resolving their older objects.
+
+# system imports
+import hashlib
+import mmap
+import os
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# DT imports
+from dstrk.exceptions import UnknownHashAlgorithm
+
+# default number of bytes read from a file in one go
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# the original algorithm, used by any DB that doesn't say otherwise
+DEFAULT_HASH = 'sha1'
+
+# digest size in bytes of each algorithm - these must all be different
+DIGEST_SIZES = {'sha1': 20, 'sha256': 32, 'blake2b': 64, 'xxh128': 16}
+
+# constructors for the algorithms available here. xxh128 is not a cryptographic hash but is much
+# faster and needs the xxhash package
+HASH_ALGORITHMS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = hashlib.blake2b
+if xxhash is not None and hasattr(xxhash, 'xxh3_128'):
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
+# number of bytes read from each end of a file for its partial hash
+PARTIAL_HASH_BLOCK = 64 * 1024
+
+# files no bigger than this are read in full for their partial hash, so they don't get one
+PARTIAL_HASH_MIN_SIZE = 2 * PARTIAL_HASH_BLOCK
+
+# -----------------------------------------------------------------------------
+def new_hash(algorithm):
+    """Return a new hash object for the given algorithm"""
+    if not algorithm in HASH_ALGORITHMS:
+        raise UnknownHashAlgorithm("Hash algorithm {0} is not available (have {1})".format(algorithm, ', '.join(sorted(HASH_ALGORITHMS))))
+    return HASH_ALGORITHMS[algorithm]()
+
+def algorithm_of(obj_hash):
+    """Return the name of the algorithm that made the given hex digest or None if it's unknown"""
+    for algorithm, digest_size in DIGEST_SIZES.items():
+        if len(obj_hash) == 2 * digest_size:
+            return algorithm
+    return None
+
+# -----------------------------------------------------------------------------
+def hash_string(obj_str, algorithm=DEFAULT_HASH):
+    """Return the hex digest of the given string (e.g. a DB record)"""
+    if not isinstance(obj_str, bytes):
+        obj_str = obj_str.encode('utf-8')
+    obj_hash = new_hash(algorithm)
+    obj_hash.update(obj_str)
+    return obj_hash.hexdigest()
+
+# -----------------------------------------------------------------------------
+# class to limit the rate files are read at. Shared by all the hashing threads
+class RateLimiter(object):
+    def __init__(self, bytes_per_sec):
+        assert bytes_per_sec > 0
+        self.bytes_per_sec = bytes_per_sec
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        """Wait until reading nbytes more keeps us within the rate"""
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + nbytes / float(self.bytes_per_sec)
+        if start > now:
+            time.sleep(start - now)
+
+# -----------------------------------------------------------------------------
+def hash_file(fname, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False, limiter=None, algorithm=DEFAULT_HASH):
+    """Return the hex digest of the given file. Only buffer_size bytes are held in memory
+    at any one time so this is safe to use on files of any size. If a RateLimiter is given,
+    reads are throttled by it"""
+    file_hash = new_hash(algorithm)
+
+    with open(fname, "rb") as f:
+        if use_mmap:
+            # map the file and feed the hash from the mapping without copying
+            if os.fstat(f.fileno()).st_size:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    view = memoryview(mapped)
+                    for offset in range(0, len(view), buffer_size):
+                        if limiter:
+                            limiter.consume(min(buffer_size, len(view) - offset))
+                        file_hash.update(view[offset:offset + buffer_size])
+                    view.release()
+                finally:
+                    mapped.close()
+        else:
+            # read into the same buffer each time to keep memory use flat
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            nbytes = f.readinto(buf)
+            while nbytes:
+                if limiter:
+                    limiter.consume(nbytes)
+                file_hash.update(view[:nbytes])
+                nbytes = f.readinto(buf)
+
+    return file_hash.hexdigest()
+
+# -----------------------------------------------------------------------------
+def partial_hash(fname, block_size=PARTIAL_HASH_BLOCK):
+    """Return the hex digest of just the first and last block_size bytes of the given file. Much
+    cheaper than hash_file for big files and enough to rule out most files of the same size"""
+    file_hash = hashlib.sha1()
+    with open(fname, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        file_hash.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(size - block_size, block_size))
+            file_hash.update(f.read(block_size))
+    return file_hash.hexdigest()
+
+# -----------------------------------------------------------------------------
+def hash_files(fnames, buffer_size=DEFAULT_BUFFER_SIZE, use_mmap=False, jobs=1, limiter=None, algorithm=DEFAULT_HASH):
+    """Return the hex digests of the given files in the same order as given. If jobs > 1
+    the files are hashed on a pool of that many threads (hashlib releases the GIL while
+    hashing so this scales across cores)"""
+    if jobs <= 1 or len(fnames) <= 1:
+        return [hash_file(f, buffer_size=buffer_size, use_mmap=use_mmap, limiter=limiter, algorithm=algorithm) for f in fnames]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(fnames)))
+    try:
+        return pool.map(lambda f: hash_file(f, buffer_size=buffer_size, use_mmap=use_mmap, limiter=limiter, algorithm=algorithm),
+                        fnames, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
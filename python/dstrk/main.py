@@ -10,18 +10,50 @@ import sys
 
 # --------------------------------------------------------------------
 # run the main program
-def main(arglist):
-    """Process the given arg list and run the appropriate functions"""
+def main(arglist, use_server=True, db_cache=None):
+    """Process the given arg list and run the appropriate functions. If a 'dstrk serve' is
+    running for the DB, the command is passed to it unless use_server is False. DSDatabase
+    objects are reused from db_cache if given"""
     
     # parse the arguments
     parser = argparse.ArgumentParser(description='Track your datasets and files, what created them, when and from what')
     parser.add_argument('--dbpath', help='Set the DB path to something other than ~/.dstrk')
+    parser.add_argument('--buffersize', type=int, default=0,
+                        help='Number of bytes to read at a time when hashing files (default 1MB)')
+    parser.add_argument('--nocache', action='store_true', help='Always rehash files rather than using the stat-based hash cache')
+    parser.add_argument('--timings', action='store_true',
+                        help='Report the time, files hashed and objects read/written for each phase to stderr')
+    parser.add_argument('--timings-json', metavar='FILE', help='Write the --timings report to the given JSON file instead')
+    parser.add_argument('--profile', action='store_true', help='Run under cProfile and print the top functions to stderr')
+    parser.add_argument('--profile-out', metavar='FILE', help='Run under cProfile and save the stats to the given file instead')
+    parser.add_argument('--noserver', action='store_true', help="Don't pass the command to a running 'dstrk serve'")
 
     # add subparser for initDB
-    subparsers = parser.add_subparsers(help='Specific command help')
+    subparsers = parser.add_subparsers(dest='command', help='Specific command help')
+    subparsers.required = True
     parser_initdb = subparsers.add_parser('initDB', help='Initialise the DatasetTracker database. Defaults to ~/.dstrk')
+    parser_initdb.add_argument('--engine', default='loose', choices=['loose', 'sqlite'],
+                               help='Storage engine for the DB: loose files (default) or a single indexed SQLite file')
+    parser_initdb.add_argument('--hash', default='sha1', choices=hashChoices(),
+                               help='Algorithm to hash files and records with (default sha1)')
+    parser_initdb.add_argument('--manifest', default='text', choices=manifestChoices(),
+                               help='How to store the file lists of datasets: text (default) or compact binary, optionally compressed')
     parser_initdb.set_defaults(func=initDB)
+
+    # add subparser for migrateDB
+    parser_migratedb = subparsers.add_parser('migrateDB', help='Convert the DB to use a different storage engine, hash algorithm or manifest encoding')
+    parser_migratedb.add_argument('--engine', choices=['loose', 'sqlite'], help='Storage engine to convert to')
+    parser_migratedb.add_argument('--hash', choices=hashChoices(),
+                                  help='Hash new files and records with this algorithm. Existing records keep their hashes')
+    parser_migratedb.add_argument('--manifest', choices=manifestChoices(),
+                                  help='Rewrite the file lists of all datasets with this encoding. Dataset hashes are unchanged')
+    parser_migratedb.set_defaults(func=migrateDB)
     
+    # add subparser for gc
+    parser_gc = subparsers.add_parser('gc', help='Compact the DB by folding loose records into pack files')
+    parser_gc.add_argument('--full', action='store_true', help='Repack everything into a single pack and drop deleted records')
+    parser_gc.set_defaults(func=gc)
+
     # add subparser for addDS
     parser_addds = subparsers.add_parser('addDS', help='Create and add a Dataset from a filelist')
     parser_addds.add_argument('filelist', nargs="+", help='Globbed list of local files to add to the DS')
@@ -29,6 +61,8 @@ def main(arglist):
     parser_addds.add_argument('--tags', default=[], action='append', help='Tag information to add to the entry for this DS')
     parser_addds.add_argument('--gitinfo', default=[], action='append',
                               help='Fill tags from the given git repo(s). Will run: git rev-parse HEAD, git rev-parse --abbrev-ref HEAD, git remote -v')
+    parser_addds.add_argument('--jobs', type=int, default=1, help='Number of files to hash in parallel (default 1)')
+    addWalkOptions(parser_addds)
     parser_addds.set_defaults(func=addDS)
 
     # add subparser for DSinfo
@@ -39,12 +73,31 @@ def main(arglist):
     # add subparser for DSinfo
     parser_tree = subparsers.add_parser('tree', help='show the hierachy of the given dataset')
     parser_tree.add_argument('file_or_hash', help='dataset file or hash to use to lookup the DS info')
+    parser_tree.add_argument('--max-depth', type=int, default=None, help='only show this many generations of parents')
     parser_tree.set_defaults(func=tree)
 
+    # add subparser for descendants
+    parser_descendants = subparsers.add_parser('descendants', help='show all the datasets derived from the given dataset')
+    parser_descendants.add_argument('file_or_hash', help='dataset file or hash to use to lookup the DS info')
+    parser_descendants.add_argument('--max-depth', type=int, default=None, help='only show this many generations of children')
+    parser_descendants.set_defaults(func=descendants)
+
+    # add subparser for find
+    parser_find = subparsers.add_parser('find', help='List the datasets with the given tags, parents and creation times')
+    parser_find.add_argument('--tag', default=[], action='append', help='Only datasets with this exact tag (can be given more than once)')
+    parser_find.add_argument('--since', type=findTime, help='Only datasets created at or after this ISO time or age (e.g. 7d, 12h, 30m)')
+    parser_find.add_argument('--until', type=findTime, help='Only datasets created before this ISO time or age')
+    parser_find.add_argument('--has-parent', default=[], action='append',
+                             help='Only datasets derived from this dataset file or hash (can be given more than once)')
+    parser_find.add_argument('--long', '-l', action='store_true', help='Also show the creation time and tags of each dataset')
+    parser_find.set_defaults(func=find)
+
     # add subparser for addfiles
     parser_addfiles = subparsers.add_parser('addfiles', help='Add the given files to an existing dataset')
     parser_addfiles.add_argument('filelist', nargs="+", help='Globbed list of local files to add to the DS')
     parser_addfiles.add_argument('--dataset', help='dataset file or hash to add files to', required=True)
+    parser_addfiles.add_argument('--jobs', type=int, default=1, help='Number of files to hash in parallel (default 1)')
+    addWalkOptions(parser_addfiles)
     parser_addfiles.set_defaults(func=addfiles)
 
     # add subparser for delDS
@@ -55,27 +108,308 @@ def main(arglist):
     # add subparser for delfiles
     parser_delds = subparsers.add_parser('delfiles', help='Remove the given files')
     parser_delds.add_argument('filelist', nargs="+", help='Globbed list of local files to remove from DB')
+    parser_delds.add_argument('--jobs', type=int, default=1, help='Number of files to hash in parallel (default 1)')
+    addWalkOptions(parser_delds)
     parser_delds.set_defaults(func=delfiles)
     
+    # add subparser for verify
+    parser_verify = subparsers.add_parser('verify', help='Check that the files of a dataset are still present and unmodified')
+    parser_verify.add_argument('file_or_hash', nargs='?', help='dataset file or hash to check')
+    parser_verify.add_argument('--all', action='store_true', help='Check every dataset in the DB')
+    parser_verify.add_argument('--full', action='store_true', help='Rehash every file rather than trusting unchanged stat info')
+    parser_verify.add_argument('--max-rate', type=float, default=0, help='Maximum MB per second to read')
+    parser_verify.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser_verify.add_argument('--jobs', type=int, default=1, help='Number of files to hash in parallel (default 1)')
+    parser_verify.set_defaults(func=verify)
+
+    # add subparser for locate
+    parser_locate = subparsers.add_parser('locate', help='Search directories for dataset files that have moved')
+    parser_locate.add_argument('file_or_hash', help='dataset file or hash')
+    parser_locate.add_argument('--search', nargs='+', required=True, help='directories (or globs) to search under')
+    parser_locate.add_argument('--rewrite', action='store_true', help='Update the dataset with the new paths')
+    parser_locate.add_argument('--include', default=[], action='append',
+                               help='Only consider files whose name or path matches this pattern (can be given more than once)')
+    parser_locate.add_argument('--exclude', default=[], action='append',
+                               help="Skip files and directories whose name or path matches this pattern (can be given more than once)")
+    parser_locate.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser_locate.add_argument('--jobs', type=int, default=1, help='Number of files to hash in parallel (default 1)')
+    parser_locate.set_defaults(func=locate)
+
+    # add subparser for batch
+    parser_batch = subparsers.add_parser('batch', help='Run a stream of JSON line commands (addDS, addfiles, DSinfo, delDS, delfiles) in one go')
+    parser_batch.add_argument('input', nargs='?', default='-', help='file of commands, one JSON object per line (default: stdin)')
+    parser_batch.add_argument('--output', help='file to write the JSON line results to (default: stdout)')
+    parser_batch.add_argument('--group-size', type=int, default=100, help='number of commands whose writes are grouped together')
+    parser_batch.add_argument('--jobs', type=int, default=1, help='number of threads to hash files with')
+    parser_batch.set_defaults(func=batch)
+
+    # add subparser for export
+    parser_export = subparsers.add_parser('export', help='Write the records of the DB, or of some datasets and everything derived from them, to a stream')
+    parser_export.add_argument('output', nargs='?', default='-', help='file to write the export to (default: stdout)')
+    parser_export.add_argument('--format', default='jsonl', choices=['jsonl', 'binary'], help='JSON lines (default) or compact binary records')
+    parser_export.add_argument('--compress', default='none', choices=exportCompression(), help='compress the export (default: none)')
+    parser_export.add_argument('--dataset', default=[], action='append',
+                               help='only export this dataset (file or hash) and its descendants (can be given more than once)')
+    parser_export.add_argument('--ancestors', action='store_true', help='also export the datasets the given ones were derived from')
+    parser_export.set_defaults(func=export)
+
+    # add subparser for import
+    parser_import = subparsers.add_parser('import', help='Add the records of an export to the DB')
+    parser_import.add_argument('input', nargs='?', default='-', help='export file, in any format or compression (default: stdin)')
+    parser_import.add_argument('--group-size', type=int, default=10000, help='number of records written together')
+    parser_import.set_defaults(func=importDB)
+
+    # add subparser for serve
+    parser_serve = subparsers.add_parser('serve', help='Keep the DB loaded and run commands sent to it by other dstrk calls until interrupted')
+    parser_serve.set_defaults(func=serve)
+
     args = parser.parse_args(arglist)
-    args.func(args)
+    if args.command == 'verify' and args.all == bool(args.file_or_hash):
+        parser_verify.error("give either a dataset or --all")
+    if args.command == 'migrateDB' and not args.engine and not args.hash and not args.manifest:
+        parser_migratedb.error("give at least one of --engine, --hash and --manifest")
+    args.db_cache = db_cache
+
+    # hand over to the server if there's one running
+    if use_server and not args.noserver and not args.command in ['serve', 'initDB', 'batch', 'export', 'import']:
+        from dstrk.server import forward
+        if forward(dbPath(args), arglist):
+            return
+
+    # set up the instrumentation if asked for
+    from dstrk.timings import Recorder, Timings
+    args.recorder = Recorder()
+    if args.timings or args.timings_json:
+        timings = Timings()
+        args.recorder.add_hook(timings)
+
+    profiler = None
+    if args.profile or args.profile_out:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with args.recorder.phase(args.command):
+            args.func(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            if args.profile_out:
+                profiler.dump_stats(args.profile_out)
+            else:
+                import pstats
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
+        if args.timings_json:
+            timings.write_json(args.timings_json)
+        elif args.timings:
+            timings.write_text(sys.stderr)
 
 # --------------------------------------------------------------------
-def createDBObject(args):
-    """Create the database object"""
+def dbPath(args):
+    """Return the path of the DB to use"""
     ds_base_path = "~/.dstrk"
     if args.dbpath:
         ds_base_path = args.dbpath
-    
+    return os.path.abspath(os.path.expanduser(ds_base_path))
+
+# --------------------------------------------------------------------
+def hashChoices():
+    """Return the hash algorithms available here"""
+    from dstrk.hashing import HASH_ALGORITHMS
+    return sorted(HASH_ALGORITHMS)
+
+# --------------------------------------------------------------------
+def manifestChoices():
+    """Return the dataset manifest encodings available here"""
+    from dstrk.records import MANIFEST_ENCODINGS
+    return MANIFEST_ENCODINGS
+
+# --------------------------------------------------------------------
+def exportCompression():
+    """Return the compression available for exports"""
+    from dstrk.transfer import EXPORT_COMPRESSION
+    return EXPORT_COMPRESSION
+
+# --------------------------------------------------------------------
+def findTime(time_str):
+    """Return the datetime for an ISO time or an age relative to now in days, hours or minutes"""
+    from datetime import datetime, timedelta
+    from dstrk.records import parse_iso_time
+    units = {'d':'days', 'h':'hours', 'm':'minutes'}
+    try:
+        if time_str[-1:] in units:
+            return datetime.now() - timedelta(**{units[time_str[-1]]: float(time_str[:-1])})
+        return parse_iso_time(time_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not an ISO time or age: {0}".format(time_str))
+
+# --------------------------------------------------------------------
+def addWalkOptions(parser):
+    """Add the options controlling how the file list is expanded"""
+    parser.add_argument('--recursive', '-r', action='store_true', help='Add everything under any directories in the file list')
+    parser.add_argument('--include', default=[], action='append',
+                        help='Only use files whose name or path matches this pattern (can be given more than once)')
+    parser.add_argument('--exclude', default=[], action='append',
+                        help="Skip files and directories whose name or path matches this pattern (can be given more than once)")
+
+# --------------------------------------------------------------------
+def createDBObject(args):
+    """Create the database object"""
     from dstrk.database import DSDatabase
-    return DSDatabase(os.path.expanduser(ds_base_path))
+    from dstrk.hashing import DEFAULT_BUFFER_SIZE
+    db_args = (dbPath(args), args.buffersize or DEFAULT_BUFFER_SIZE, max(getattr(args, 'jobs', 1), 1), not args.nocache)
+    db_cache = getattr(args, 'db_cache', None)
+    if db_cache is not None and db_args in db_cache:
+        ds = db_cache[db_args]
+        ds.recorder = args.recorder
+        # pick up any changes made to the DB config without going through the server
+        ds.refresh()
+        return ds
+
+    ds = DSDatabase(db_args[0], buffer_size=db_args[1], jobs=db_args[2], use_hash_cache=db_args[3],
+                    recorder=getattr(args, 'recorder', None))
+    if db_cache is not None and args.command != 'initDB':
+        db_cache[db_args] = ds
+    return ds
 
     
+# --------------------------------------------------------------------
+def verify(args):
+    """Check datasets against the files on disk"""
+    ds = createDBObject(args)
+    ds_list = ds.iter_ds_hashes() if args.all else [args.file_or_hash]
+
+    results = []
+    problems = 0
+    for ds_id in ds_list:
+        result = ds.verify_ds(ds_id, use_cache=not args.full, max_rate=args.max_rate * 1e6)
+        problems += len(result['modified']) + len(result['missing'])
+        if args.json:
+            results.append(result)
+            continue
+
+        print("{0}  OK: {1}  Modified: {2}  Missing: {3}".format(result['ds_hash'], len(result['ok']),
+                                                                  len(result['modified']), len(result['missing'])))
+        for status in ['modified', 'missing']:
+            for f in result[status]:
+                print("    {0}: {1}".format(status.upper(), f))
+
+    if args.json:
+        import json
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if problems:
+        sys.exit(1)
+
+# --------------------------------------------------------------------
+def locate(args):
+    """Find the moved files of a dataset"""
+    ds = createDBObject(args)
+    result = ds.locate_ds(args.file_or_hash, args.search, rewrite=args.rewrite, include=args.include, exclude=args.exclude)
+
+    if args.json:
+        import json
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print("{0}  Found: {1}  Missing: {2}".format(result['ds_hash'], len(result['found']), len(result['missing'])))
+        for f in sorted(result['found']):
+            print("    {0} -> {1}".format(f, result['found'][f]))
+        for f in result['missing']:
+            print("    {0}: {1}".format("UNKNOWN SIZE" if f in result['unknown_size'] else "MISSING", f))
+
+    if result['missing']:
+        sys.exit(1)
+
+# --------------------------------------------------------------------
+def batch(args):
+    """Run a stream of commands against the DB"""
+    from dstrk.batch import run_batch
+    ds = createDBObject(args)
+    in_file = sys.stdin if args.input == '-' else open(args.input)
+    out_file = open(args.output, "w") if args.output else sys.stdout
+
+    # keep the results on stdout clean of any warnings
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        failures = run_batch(ds, in_file, out_file, group_size=max(args.group_size, 1))
+    finally:
+        sys.stdout = stdout
+        if in_file is not sys.stdin:
+            in_file.close()
+        if out_file is not sys.stdout:
+            out_file.close()
+
+    if failures:
+        sys.exit(1)
+
+# --------------------------------------------------------------------
+def export(args):
+    """Export the records of the DB"""
+    from dstrk.transfer import open_export, export_db
+    ds = createDBObject(args)
+    stdout = sys.stdout
+    out_file = getattr(stdout, 'buffer', stdout) if args.output == '-' else open(args.output, "wb")
+
+    # keep the export on stdout clean of any warnings
+    sys.stdout = sys.stderr
+    try:
+        export_file = open_export(out_file, args.compress)
+        export_db(ds, export_file, fmt=args.format, datasets=args.dataset, ancestors=args.ancestors)
+        if export_file is not out_file:
+            export_file.close()
+    finally:
+        sys.stdout = stdout
+        if args.output == '-':
+            out_file.flush()
+        else:
+            out_file.close()
+
+# --------------------------------------------------------------------
+def importDB(args):
+    """Import the records of an export into the DB"""
+    from dstrk.transfer import open_import, import_db
+    ds = createDBObject(args)
+    in_file = getattr(sys.stdin, 'buffer', sys.stdin) if args.input == '-' else open(args.input, "rb")
+    try:
+        counts = import_db(ds, open_import(in_file), group_size=max(args.group_size, 1))
+    finally:
+        if args.input != '-':
+            in_file.close()
+
+    print("Imported {0} records: {1} written, {2} merged, {3} already present".format(sum(counts.values()), counts['written'],
+                                                                                      counts['merged'], counts['skipped']))
+
+# --------------------------------------------------------------------
+def serve(args):
+    """Serve commands for the DB until interrupted"""
+    from dstrk.server import DSServer
+    ds = createDBObject(args)
+    ds.check_db()
+    server = DSServer(ds.db_base_path)
+    print("Serving {0} on {1}".format(ds.db_base_path, server.server_address))
+    sys.stdout.flush()
+    server.serve()
+
 # --------------------------------------------------------------------
 def initDB(args):
     """Initialise the Database"""
     ds = createDBObject(args)
-    ds.init_db()
+    ds.init_db(engine=args.engine, hash_algorithm=args.hash, manifest=args.manifest)
+
+# --------------------------------------------------------------------
+def migrateDB(args):
+    """Convert the Database to a different storage engine, hash algorithm or manifest encoding"""
+    ds = createDBObject(args)
+    ds.migrate_db(engine=args.engine, hash_algorithm=args.hash, manifest=args.manifest)
+
+# --------------------------------------------------------------------
+def gc(args):
+    """Compact the Database"""
+    ds = createDBObject(args)
+    ds.gc(full=args.full)
 
 # --------------------------------------------------------------------
 def addDS(args):
@@ -84,50 +418,104 @@ def addDS(args):
     gitrepos = []
     for repo in args.gitinfo:
         gitrepos.append(os.path.abspath(os.path.expanduser(repo)))
-    ds.add_ds(args.filelist, parents=args.parentDS, tags=args.tags, gitinfo=gitrepos)
+    ds.add_ds(args.filelist, parents=args.parentDS, tags=args.tags, gitinfo=gitrepos,
+              recursive=args.recursive, include=args.include, exclude=args.exclude)
 
 # --------------------------------------------------------------------
 def DSinfo(args):
     """get dataset info given file or hash"""
     ds = createDBObject(args)
-    ds_info = ds.get_ds_info(args.file_or_hash)
+    ds_info, manifest = ds.get_ds_record(args.file_or_hash)
     print("Datset Created:  {0}\n\nParents:  {1}\n\nDataset:  {2}\n\nTags:".format(ds_info['creation'], ' '.join(ds_info['parents']), ds_info['ds_hash']))
     for t in ds_info['tags']:
         print("{0}".format(t))
     print("\nFile List:")
-    for f in ds_info['file_paths']:
+
+    # the file list is printed as it's read so huge datasets don't have to fit in memory
+    for f, fhash in manifest:
         print("{0}".format(f))
     
 # --------------------------------------------------------------------
 def tree(args):
     """get tree info given file or hash"""
     ds = createDBObject(args)
-    ds_tree = ds.get_ds_tree(args.file_or_hash)
-    
-    def print_leaf(ds_dict):
-        max_depth = 0
-        for ds in ds_dict['parents']:
-            max_depth_temp = print_leaf(ds)
+    ds_tree = ds.get_ds_tree(args.file_or_hash, max_depth=args.max_depth)
+
+    # parents are printed above their children, indented by the depth of the deepest parent.
+    # Shared ancestors are only printed in full the first time they're seen
+    printed = set()
+    to_print = [[ds_tree, 0, 0]]
+    parent_depth = None
+    while to_print:
+        frame = to_print[-1]
+        ds_dict, next_parent, max_depth = frame
+        if parent_depth is not None:
             print("     " * (max_depth+1) + "|")
-            if max_depth_temp > max_depth:
-                max_depth = max_depth_temp
+            frame[2] = max_depth = max(max_depth, parent_depth)
+            parent_depth = None
+
+        str_to_print = ds_dict['ds_hash'] + "  {0}".format(ds_dict['tags'])
+        if next_parent == 0 and ds_dict['ds_hash'] in printed:
+            print(str_to_print + "  (see above)")
+            to_print.pop()
+            parent_depth = 0
+            continue
 
-        
+        if next_parent < len(ds_dict['parents']):
+            frame[1] += 1
+            to_print.append([ds_dict['parents'][next_parent], 0, 0])
+            continue
+
+        if ds_dict['truncated']:
+            str_to_print += "  ..."
         if len(ds_dict['parents']):
             max_depth += 1
-            str_to_print = "     " * max_depth + "+--> " + ds_dict['ds_hash'] + "  {0}".format(ds_dict['tags'])
-        else:
-            str_to_print = ds_dict['ds_hash'] + "  {0}".format(ds_dict['tags'])
+            str_to_print = "     " * max_depth + "+--> " + str_to_print
         print(str_to_print)
-        return max_depth
+        printed.add(ds_dict['ds_hash'])
+        to_print.pop()
+        parent_depth = max_depth
+
+# --------------------------------------------------------------------
+def descendants(args):
+    """get the derived datasets given file or hash"""
+    ds = createDBObject(args)
+    ds_tree = ds.get_ds_descendants(args.file_or_hash, max_depth=args.max_depth)
+
+    # datasets with more than one parent are only expanded the first time they're seen
+    printed = set()
+    to_print = [(ds_tree, 0)]
+    while to_print:
+        ds_dict, depth = to_print.pop()
+        str_to_print = ds_dict['ds_hash'] + "  {0}".format(ds_dict['tags'])
+        if depth:
+            str_to_print = "     " * (depth - 1) + "+--> " + str_to_print
+        if ds_dict['ds_hash'] in printed:
+            print(str_to_print + "  (see above)")
+            continue
+        if ds_dict['truncated']:
+            str_to_print += "  ..."
+        print(str_to_print)
+        printed.add(ds_dict['ds_hash'])
+        for child in reversed(ds_dict['children']):
+            to_print.append((child, depth + 1))
+
+# --------------------------------------------------------------------
+def find(args):
+    """list the datasets matching the given tags, parents and times"""
+    ds = createDBObject(args)
+    for ds_hash in ds.find_ds(tags=args.tag, since=args.since, until=args.until, parents=args.has_parent):
+        if args.long:
+            header = ds.read_ds_header(ds_hash)
+            print("{0}  {1}  {2}".format(ds_hash, header.get('creation', ''), header['tags']))
+        else:
+            print(ds_hash)
 
-    print_leaf(ds_tree)
-    
 # --------------------------------------------------------------------
 def addfiles(args):
     """Add files to an existing dataset"""
     ds = createDBObject(args)
-    ds.add_files(args.filelist, dataset=args.dataset)
+    ds.add_files(args.filelist, dataset=args.dataset, recursive=args.recursive, include=args.include, exclude=args.exclude)
 
 # --------------------------------------------------------------------
 def delDS(args):
@@ -139,5 +527,5 @@ def delDS(args):
 def delfiles(args):
     """Delete the files from the DB"""
     ds = createDBObject(args)
-    ds.del_files(args.filelist)
+    ds.del_files(args.filelist, recursive=args.recursive, include=args.include, exclude=args.exclude)
     
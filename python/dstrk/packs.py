@@ -0,0 +1,206 @@
+# Pack files for the loose object store
+#
+# 'dstrk gc' folds loose objects into pack files in <db>/packs. Each pack is a pair of files:
+#
+#   pack-<id>.pack   the object data, one object after another
+#   pack-<id>.idx    a header followed by fixed size entries sorted on the binary digest:
+#                      <digest> <offset (8 bytes)> <length (4 bytes)>
+#
+# The index is memory mapped and binary searched so looking up an object in a pack costs
+# O(log n) without reading the index into memory. Packs are never modified once written -
+# newer versions of an object live in loose files or newer packs and deleted objects are
+# marked with an empty loose file until the next full gc.
+#
+# A pack is written an object at a time by a PackWriter to a temporary file, so it can be built
+# up over a long run of writes (e.g. an import). Its objects can be read back by the writing
+# process straight away but only become visible to others once the pack is finished.
+
+# system imports
+import binascii
+import mmap
+import os
+import struct
+import time
+
+# DT imports
+from dstrk.fsutil import ensure_dir
+
+PACK_MAGIC = b'DSTKPACK'
+IDX_MAGIC = b'DSTKIDX1'
+IDX_HEADER = struct.Struct('>8sII')
+IDX_ENTRY = struct.Struct('>QI')
+
+# -----------------------------------------------------------------------------
+# class to handle a single read-only pack
+class Pack:
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+        self.name = os.path.basename(idx_path)[:-len('.idx')]
+
+        self.idx_file = open(idx_path, "rb")
+        self.idx = mmap.mmap(self.idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.digest_size, self.count = IDX_HEADER.unpack_from(self.idx, 0)
+        assert magic == IDX_MAGIC
+        self.entry_size = self.digest_size + IDX_ENTRY.size
+        self.pack_file = None
+
+    def close(self):
+        self.idx.close()
+        self.idx_file.close()
+        if self.pack_file:
+            self.pack_file.close()
+
+    def digest(self, i):
+        """Return the binary digest of the i'th entry"""
+        start = IDX_HEADER.size + i * self.entry_size
+        return self.idx[start:start + self.digest_size]
+
+    def bisect(self, digest):
+        """Return the index of the first entry >= the given binary digest"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, obj_hash):
+        """Return the (offset, length) of the given object or None if it isn't in this pack"""
+        if len(obj_hash) != 2 * self.digest_size:
+            return None
+        digest = binascii.unhexlify(obj_hash)
+        i = self.bisect(digest)
+        if i == self.count or self.digest(i) != digest:
+            return None
+        return IDX_ENTRY.unpack_from(self.idx, IDX_HEADER.size + i * self.entry_size + self.digest_size)
+
+    def has_object(self, obj_hash):
+        return self.find(obj_hash) is not None
+
+    def read_object(self, obj_hash):
+        entry = self.find(obj_hash)
+        if entry is None:
+            return None
+        if self.pack_file is None:
+            self.pack_file = open(self.pack_path, "rb")
+        self.pack_file.seek(entry[0])
+        return self.pack_file.read(entry[1])
+
+    def iter_objects(self):
+        for i in range(0, self.count):
+            yield binascii.hexlify(self.digest(i)).decode('ascii')
+
+# -----------------------------------------------------------------------------
+def load_packs(pack_dir):
+    """Return all the packs in the given directory, newest first"""
+    if not os.path.exists(pack_dir):
+        return []
+    return [Pack(os.path.join(pack_dir, f)) for f in sorted(os.listdir(pack_dir), reverse=True)
+            if f.startswith('pack-') and f.endswith('.idx')]
+
+# -----------------------------------------------------------------------------
+# class to write a new pack an object at a time
+class PackWriter:
+    def __init__(self, pack_dir):
+        ensure_dir(pack_dir)
+
+        # ids sort in creation order so newer packs are searched first
+        pack_time = int(time.time() * 1e6)
+        while True:
+            pack_id = "{0:016x}{1:08x}".format(pack_time, os.getpid())
+            self.pack_path = os.path.join(pack_dir, "pack-{0}.pack".format(pack_id))
+            self.idx_path = os.path.join(pack_dir, "pack-{0}.idx".format(pack_id))
+            if not os.path.exists(self.pack_path + ".tmp") and not os.path.exists(self.idx_path):
+                break
+            pack_time += 1
+
+        self.file = open(self.pack_path + ".tmp", "w+b")
+        self.file.write(PACK_MAGIC)
+        self.size = len(PACK_MAGIC)
+        self.digest_size = None
+        self.entries = {}
+        self.replaced = []
+
+    def add(self, obj_hash, data):
+        """Write the object to the end of the pack, replacing any earlier copy"""
+        digest = binascii.unhexlify(obj_hash)
+        assert self.digest_size in [None, len(digest)], "all objects in a pack must use the same hash"
+        self.digest_size = len(digest)
+        self.file.seek(self.size)
+        self.file.write(data)
+        if digest in self.entries:
+            self.replaced.append((digest, self.entries[digest], self.size))
+        self.entries[digest] = (self.size, len(data))
+        self.size += len(data)
+
+    def truncate(self, size):
+        """Drop the objects added since the pack was the given size"""
+        size = max(size, len(PACK_MAGIC))
+        if size >= self.size:
+            return
+        for digest in [d for d, (offset, length) in self.entries.items() if offset >= size]:
+            del self.entries[digest]
+        while self.replaced and self.replaced[-1][2] >= size:
+            digest, entry, offset = self.replaced.pop()
+            if entry[0] < size:
+                self.entries[digest] = entry
+        self.file.truncate(size)
+        self.size = size
+
+    def has_object(self, obj_hash):
+        return self.digest_size is not None and len(obj_hash) == 2 * self.digest_size and binascii.unhexlify(obj_hash) in self.entries
+
+    def read_object(self, obj_hash):
+        if not self.has_object(obj_hash):
+            return None
+        offset, length = self.entries[binascii.unhexlify(obj_hash)]
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def iter_objects(self):
+        for digest in sorted(self.entries):
+            yield binascii.hexlify(digest).decode('ascii')
+
+    def finish(self):
+        """Write the index and move the pack into place, returning the path of its index or an
+        empty string if there was nothing to pack"""
+        if not self.entries:
+            self.abort()
+            return ''
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+        with open(self.idx_path + ".tmp", "wb") as f:
+            f.write(IDX_HEADER.pack(IDX_MAGIC, self.digest_size, len(self.entries)))
+            for digest in sorted(self.entries):
+                f.write(digest + IDX_ENTRY.pack(*self.entries[digest]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        # the index is what makes the pack visible so move it into place last
+        os.rename(self.pack_path + ".tmp", self.pack_path)
+        os.rename(self.idx_path + ".tmp", self.idx_path)
+        return self.idx_path
+
+    def abort(self):
+        """Throw the unfinished pack away"""
+        self.file.close()
+        os.remove(self.pack_path + ".tmp")
+
+# -----------------------------------------------------------------------------
+def write_pack(pack_dir, objects):
+    """Write a new pack from the given iterable of (hash, data) and return the path of its index.
+    Returns an empty string if there was nothing to pack"""
+    writer = PackWriter(pack_dir)
+    try:
+        for obj_hash, data in objects:
+            writer.add(obj_hash, data)
+    except:
+        writer.abort()
+        raise
+    return writer.finish()
@@ -0,0 +1,68 @@
+# In-memory cache of parsed DB records for a DSDatabase session
+#
+# Inside DSDatabase.session() the parsed file records, dataset records and headers and the
+# answers to "is this a dataset?" are kept in an LRU cache keyed on (kind, hash), including
+# records that don't exist. DSDatabase drops the entries for a hash whenever it writes, updates or
+# deletes that object, so a session always sees its own changes. It assumes no other process
+# changes the records it has read while it runs - use a new session to see their changes.
+
+# system imports
+from collections import OrderedDict
+
+# default maximum number of records to remember
+DEFAULT_CACHE_SIZE = 10000
+
+# datasets with more files than this aren't cached as they'd crowd out everything else
+DEFAULT_MAX_DS_FILES = 10000
+
+# the kinds of entries kept for each object
+CACHE_KINDS = ['file', 'ds', 'header', 'has_ds']
+
+# returned by lookup when there's no entry (None is a valid cached value)
+MISSING = object()
+
+# -----------------------------------------------------------------------------
+def copy_record(value):
+    """Return a copy of a cached value that can be changed without changing the cache"""
+    if not isinstance(value, dict):
+        return value
+    return dict((key, list(v) if isinstance(v, list) else v) for key, v in value.items())
+
+# -----------------------------------------------------------------------------
+# class to hold the most recently used max_entries records, counting the hits and misses
+class RecordCache:
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, max_ds_files=DEFAULT_MAX_DS_FILES):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.max_ds_files = max_ds_files
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return the cached value for the key or MISSING"""
+        value = self.entries.pop(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+            return MISSING
+
+        self.entries[key] = value
+        self.hits += 1
+        return copy_record(value)
+
+    def store(self, key, value):
+        """Cache the value for the key, forgetting the least recently used entries if full"""
+        if isinstance(value, dict) and len(value.get('file_paths', [])) > self.max_ds_files:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = copy_record(value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, obj_hash):
+        """Forget everything cached about the object"""
+        for kind in CACHE_KINDS:
+            self.entries.pop((kind, obj_hash), None)
+
+    def clear(self):
+        self.entries.clear()
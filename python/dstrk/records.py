@@ -0,0 +1,438 @@
+# Formatting and parsing of the records stored in the DB
+#
+# A file record is the space separated list of datasets the file belongs to (latest first)
+# followed by the path the file was added from and, for files added since sizes were recorded,
+# the file size and partial hash (see hashing.partial_hash) used to find the file if it moves:
+#
+#   <ds_hash> <ds_hash> ...
+#   <path>
+#   <size> <partial_hash>
+#
+# A dataset record is a header followed by the file list:
+#
+#   Creation:  <iso time>
+#
+#   Parents:  <ds_hash> ...
+#
+#   Tags:
+#    - <tag>
+#
+#   <path>  <file_hash>
+#   ...
+#
+# For large datasets the file list can instead be stored in binary (the 'manifest' DB setting),
+# which is named by a "Manifest:  <encoding>" line after the parents. The files are front coded -
+# each is stored as the number of leading bytes its path shares with the previous (sorted) path,
+# the rest of the path and the raw digest, all lengths being varints:
+#
+#   <varint shared> <varint suffix length> <suffix> <varint digest length> <digest>
+#
+# and for the 'zlib' and 'lzma' encodings the whole file list is then compressed. The file list is
+# always in path order so it can be read in order as it's streamed. Files added to an existing
+# dataset that sort after all its files are appended to the end of its file list in the same
+# encoding (continuing the front coding from its last path and as another compressed stream) so
+# the existing entries don't have to be rewritten - otherwise the whole record is rewritten.
+# Whatever the encoding, a dataset's hash is always that of its record in the text format as
+# first written, so converting a DB between encodings or adding files doesn't change any
+# identities.
+
+# system imports
+from datetime import datetime
+import binascii
+import io
+import itertools
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# dstrk imports
+from dstrk.exceptions import UnknownManifestEncoding
+
+# the encodings for the file list of dataset records - lzma needs python 3
+TEXT_MANIFEST = 'text'
+MANIFEST_COMPRESSORS = {'packed': None, 'zlib': zlib.compressobj}
+MANIFEST_DECOMPRESSORS = {'packed': None, 'zlib': zlib.decompressobj}
+if lzma is not None:
+    MANIFEST_COMPRESSORS['lzma'] = lzma.LZMACompressor
+    MANIFEST_DECOMPRESSORS['lzma'] = lzma.LZMADecompressor
+MANIFEST_ENCODINGS = [TEXT_MANIFEST] + sorted(MANIFEST_COMPRESSORS)
+
+# number of files packed together before compressing and bytes read at a time when unpacking
+MANIFEST_PACK_FILES = 4096
+MANIFEST_READ_SIZE = 65536
+
+# formats accepted for ISO times, e.g. the dataset creation times
+ISO_TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+# -----------------------------------------------------------------------------
+def parse_iso_time(time_str):
+    """Return the datetime for an ISO time with or without the seconds, fraction or time part
+    (a space can also separate the date and time)"""
+    time_str = time_str.strip().replace(' ', 'T')
+    for fmt in ISO_TIME_FORMATS:
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Not an ISO time: {0}".format(time_str))
+
+# -----------------------------------------------------------------------------
+def format_file_record(ds_list, path, size=None, partial=''):
+    """Return the record string for a file"""
+    file_str = "{0}\n{1}\n".format(" ".join(ds_list), path)
+    if size is not None:
+        file_str += "{0} {1}\n".format(size, partial)
+    return file_str
+
+# -----------------------------------------------------------------------------
+def parse_file_record(file_str, file_hash):
+    """Return the file info dictionary from a file record string"""
+    file_info_lines = file_str.splitlines()
+    file_info = {'ds':[], 'path':file_info_lines[1].strip(), 'hash':file_hash, 'size':None, 'partial':''}
+    for ds in file_info_lines[0].split():
+        file_info['ds'].append(ds.strip())
+    if len(file_info_lines) > 2 and file_info_lines[2].strip():
+        toks = file_info_lines[2].split()
+        file_info['size'] = int(toks[0])
+        file_info['partial'] = toks[1] if len(toks) > 1 else ''
+    return file_info
+
+# -----------------------------------------------------------------------------
+def add_file_dataset(file_str, file_hash, ds_hash, path, size=None, partial=''):
+    """Return the file record with the dataset added at the front, creating the record if
+    file_str is None. The size and partial hash are only used if the record doesn't have them"""
+    if file_str is None:
+        return format_file_record([ds_hash], path, size, partial)
+
+    file_info = parse_file_record(file_str, file_hash)
+    if ds_hash in file_info['ds']:
+        return file_str
+    if file_info['size'] is not None:
+        size, partial = file_info['size'], file_info['partial']
+    return format_file_record([ds_hash] + file_info['ds'], path, size, partial)
+
+def remove_file_dataset(file_str, file_hash, ds_hash):
+    """Return the file record without the dataset or None if it's in no other datasets"""
+    if file_str is None:
+        return None
+
+    file_info = parse_file_record(file_str, file_hash)
+    if not ds_hash in file_info['ds']:
+        return file_str
+    ds_list = [ds for ds in file_info['ds'] if ds != ds_hash]
+    if not ds_list:
+        return None
+    return format_file_record(ds_list, file_info['path'], file_info['size'], file_info['partial'])
+
+def move_file_record(file_str, file_hash, old_paths, new_path):
+    """Return the file record with its path changed to new_path if it's still one of old_paths"""
+    if file_str is None:
+        return None
+
+    file_info = parse_file_record(file_str, file_hash)
+    if not file_info['path'] in old_paths:
+        return file_str
+    return format_file_record(file_info['ds'], new_path, file_info['size'], file_info['partial'])
+
+def merge_file_record(file_str, file_hash, other_str):
+    """Return the file record with the datasets of the other record for the same file added after
+    its own. The path, size and partial hash are kept unless the record doesn't have them"""
+    if file_str is None:
+        return other_str
+
+    file_info = parse_file_record(file_str, file_hash)
+    other_info = parse_file_record(other_str, file_hash)
+    ds_list = file_info['ds'] + [ds for ds in other_info['ds'] if not ds in file_info['ds']]
+    if file_info['size'] is None:
+        file_info['size'], file_info['partial'] = other_info['size'], other_info['partial']
+    return format_file_record(ds_list, file_info['path'], file_info['size'], file_info['partial'])
+
+# -----------------------------------------------------------------------------
+def is_ds_record(file_str):
+    """Return true if the given record string is a dataset record"""
+    if isinstance(file_str, bytes):
+        return file_str.startswith(b"Creation")
+    return file_str.startswith("Creation")
+
+# -----------------------------------------------------------------------------
+def format_ds_header(ds_info, manifest=TEXT_MANIFEST):
+    """Return the header of the record string for a dataset whose file list has the given encoding"""
+    ds_file_str = ""
+
+    # add creation time
+    ds_file_str += "Creation:  " + ds_info['creation'] + "\n\n"
+
+    # add parents
+    ds_file_str += "Parents:  " + ' '.join(ds_info['parents']) + "\n\n"
+
+    # say how the file list is stored if it isn't text
+    if manifest != TEXT_MANIFEST:
+        ds_file_str += "Manifest:  " + manifest + "\n\n"
+
+    # add tags
+    ds_file_str += "Tags:  \n"
+    for tag in ds_info['tags']:
+        ds_file_str += ' - ' + tag + "\n"
+
+    ds_file_str += "\n"
+    return ds_file_str
+
+def format_ds_manifest_line(path, file_hash):
+    """Return the line for a file in the text file list of a dataset"""
+    return path + "  " + file_hash + "\n"
+
+def format_ds_record(ds_info):
+    """Return the record string for a dataset"""
+    return format_ds_header(ds_info) + ''.join(format_ds_manifest_line(path, fhash)
+                                               for path, fhash in zip(ds_info['file_paths'], ds_info['file_hashes']))
+
+# -----------------------------------------------------------------------------
+# the lengths are nearly always below 128, i.e. a single byte
+SMALL_VARINTS = [bytes(bytearray([n])) for n in range(0x80)]
+
+def encode_varint(n):
+    """Return the bytes of an unsigned LEB128 varint"""
+    if n < 0x80:
+        return SMALL_VARINTS[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def decode_varint(buf, pos):
+    """Return the varint at pos in the bytearray and the position after it, or None, pos if the
+    buffer ends first"""
+    if pos < len(buf) and buf[pos] < 0x80:
+        return buf[pos], pos + 1
+    n = shift = 0
+    i = pos
+    while i < len(buf):
+        n |= (buf[i] & 0x7f) << shift
+        i += 1
+        if not buf[i - 1] & 0x80:
+            return n, i
+        shift += 7
+    return None, pos
+
+def common_prefix_length(a, b):
+    """Return the number of leading bytes a and b share, found by bisection so the comparisons
+    are done in C"""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def pack_manifest(file_paths, file_hashes, prev_path=b''):
+    """Yield the binary file list entry of each file (see the top of the file), front coding the
+    first against prev_path"""
+    for path, fhash in zip(file_paths, file_hashes):
+        path = path.encode('utf-8')
+        digest = binascii.unhexlify(fhash)
+        shared = common_prefix_length(prev_path, path)
+        yield encode_varint(shared) + encode_varint(len(path) - shared) + path[shared:] + encode_varint(len(digest)) + digest
+        prev_path = path
+
+def decompress_blocks(blocks, manifest):
+    """Yield the decompressed blocks of a binary file list with the given encoding, which may be
+    made of several compressed streams one after the other"""
+    make_decompressor = MANIFEST_DECOMPRESSORS[manifest]
+    if make_decompressor is None:
+        for block in blocks:
+            yield block
+        return
+
+    decompressor = make_decompressor()
+    for block in blocks:
+        while block:
+            yield decompressor.decompress(block)
+            if not decompressor.eof:
+                break
+            block = decompressor.unused_data
+            decompressor = make_decompressor()
+
+def unpack_manifest(blocks, manifest):
+    """Yield the (path, hash) of each file from the blocks of bytes of a binary file list with the
+    given encoding. Only the entries of the current block are held in memory"""
+    buf = bytearray()
+    prev_path = b''
+    for block in decompress_blocks(blocks, manifest):
+        buf += block
+        pos = 0
+        while True:
+            shared, i = decode_varint(buf, pos)
+            length, i = decode_varint(buf, i) if shared is not None else (None, i)
+            if length is None or i + length > len(buf):
+                break
+            path = prev_path[:shared] + bytes(buf[i:i + length])
+            digest_length, i = decode_varint(buf, i + length)
+            if digest_length is None or i + digest_length > len(buf):
+                break
+
+            yield path.decode('utf-8'), binascii.hexlify(bytes(buf[i:i + digest_length])).decode('ascii')
+            prev_path = path
+            pos = i + digest_length
+        del buf[:pos]
+
+    if buf:
+        raise ValueError("Dataset file list is truncated")
+
+# -----------------------------------------------------------------------------
+def parse_ds_header(ds_lines, ds_hash):
+    """Return the dataset info dictionary without the file list. Only reads the lines up to the
+    end of the tags so if ds_lines is an iterator it is left at the start of the file list"""
+    ds_info = {'ds_hash': ds_hash, 'parents': [], 'tags': []}
+    in_tags = False
+    for ln in ds_lines:
+        if ln.startswith("Creation"):
+            ds_info['creation'] = ' '.join(ln.split()[1:]).strip()
+        elif ln.startswith("Parents"):
+            ds_info['parents'] = ln.split()[1:]
+        elif ln.startswith("Manifest"):
+            ds_info['manifest'] = ln.split()[1]
+        elif ln.startswith("Tags"):
+            in_tags = True
+        elif ln.startswith(" - "):
+            ds_info['tags'].append(ln[3:].strip())
+        elif in_tags and not ln.strip():
+            break
+
+    return ds_info
+
+# -----------------------------------------------------------------------------
+def parse_ds_manifest(ds_lines):
+    """Yield the (path, hash) of each file from the lines of a dataset record after the header
+    (see parse_ds_header)"""
+    for ln in ds_lines:
+        if len(ln) > 4:
+            fields = ln.split()
+            yield fields[0], fields[1]
+
+# -----------------------------------------------------------------------------
+def parse_ds_record(ds_lines, ds_hash):
+    """Return the dataset info dictionary from the lines of a dataset record"""
+    ds_lines = iter(ds_lines)
+    ds_info = parse_ds_header(ds_lines, ds_hash)
+    ds_info['file_paths'] = []
+    ds_info['file_hashes'] = []
+    for path, fhash in parse_ds_manifest(ds_lines):
+        ds_info['file_paths'].append(path)
+        ds_info['file_hashes'].append(fhash)
+
+    return ds_info
+
+# -----------------------------------------------------------------------------
+def encode_ds_record(ds_info, manifest=TEXT_MANIFEST):
+    """Return the record bytes for a dataset with the file list stored in the given encoding"""
+    if manifest == TEXT_MANIFEST:
+        return format_ds_record(ds_info).encode('utf-8')
+    if not manifest in MANIFEST_COMPRESSORS:
+        raise UnknownManifestEncoding("Manifest encoding {0} is not available (have {1})".format(manifest, ', '.join(MANIFEST_ENCODINGS)))
+
+    return format_ds_header(ds_info, manifest).encode('utf-8') + encode_manifest(ds_info['file_paths'], ds_info['file_hashes'], manifest)
+
+def encode_manifest(file_paths, file_hashes, manifest, prev_path=''):
+    """Return the bytes of the file list entries in the given encoding. For the binary encodings
+    the first path is front coded against prev_path, the last path already in the list"""
+    if manifest == TEXT_MANIFEST:
+        return ''.join(format_ds_manifest_line(path, fhash) for path, fhash in zip(file_paths, file_hashes)).encode('utf-8')
+
+    compressor = MANIFEST_COMPRESSORS[manifest]
+    compressor = compressor() if compressor else None
+    pieces = []
+    entries = pack_manifest(file_paths, file_hashes, prev_path.encode('utf-8'))
+    while True:
+        block = b''.join(itertools.islice(entries, MANIFEST_PACK_FILES))
+        if not block:
+            break
+        pieces.append(compressor.compress(block) if compressor else block)
+    if compressor:
+        pieces.append(compressor.flush())
+    return b''.join(pieces)
+
+def append_ds_files(data, ds_hash, file_paths, file_hashes):
+    """Return the dataset record bytes with the given files appended in the record's own encoding.
+    The existing entries are only scanned, not rewritten, and files already in the dataset are
+    skipped. Returns None if any of the paths is in the dataset with a different hash or would sort
+    before its last file, as the record then has to be rewritten (see merge_ds_record) to keep the
+    file list in path order"""
+    manifest = parse_ds_header((ln.decode('utf-8') for ln in io.BytesIO(data)), ds_hash).get('manifest', TEXT_MANIFEST)
+    new_files = dict(zip(file_paths, file_hashes))
+    prev_path = ''
+    for path, fhash in open_ds_record(io.BytesIO(data), ds_hash)[1]:
+        if path in new_files:
+            if new_files[path] != fhash:
+                return None
+            del new_files[path]
+        prev_path = path
+
+    if not new_files:
+        return data
+    new_paths = sorted(new_files)
+    if new_paths[0] < prev_path:
+        return None
+    return data + encode_manifest(new_paths, [new_files[f] for f in new_paths], manifest, prev_path)
+
+def open_ds_record(f, ds_hash):
+    """Return the header of the dataset record in the binary file object and an iterator over the
+    (path, hash) of its files that reads the rest of the file as it goes"""
+    ds_lines = (ln.decode('utf-8') for ln in f)
+    ds_info = parse_ds_header(ds_lines, ds_hash)
+    manifest = ds_info.pop('manifest', TEXT_MANIFEST)
+    if manifest == TEXT_MANIFEST:
+        return ds_info, parse_ds_manifest(ds_lines)
+    if not manifest in MANIFEST_DECOMPRESSORS:
+        raise UnknownManifestEncoding("Manifest encoding {0} is not available (have {1})".format(manifest, ', '.join(MANIFEST_ENCODINGS)))
+    return ds_info, unpack_manifest(iter(lambda: f.read(MANIFEST_READ_SIZE), b''), manifest)
+
+def decode_ds_record(data, ds_hash):
+    """Return the dataset info dictionary from the record bytes in any encoding"""
+    ds_info, manifest = open_ds_record(io.BytesIO(data), ds_hash)
+    ds_info['file_paths'] = []
+    ds_info['file_hashes'] = []
+    for path, fhash in manifest:
+        ds_info['file_paths'].append(path)
+        ds_info['file_hashes'].append(fhash)
+    return ds_info
+
+# -----------------------------------------------------------------------------
+def merge_ds_record(current, ds_info):
+    """Return the dataset info, keeping any files in the current dataset info (or None) that it
+    doesn't have"""
+    if current is not None:
+        file_hash = dict(zip(current['file_paths'], current['file_hashes']))
+        file_hash.update(zip(ds_info['file_paths'], ds_info['file_hashes']))
+        ds_info = dict(ds_info, file_paths=sorted(file_hash))
+        ds_info['file_hashes'] = [file_hash[f] for f in ds_info['file_paths']]
+    return ds_info
+
+def move_ds_files(ds_info, moved):
+    """Return the dataset info with the files given by (path, hash) in the moved dictionary at
+    their new paths, keeping the file list in path order, or None if ds_info is None"""
+    if ds_info is None:
+        return None
+
+    entries = sorted((moved.get((f, fhash), f), fhash) for f, fhash in zip(ds_info['file_paths'], ds_info['file_hashes']))
+    ds_info['file_paths'] = [f for f, fhash in entries]
+    ds_info['file_hashes'] = [fhash for f, fhash in entries]
+    return ds_info
+
+def remove_ds_files(ds_info, file_hashes):
+    """Return the dataset info without the given files or None if there are none left"""
+    if ds_info is None:
+        return None
+
+    keep = [i for i, fhash in enumerate(ds_info['file_hashes']) if not fhash in file_hashes]
+    if not keep:
+        return None
+    ds_info['file_paths'] = [ds_info['file_paths'][i] for i in keep]
+    ds_info['file_hashes'] = [ds_info['file_hashes'][i] for i in keep]
+    return ds_info
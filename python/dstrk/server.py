@@ -0,0 +1,192 @@
+# Long running server so repeated dstrk commands don't pay for starting up
+#
+# 'dstrk serve' listens on a Unix domain socket in the DB directory (<db>/serve.sock) and keeps
+# its DSDatabase objects - and so their indexes, packs and hash cache - in memory between
+# commands. While it's running, dstrk.main forwards every command for that DB to it.
+#
+# Each request and response is a single line of JSON:
+#
+#   {"argv": [...], "cwd": <client working dir>}
+#   {"stdout": <text>, "stderr": <text>, "exit": <exit code or null>, "error": [<type>, <message>] or null}
+#
+# Connections are handled on their own threads but the commands themselves run one at a time, as
+# they share the cached DB objects and the process' working directory and stdout. Changes made
+# to the DB without going through the server (--noserver, batch, import or other hosts) are seen
+# as the indexes, packs and config are reloaded whenever their files change.
+#
+# A command can write files anywhere its user can, so the socket is only accessible to the user
+# running the server and, where the OS says who is connecting (SO_PEERCRED on Linux), connections
+# from any other user are refused.
+
+# system imports
+import errno
+import io
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import threading
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+# name of the socket in the DB directory
+SOCKET_NAME = 'serve.sock'
+
+# -----------------------------------------------------------------------------
+def socket_path(db_base_path):
+    """Return the path of the server socket for the given DB"""
+    return os.path.join(db_base_path, SOCKET_NAME)
+
+def peer_uid(sock):
+    """Return the user id of the process at the other end of the Unix socket, or None if the OS
+    doesn't tell us"""
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+# -----------------------------------------------------------------------------
+def send_message(sock_file, msg):
+    sock_file.write((json.dumps(msg) + "\n").encode('utf-8'))
+    sock_file.flush()
+
+def read_message(sock_file):
+    ln = sock_file.readline()
+    if not ln:
+        return None
+    return json.loads(ln.decode('utf-8'))
+
+# -----------------------------------------------------------------------------
+def connect(db_base_path):
+    """Return a socket connected to the server for the given DB or None if it isn't running"""
+    path = socket_path(db_base_path)
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in [errno.ECONNREFUSED, errno.ENOENT]:
+            # left behind by a server that didn't shut down cleanly
+            return None
+        raise
+    return sock
+
+# -----------------------------------------------------------------------------
+def forward(db_base_path, arglist):
+    """Run the given command on the server for the DB, writing its output to stdout/stderr and
+    raising any exception it raised. Returns False if there is no server running"""
+    sock = connect(db_base_path)
+    if sock is None:
+        return False
+
+    try:
+        sock_file = sock.makefile('rwb')
+        send_message(sock_file, {'argv':arglist, 'cwd':os.getcwd()})
+        response = read_message(sock_file)
+        sock_file.close()
+    finally:
+        sock.close()
+
+    if response is None:
+        raise RuntimeError("dstrk server closed the connection")
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    if response['error']:
+        import dstrk.exceptions
+        exc_type, msg = response['error']
+        exc_class = getattr(dstrk.exceptions, exc_type, None)
+        if isinstance(exc_class, type) and issubclass(exc_class, Exception):
+            raise exc_class(*([msg] if msg else []))
+        raise RuntimeError("{0}: {1}".format(exc_type, msg))
+    if response['exit'] is not None:
+        sys.exit(response['exit'])
+
+    return True
+
+# -----------------------------------------------------------------------------
+# request handler - runs one command per connection
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = read_message(self.rfile)
+        if request is None:
+            return
+        send_message(self.wfile, self.server.run(request['argv'], request['cwd']))
+
+# -----------------------------------------------------------------------------
+# class to serve commands for a single DB
+class DSServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, db_base_path):
+        self.db_base_path = db_base_path
+        path = socket_path(db_base_path)
+        if os.path.exists(path):
+            sock = connect(db_base_path)
+            if sock is not None:
+                sock.close()
+                raise RuntimeError("dstrk server already running on " + path)
+            os.remove(path)
+
+        self.uid = os.getuid()
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.db_cache = {}
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        """Create the socket so only our user can connect to it"""
+        old_umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.server_address, stat.S_IRUSR | stat.S_IWUSR)
+
+    def verify_request(self, request, client_address):
+        """Only take commands from our own user"""
+        uid = peer_uid(request)
+        return uid is None or uid == self.uid
+
+    def run(self, argv, cwd):
+        """Run the given command and return the response"""
+        import dstrk.main
+        response = {'stdout':'', 'stderr':'', 'exit':None, 'error':None}
+        with self.lock:
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+            try:
+                os.chdir(cwd)
+                dstrk.main.main(argv, use_server=False, db_cache=self.db_cache)
+            except SystemExit as e:
+                response['exit'] = e.code
+            except Exception as e:
+                response['error'] = [type(e).__name__, str(e)]
+                if not type(e).__module__.startswith('dstrk'):
+                    traceback.print_exc()
+            finally:
+                response['stdout'] = sys.stdout.getvalue()
+                response['stderr'] = sys.stderr.getvalue()
+                sys.stdout, sys.stderr = stdout, stderr
+
+        return response
+
+    def serve(self):
+        """Serve until interrupted or terminated, removing the socket afterwards"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
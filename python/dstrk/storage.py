@@ -0,0 +1,866 @@
+# Storage engines for the DB objects
+#
+# Every record in the DB is an object keyed on its hash. An engine stores and retrieves the
+# raw bytes of these objects and can answer index queries about them. All engines provide:
+#
+#   init_storage()              create the storage area
+#   destroy()                   remove the storage area and everything in it
+#   transaction(commit)         context manager grouping a set of writes together. Can be nested
+#                               and an error rolls back the writes of the innermost one. With
+#                               commit a nested one makes its writes when it ends, all or nothing
+#   has_object(obj_hash)        is there an object with this hash?
+#   has_dataset(obj_hash)       is there a dataset with this hash?
+#   read_object(obj_hash)       the object bytes or None if not present
+#   open_object(obj_hash)       a binary file object to read the object from or None if not present
+#   write_object(obj_hash, data)
+#   write_new_objects(objects)  write an iterable of (hash, data) for objects not in the DB yet
+#                               in one go, e.g. when importing
+#   bulk_writes()               context manager for a long run of write_new_objects calls
+#   update_object(obj_hash, update)
+#                               replace the object with update(current bytes or None), deleting
+#                               it if that's None. Safe against other processes updating it too
+#   delete_object(obj_hash)
+#   iter_objects()              iterate over the hashes of all objects
+#   iter_datasets()             iterate over the hashes of all datasets
+#   hashes_with_prefix(prefix, limit)
+#                               sorted dataset hashes starting with the given prefix
+#   get_children(ds_hash)       the hashes of the datasets that list ds_hash as a parent
+#   find_datasets(tags, since, until, parents)
+#                               iterate over the hashes of the datasets with all the tags and
+#                               parents, created in [since, until) (ISO times, either optional)
+#   gc(full)                    compact the storage
+
+# system imports
+from contextlib import contextmanager
+from datetime import datetime
+import errno
+import hashlib
+import io
+import os
+import shutil
+
+# DT imports
+from dstrk.records import is_ds_record, parse_file_record, format_file_record, parse_ds_header, parse_iso_time
+from dstrk.fsutil import atomic_write, file_stamp, LockFile
+from dstrk.packs import load_packs, write_pack, PackWriter
+from dstrk.hashindex import HashIndex
+from dstrk.hashing import algorithm_of
+
+# the pack written by bulk_writes is finished and another started once it's this big
+PACK_ROLLOVER_SIZE = 256 * 1024 * 1024
+PACK_ROLLOVER_OBJECTS = 1000000
+
+# the characters of a hex digest - int(s, 16) also takes '0x', '_', signs and spaces
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+# -----------------------------------------------------------------------------
+def is_hex(hash_str):
+    """Return true if the given string is a (partial) lower case hex digest"""
+    return bool(hash_str) and all(c in HEX_DIGITS for c in hash_str)
+
+def is_full_hash(hash_str):
+    """Return true if the given string is a complete hex digest of one of the known algorithms"""
+    return is_hex(hash_str) and algorithm_of(hash_str) is not None
+
+def list_dir(path):
+    """Return the entries of the directory, or none if it has been removed"""
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return []
+
+def remove_empty_dir(path):
+    """Remove the directory if it's empty, ignoring it if it has gone or has just been used"""
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        if not e.errno in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+# -----------------------------------------------------------------------------
+def record_header(data):
+    """Return the header of the given dataset record bytes or None if it isn't a dataset"""
+    if not data or not is_ds_record(data):
+        return None
+    return parse_ds_header((ln.decode('utf-8') for ln in io.BytesIO(data)), '')
+
+def record_parents(data):
+    """Return the parents listed in the given dataset record bytes"""
+    header = record_header(data)
+    return header['parents'] if header else []
+
+# -----------------------------------------------------------------------------
+def tag_key(tag):
+    """Return the fixed length hex key of a tag in the tag index"""
+    return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+def time_key(iso_time):
+    """Return a 16 digit hex key for the ISO time that sorts in time order (the microseconds since
+    1970) or an empty string if it isn't a valid time"""
+    try:
+        delta = parse_iso_time(iso_time) - datetime(1970, 1, 1)
+    except ValueError:
+        return ''
+    return "{0:016x}".format(max((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds, 0))
+
+# -----------------------------------------------------------------------------
+# The original layout - each object is a file at <db>/xx/yy/<hash>. 'dstrk gc' can fold these
+# into pack files (see packs.py). Loose objects always take precedence over packed ones and an
+# empty loose object marks a packed object as deleted. The dataset hashes are kept in a sorted
+# index (see hashindex.py) for prefix lookups and the parent -> child links are kept in another
+# with each entry being <parent hash><child hash>. Similarly, the tag index has entries of
+# <tag_key(tag)><ds hash> and the creation index <time_key(creation)><ds hash> so datasets can be
+# found by tag or creation time without reading them. Objects are replaced atomically and updates are
+# made under a lock on the object (a byte of <db>/objects.lock) so concurrent writers are safe
+class LooseStorage:
+    name = 'loose'
+
+    def __init__(self, db_base_path):
+        self.db_base_path = db_base_path
+        self.pack_dir = os.path.join(db_base_path, 'packs')
+        self.index_dir = os.path.join(db_base_path, 'index')
+        self._packs = None
+        self._packs_stamp = None
+        self._ds_index = HashIndex(self.index_dir, 'ds-hashes')
+        self._children_index = HashIndex(self.index_dir, 'ds-children')
+        self._tags_index = HashIndex(self.index_dir, 'ds-tags')
+        self._creation_index = HashIndex(self.index_dir, 'ds-creation')
+        self.object_locks = LockFile(os.path.join(db_base_path, 'objects.lock'))
+        self.pending = None
+        self.pending_log = None
+        self.index_log = None
+        self.pack_writers = None
+        self.bulk_depth = 0
+
+    @property
+    def packs(self):
+        """The packs in the DB, newest first. They're reloaded if another process has added or
+        removed any (the old ones aren't closed as they may still be being iterated over)"""
+        stamp = file_stamp(self.pack_dir)
+        if self._packs is None or stamp != self._packs_stamp:
+            self._packs = load_packs(self.pack_dir)
+            self._packs_stamp = stamp
+        return self._packs
+
+    def close_packs(self):
+        for pack in self.packs:
+            pack.close()
+        self._packs = None
+
+    def search_packs(self):
+        """The packs to look for objects in - those being written by bulk_writes and then the
+        finished ones"""
+        if self.pack_writers:
+            return list(self.pack_writers.values()) + self.packs
+        return self.packs
+
+    @property
+    def ds_index(self):
+        """The sorted index of dataset hashes. DBs from before the index existed have it built
+        from the objects on first use"""
+        if not self._ds_index.exists():
+            self.rebuild_indexes()
+        return self._ds_index
+
+    @property
+    def children_index(self):
+        """The sorted index of parent -> child links"""
+        if not self._children_index.exists():
+            self.rebuild_indexes()
+        return self._children_index
+
+    @property
+    def tags_index(self):
+        """The sorted index of tag -> dataset"""
+        if not self._tags_index.exists():
+            self.rebuild_indexes()
+        return self._tags_index
+
+    @property
+    def creation_index(self):
+        """The sorted index of creation time -> dataset"""
+        if not self._creation_index.exists():
+            self.rebuild_indexes()
+        return self._creation_index
+
+    def all_indexes(self):
+        return [self._ds_index, self._children_index, self._tags_index, self._creation_index]
+
+    def rebuild_indexes(self):
+        """Rebuild the indexes by reading every object"""
+        ds_hashes = []
+        links = []
+        tags = []
+        creation = []
+        for obj_hash in self.iter_objects():
+            header = record_header(self.read_object(obj_hash))
+            if header:
+                ds_hashes.append(obj_hash)
+                links += [(parent, obj_hash) for parent in header['parents']]
+                tags += [tag_key(tag) + obj_hash for tag in header['tags']]
+                if time_key(header.get('creation', '')):
+                    creation.append(time_key(header['creation']) + obj_hash)
+        self._ds_index.rebuild(ds_hashes)
+        self._tags_index.rebuild(tags)
+        self._creation_index.rebuild(creation)
+
+        # older records can have abbreviated parents
+        children = []
+        for parent, child in links:
+            full_parent = self._ds_index.with_prefix(parent, limit=2) if is_hex(parent) else []
+            if len(full_parent) == 1:
+                children.append(full_parent[0] + child)
+        self._children_index.rebuild(children)
+
+    def objects_to_pack(self, obj_hashes, packed):
+        """Iterate over the (hash, data) of the objects that still exist, adding their hashes to packed"""
+        for obj_hash in obj_hashes:
+            data = self.read_object(obj_hash)
+            if data:
+                packed.add(obj_hash)
+                yield obj_hash, data
+
+    def init_storage(self):
+        """Create the (empty) indexes - object directories are created as objects are written"""
+        self.rebuild_indexes()
+
+    def destroy(self):
+        """Remove all the loose object directories, packs and indexes"""
+        self.close_packs()
+        self.object_locks.close()
+        for index in self.all_indexes():
+            index.close()
+            index.lock_file.close()
+        if os.path.exists(self.object_locks.path):
+            os.remove(self.object_locks.path)
+        for obj_dir in os.listdir(self.db_base_path):
+            if len(obj_dir) == 2 and is_hex(obj_dir):
+                shutil.rmtree(os.path.join(self.db_base_path, obj_dir))
+        for data_dir in [self.pack_dir, self.index_dir]:
+            if os.path.exists(data_dir):
+                shutil.rmtree(data_dir)
+
+    @contextmanager
+    def transaction(self, commit=False):
+        """Hold back the object writes until the outermost transaction ends and then write them
+        together in directory order. Can be nested - an error drops the writes made in the
+        innermost transaction and undoes its changes to the indexes and bulk_writes packs. With
+        commit, a nested transaction writes out its objects when it ends instead (see
+        commit_changes), so an update that fails then is raised from it and rolls it back"""
+        if self.pending is None:
+            self.pending = {}
+            self.pending_log = []
+            self.index_log = []
+            outermost = True
+        else:
+            outermost = False
+
+        savepoint = (len(self.pending_log), len(self.index_log),
+                     dict((hash_len, writer.size) for hash_len, writer in (self.pack_writers or {}).items()))
+        try:
+            yield
+            if commit and not outermost:
+                self.commit_changes(*savepoint[:2])
+        except:
+            self.rollback(*savepoint)
+            if outermost:
+                self.pending = self.pending_log = self.index_log = None
+                self.end_packs()
+            raise
+
+        if outermost:
+            pending, self.pending = self.pending, None
+            self.pending_log = self.index_log = None
+            for obj_hash in sorted(pending):
+                self.apply_changes(obj_hash, pending[obj_hash])
+            self.end_packs()
+
+    def commit_changes(self, pending_length, index_length):
+        """Write out the objects changed since the logs were the given lengths, along with any
+        earlier changes to them, and forget them so they can't be rolled back. Their updates are all
+        made, under the objects' locks, before anything is written so if one fails nothing is"""
+        obj_hashes = sorted(set(self.pending_log[pending_length:]))
+        updated = [h for h in obj_hashes if any(callable(change) for change in self.pending[h])]
+        with self.object_locks.lock_all(updated):
+            stored = dict((h, self.stored_object(h)) for h in updated)
+            new_data = dict((h, self.changed_object(self.pending[h], stored.get(h))) for h in obj_hashes)
+            for obj_hash in obj_hashes:
+                if obj_hash in stored and new_data[obj_hash] == stored[obj_hash]:
+                    continue
+                if obj_hash in stored:
+                    self.update_indexes(obj_hash, stored[obj_hash], new_data[obj_hash])
+                self.store_loose(obj_hash, new_data[obj_hash])
+
+        written = set(obj_hashes)
+        for obj_hash in obj_hashes:
+            del self.pending[obj_hash]
+        self.pending_log = [h for h in self.pending_log if not h in written]
+        del self.index_log[index_length:]
+
+    def rollback(self, pending_length, index_length, pack_sizes):
+        """Drop the writes queued, undo the index changes and truncate the bulk_writes packs back to
+        when the logs were the given lengths and the packs the given sizes"""
+        while len(self.pending_log) > pending_length:
+            obj_hash = self.pending_log.pop()
+            self.pending[obj_hash].pop()
+            if not self.pending[obj_hash]:
+                del self.pending[obj_hash]
+
+        while len(self.index_log) > index_length:
+            index, entry, added = self.index_log.pop()
+            if added:
+                index.remove(entry)
+            else:
+                index.add(entry)
+
+        for hash_len, writer in (self.pack_writers or {}).items():
+            writer.truncate(pack_sizes.get(hash_len, 0))
+
+    def stored_object(self, obj_hash):
+        """Return the object as stored, ignoring any pending changes"""
+        try:
+            with open(self.object_path(obj_hash), "rb") as f:
+                return f.read() or None
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        for pack in self.search_packs():
+            data = pack.read_object(obj_hash)
+            if data is not None:
+                return data
+        return None
+
+    def changed_object(self, changes, data):
+        """Return the object data after the list of changes - new data, or update functions taking
+        the current data - are made to the given data. None if it ends up deleted"""
+        for change in changes:
+            data = change(data) if callable(change) else change
+            data = data or None
+        return data
+
+    def pending_object(self, obj_hash):
+        """Return the object as it will be once its pending changes are written"""
+        changes = self.pending[obj_hash]
+        return self.changed_object(changes, self.stored_object(obj_hash) if callable(changes[0]) else None)
+
+    def apply_changes(self, obj_hash, changes):
+        """Write out the changes to the object. Updates are made under the object's lock against
+        the latest stored data so concurrent updates from other processes aren't lost"""
+        if not any(callable(change) for change in changes):
+            self.store_loose(obj_hash, self.changed_object(changes, None))
+            return
+
+        with self.object_locks.lock(obj_hash):
+            old_data = self.stored_object(obj_hash)
+            data = self.changed_object(changes, old_data)
+            if data != old_data:
+                self.update_indexes(obj_hash, old_data, data)
+                self.store_loose(obj_hash, data)
+
+    def store_loose(self, obj_hash, data):
+        """Write the object as a loose file or remove it if data is None, leaving a deletion
+        marker if it's also in a pack"""
+        if data:
+            self.write_loose(obj_hash, data)
+        elif any(pack.has_object(obj_hash) for pack in self.search_packs()):
+            # we can't remove it from the pack so mark it as deleted
+            self.write_loose(obj_hash, b'')
+        else:
+            self.remove_loose(obj_hash)
+
+    def object_path(self, obj_hash):
+        """Return the path of the file holding the given object"""
+        return os.path.join(self.db_base_path, obj_hash[:2], obj_hash[2:4], obj_hash)
+
+    def loose_size(self, obj_hash):
+        """Return the size of the loose object or -1 if there isn't one"""
+        if self.pending and obj_hash in self.pending:
+            data = self.pending_object(obj_hash)
+            return -1 if data is None else len(data)
+        try:
+            return os.path.getsize(self.object_path(obj_hash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return -1
+
+    def has_object(self, obj_hash):
+        size = self.loose_size(obj_hash)
+        if size >= 0:
+            return size > 0
+        return any(pack.has_object(obj_hash) for pack in self.search_packs())
+
+    def has_dataset(self, obj_hash):
+        return self.has_object(obj_hash)
+
+    def read_object(self, obj_hash):
+        if self.pending and obj_hash in self.pending:
+            return self.pending_object(obj_hash)
+        return self.stored_object(obj_hash)
+
+    def open_object(self, obj_hash):
+        if self.pending and obj_hash in self.pending:
+            data = self.pending_object(obj_hash)
+            return io.BytesIO(data) if data else None
+
+        # loose objects can be read incrementally
+        try:
+            f = open(self.object_path(obj_hash), "rb")
+            if os.fstat(f.fileno()).st_size:
+                return f
+            f.close()
+            return None
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        data = self.read_object(obj_hash)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+    def index_entries(self, obj_hash, data):
+        """Return a list of (index, entries) giving the entries of the object in each of the
+        children, tag and creation indexes"""
+        header = record_header(data)
+        if header is None:
+            return []
+        creation_key = time_key(header.get('creation', ''))
+        # only full hashes can go in the index - older records can have abbreviated parents, which
+        # rebuild_indexes expands
+        return [(self.children_index, [parent + obj_hash for parent in header['parents'] if is_full_hash(parent)]),
+                (self.tags_index, [tag_key(tag) + obj_hash for tag in header['tags']]),
+                (self.creation_index, [creation_key + obj_hash] if creation_key else [])]
+
+    def update_indexes(self, obj_hash, old_data, new_data):
+        """Update the indexes for the object changing from old to new data"""
+        if new_data and is_ds_record(new_data):
+            self.change_index(self.ds_index, obj_hash, True)
+        elif not new_data:
+            self.change_index(self.ds_index, obj_hash, False)
+
+        new_entries = dict(self.index_entries(obj_hash, new_data))
+        for index, entries in self.index_entries(obj_hash, old_data):
+            for entry in entries:
+                if not entry in new_entries.get(index, []):
+                    self.change_index(index, entry, False)
+        for index, entries in new_entries.items():
+            for entry in entries:
+                self.change_index(index, entry, True)
+
+    def change_index(self, index, entry, add):
+        """Add or remove the index entry, remembering the change so a failed transaction can undo it"""
+        changed = index.add(entry) if add else index.remove(entry)
+        if changed and self.index_log is not None:
+            self.index_log.append((index, entry, add))
+
+    def queue_change(self, obj_hash, change):
+        """Add the change to the pending ones or make it straight away"""
+        if self.pending is not None:
+            self.pending.setdefault(obj_hash, []).append(change)
+            self.pending_log.append(obj_hash)
+        else:
+            self.apply_changes(obj_hash, [change])
+
+    def write_object(self, obj_hash, data):
+        # index first so a dataset can never be present but not findable. Only datasets need the
+        # old data for the indexes
+        self.update_indexes(obj_hash, self.read_object(obj_hash) if is_ds_record(data) else None, data)
+        self.queue_change(obj_hash, data)
+
+    def update_object(self, obj_hash, update):
+        # the indexes are updated along with the object, once the update has been made
+        self.queue_change(obj_hash, update)
+
+    @contextmanager
+    def bulk_writes(self):
+        """Write the objects given to write_new_objects in the block to one pack per hash length,
+        rolling over to a new one every PACK_ROLLOVER_SIZE bytes or PACK_ROLLOVER_OBJECTS objects
+        (between transactions, so a failed one can be rolled back), rather than a pack per call.
+        Other processes only see the objects as each pack is finished. Can be nested"""
+        if self.pack_writers is None:
+            self.pack_writers = {}
+        self.bulk_depth += 1
+        try:
+            yield
+        finally:
+            self.bulk_depth -= 1
+            if self.pending is None:
+                self.end_packs()
+
+    def write_new_objects(self, objects):
+        """Write the new objects into a pack per hash length rather than as loose files, so they
+        take a single sequential write"""
+        with self.bulk_writes():
+            for obj_hash, data in sorted(objects):
+                if self.loose_size(obj_hash) >= 0:
+                    # a deletion marker would hide it in a pack
+                    self.write_object(obj_hash, data)
+                    continue
+                if is_ds_record(data):
+                    self.update_indexes(obj_hash, None, data)
+
+                writer = self.pack_writers.get(len(obj_hash))
+                if writer is None:
+                    writer = self.pack_writers[len(obj_hash)] = PackWriter(self.pack_dir)
+                writer.add(obj_hash, data)
+
+    def end_packs(self):
+        """Finish the bulk_writes packs if bulk_writes has ended, or those that have got too big so
+        new ones are started. Only called outside transactions"""
+        for hash_len, writer in list((self.pack_writers or {}).items()):
+            if not self.bulk_depth or writer.size >= PACK_ROLLOVER_SIZE or len(writer.entries) >= PACK_ROLLOVER_OBJECTS:
+                del self.pack_writers[hash_len]
+                writer.finish()
+        if not self.bulk_depth:
+            self.pack_writers = None
+
+    def write_loose(self, obj_hash, data):
+        """Write the loose object file atomically, only creating the directories if the write fails"""
+        atomic_write(self.object_path(obj_hash), data)
+
+    def remove_loose(self, obj_hash):
+        """Remove the loose object file if there is one"""
+        try:
+            os.remove(self.object_path(obj_hash))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def delete_object(self, obj_hash):
+        self.update_indexes(obj_hash, self.read_object(obj_hash), None)
+        self.queue_change(obj_hash, None)
+
+    def iter_loose_objects(self):
+        """Iterate over the hashes of all loose objects, including deletion markers"""
+        for obj_dir in sorted(os.listdir(self.db_base_path)):
+            if len(obj_dir) != 2 or not is_hex(obj_dir):
+                continue
+            for sub_dir in sorted(os.listdir(os.path.join(self.db_base_path, obj_dir))):
+                for obj_hash in sorted(os.listdir(os.path.join(self.db_base_path, obj_dir, sub_dir))):
+                    # skip files still being written
+                    if not obj_hash.endswith('.tmp'):
+                        yield obj_hash
+
+    def iter_objects(self):
+        seen = set()
+        for obj_hash in self.iter_loose_objects():
+            seen.add(obj_hash)
+            if self.loose_size(obj_hash) > 0:
+                yield obj_hash
+
+        for pack in self.search_packs():
+            for obj_hash in pack.iter_objects():
+                if not obj_hash in seen:
+                    seen.add(obj_hash)
+                    yield obj_hash
+
+    def iter_datasets(self):
+        for ds_hash in self.ds_index:
+            if self.has_object(ds_hash):
+                yield ds_hash
+
+    def hashes_with_prefix(self, prefix, limit=None):
+        if not prefix or not is_hex(prefix):
+            return []
+        return [h for h in self.ds_index.with_prefix(prefix, limit) if self.has_object(h)]
+
+    def get_children(self, ds_hash):
+        return [link[len(ds_hash):] for link in self.children_index.with_prefix(ds_hash)]
+
+    def find_datasets(self, tags=(), since=None, until=None, parents=()):
+        """Yield the matching datasets, starting from the tag, children or creation index (in
+        that order of preference) and checking each candidate against the other conditions"""
+        low = time_key(since) if since else ''
+        high = time_key(until) if until else ''
+        check_time = bool(low or high)
+        if tags:
+            key = tag_key(tags[0])
+            candidates = [entry[len(key):] for entry in self.tags_index.with_prefix(key)]
+        elif parents:
+            candidates = self.get_children(parents[0])
+        elif check_time:
+            # 'g' sorts after every hex key
+            candidates = (entry[len(low or high):] for entry in self.creation_index.in_range(low, high or 'g'))
+            check_time = False
+        else:
+            candidates = self.ds_index
+
+        for ds_hash in candidates:
+            if not all(self.tags_index.contains(tag_key(tag) + ds_hash) for tag in tags):
+                continue
+            if not all(self.children_index.contains(parent + ds_hash) for parent in parents):
+                continue
+            if check_time:
+                header = record_header(self.read_object(ds_hash))
+                creation_key = time_key(header.get('creation', '')) if header else ''
+                if not creation_key or creation_key < low or (high and creation_key >= high):
+                    continue
+            if self.has_object(ds_hash):
+                yield ds_hash
+
+    def gc(self, full=False):
+        """Fold the loose objects into a new pack. A full gc repacks everything into a single pack
+        per hash length and drops deleted objects. Safe against other processes writing at the
+        same time - a loose object is only removed if it's the one that was packed"""
+        old_packs = list(self.packs)
+
+        # remember the state of the loose objects so we don't remove any that change while packing
+        loose_stamps = {}
+        for obj_hash in self.iter_loose_objects():
+            stamp = file_stamp(self.object_path(obj_hash))
+            if stamp is not None:
+                loose_stamps[obj_hash] = stamp
+        if full:
+            to_pack = list(self.iter_objects())
+        else:
+            to_pack = [h for h in sorted(loose_stamps) if loose_stamps[h][1] > 0]
+
+        packed = set()
+        for hash_len in sorted(set(len(h) for h in to_pack)):
+            write_pack(self.pack_dir, self.objects_to_pack([h for h in to_pack if len(h) == hash_len], packed))
+
+        self.close_packs()
+
+        # remove the old packs if they've all been rewritten
+        if full:
+            for pack in old_packs:
+                pack.close()
+                os.remove(pack.pack_path)
+                os.remove(pack.idx_path)
+
+        # and the loose objects that are now packed (or are deletion markers no longer needed),
+        # under their locks so an update can't replace one between the check and the removal
+        for obj_hash in sorted(loose_stamps):
+            with self.object_locks.lock(obj_hash):
+                if file_stamp(self.object_path(obj_hash)) != loose_stamps[obj_hash]:
+                    continue
+                if loose_stamps[obj_hash][1] > 0 and not obj_hash in packed:
+                    continue
+                if loose_stamps[obj_hash][1] == 0 and any(pack.has_object(obj_hash) for pack in self.packs):
+                    continue
+                self.remove_loose(obj_hash)
+
+        # tidy up the empty directories. A writer may be about to use one, in which case it
+        # recreates it, or have just started to, in which case it's no longer empty
+        for obj_dir in os.listdir(self.db_base_path):
+            if len(obj_dir) != 2 or not is_hex(obj_dir):
+                continue
+            obj_path = os.path.join(self.db_base_path, obj_dir)
+            for sub_dir in list_dir(obj_path):
+                remove_empty_dir(os.path.join(obj_path, sub_dir))
+            remove_empty_dir(obj_path)
+
+        # a full gc is a good time to drop any stale index entries
+        if full:
+            self.rebuild_indexes()
+
+# -----------------------------------------------------------------------------
+# All objects in a single SQLite DB at <db>/dstrk.sqlite with indexed tables for files,
+# datasets, parents and tags
+class SQLiteStorage:
+    name = 'sqlite'
+    db_file_name = 'dstrk.sqlite'
+
+    schema = [
+        "CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, path TEXT, datasets TEXT, size INTEGER, partial TEXT)",
+        "CREATE TABLE IF NOT EXISTS datasets (hash TEXT PRIMARY KEY, creation TEXT, record BLOB)",
+        "CREATE TABLE IF NOT EXISTS parents (ds_hash TEXT, parent_hash TEXT)",
+        "CREATE TABLE IF NOT EXISTS tags (ds_hash TEXT, tag TEXT)",
+        "CREATE INDEX IF NOT EXISTS files_path ON files (path)",
+        "CREATE INDEX IF NOT EXISTS datasets_creation ON datasets (creation)",
+        "CREATE INDEX IF NOT EXISTS parents_ds ON parents (ds_hash)",
+        "CREATE INDEX IF NOT EXISTS parents_parent ON parents (parent_hash)",
+        "CREATE INDEX IF NOT EXISTS tags_ds ON tags (ds_hash)",
+        "CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag)",
+        ]
+
+    # columns added to the files table since it was first created
+    added_file_columns = [("size", "INTEGER"), ("partial", "TEXT")]
+
+    def __init__(self, db_base_path):
+        self.db_base_path = db_base_path
+        self.db_file = os.path.join(db_base_path, self.db_file_name)
+        self._conn = None
+        self.transaction_depth = 0
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            import sqlite3
+            # autocommit unless we're in an explicit transaction. 'dstrk serve' uses the connection
+            # from whichever thread is running the current command
+            self._conn = sqlite3.connect(self.db_file, isolation_level=None, timeout=60, check_same_thread=False)
+            self.upgrade_schema()
+        return self._conn
+
+    def upgrade_schema(self):
+        """Add any columns missing from a DB created by an older version"""
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(files)")]
+        if not columns:
+            # not initialised yet
+            return
+        for name, col_type in self.added_file_columns:
+            if not name in columns:
+                self._conn.execute("ALTER TABLE files ADD COLUMN {0} {1}".format(name, col_type))
+
+    def init_storage(self):
+        for stmt in self.schema:
+            self.conn.execute(stmt)
+
+    def destroy(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if os.path.exists(self.db_file):
+            os.remove(self.db_file)
+
+    @contextmanager
+    def transaction(self, commit=False):
+        """Group all writes in a single SQLite transaction. Nested transactions are savepoints so
+        an error only rolls back the innermost one. Updates are made as they're asked for, so
+        commit makes no difference"""
+        savepoint = "sp{0}".format(self.transaction_depth)
+        if self.transaction_depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        else:
+            self.conn.execute("SAVEPOINT " + savepoint)
+        self.transaction_depth += 1
+        try:
+            yield
+        except:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.conn.execute("ROLLBACK")
+            else:
+                self.conn.execute("ROLLBACK TO " + savepoint)
+                self.conn.execute("RELEASE " + savepoint)
+            raise
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("RELEASE " + savepoint)
+
+    def has_object(self, obj_hash):
+        return self.has_dataset(obj_hash) or bool(self.conn.execute("SELECT 1 FROM files WHERE hash = ?", (obj_hash,)).fetchone())
+
+    def has_dataset(self, obj_hash):
+        return bool(self.conn.execute("SELECT 1 FROM datasets WHERE hash = ?", (obj_hash,)).fetchone())
+
+    def read_object(self, obj_hash):
+        row = self.conn.execute("SELECT record FROM datasets WHERE hash = ?", (obj_hash,)).fetchone()
+        if row:
+            return bytes(row[0])
+
+        row = self.conn.execute("SELECT datasets, path, size, partial FROM files WHERE hash = ?", (obj_hash,)).fetchone()
+        if row:
+            return format_file_record(row[0].split(), row[1], row[2], row[3] or '').encode('utf-8')
+
+        return None
+
+    def open_object(self, obj_hash):
+        data = self.read_object(obj_hash)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+    def update_object(self, obj_hash, update):
+        # the outermost transaction holds the write lock on the DB so nothing can change in between
+        with self.transaction():
+            old_data = self.read_object(obj_hash)
+            data = update(old_data)
+            if not data:
+                self.delete_object(obj_hash)
+            elif data != old_data:
+                self.write_object(obj_hash, data)
+
+    def write_object(self, obj_hash, data):
+        with self.transaction():
+            # only the header of a dataset is read as the file list may be binary
+            ds_info = record_header(data)
+            if ds_info:
+                self.conn.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?)", (obj_hash, ds_info['creation'], data))
+                self.conn.execute("DELETE FROM parents WHERE ds_hash = ?", (obj_hash,))
+                self.conn.executemany("INSERT INTO parents VALUES (?, ?)", [(obj_hash, p) for p in ds_info['parents']])
+                self.conn.execute("DELETE FROM tags WHERE ds_hash = ?", (obj_hash,))
+                self.conn.executemany("INSERT INTO tags VALUES (?, ?)", [(obj_hash, t) for t in ds_info['tags']])
+            else:
+                file_info = parse_file_record(data.decode('utf-8'), obj_hash)
+                self.conn.execute("INSERT OR REPLACE INTO files (hash, path, datasets, size, partial) VALUES (?, ?, ?, ?, ?)",
+                                  (obj_hash, file_info['path'], ' '.join(file_info['ds']), file_info['size'], file_info['partial']))
+
+    def write_new_objects(self, objects):
+        with self.transaction():
+            for obj_hash, data in objects:
+                self.write_object(obj_hash, data)
+
+    @contextmanager
+    def bulk_writes(self):
+        """Nothing to do - each transaction's writes are already made together"""
+        yield
+
+    def delete_object(self, obj_hash):
+        with self.transaction():
+            self.conn.execute("DELETE FROM datasets WHERE hash = ?", (obj_hash,))
+            self.conn.execute("DELETE FROM parents WHERE ds_hash = ?", (obj_hash,))
+            self.conn.execute("DELETE FROM tags WHERE ds_hash = ?", (obj_hash,))
+            self.conn.execute("DELETE FROM files WHERE hash = ?", (obj_hash,))
+
+    def iter_objects(self):
+        for row in self.conn.execute("SELECT hash FROM datasets UNION SELECT hash FROM files ORDER BY hash").fetchall():
+            yield row[0]
+
+    def get_children(self, ds_hash):
+        return [row[0] for row in self.conn.execute("SELECT ds_hash FROM parents WHERE parent_hash = ? ORDER BY ds_hash",
+                                                    (ds_hash,)).fetchall()]
+
+    def find_datasets(self, tags=(), since=None, until=None, parents=()):
+        """Yield the matching datasets in creation order using the tag, parent and creation indexes"""
+        conditions = []
+        args = []
+        for tag in tags:
+            conditions.append("hash IN (SELECT ds_hash FROM tags WHERE tag = ?)")
+            args.append(tag)
+        for parent in parents:
+            conditions.append("hash IN (SELECT ds_hash FROM parents WHERE parent_hash = ?)")
+            args.append(parent)
+        if since:
+            conditions.append("creation >= ?")
+            args.append(since)
+        if until:
+            conditions.append("creation < ?")
+            args.append(until)
+
+        query = "SELECT hash FROM datasets"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        for row in self.conn.execute(query + " ORDER BY creation, hash", args):
+            yield row[0]
+
+    def gc(self, full=False):
+        """Reclaim unused space in the SQLite file"""
+        self.conn.execute("VACUUM")
+
+    def iter_datasets(self):
+        return iter([row[0] for row in self.conn.execute("SELECT hash FROM datasets ORDER BY hash").fetchall()])
+
+    def hashes_with_prefix(self, prefix, limit=None):
+        if not prefix or not is_hex(prefix):
+            return []
+
+        # 'g' sorts after all hex digits so this is a range scan on the primary key
+        return [row[0] for row in self.conn.execute("SELECT hash FROM datasets WHERE hash >= ? AND hash < ? ORDER BY hash LIMIT ?",
+                                                    (prefix, prefix + 'g', limit or -1)).fetchall()]
+
+# -----------------------------------------------------------------------------
+# the available engines by name
+ENGINES = {LooseStorage.name: LooseStorage, SQLiteStorage.name: SQLiteStorage}
+DEFAULT_ENGINE = LooseStorage.name
+
+def make_storage(db_base_path, engine=DEFAULT_ENGINE):
+    """Return the storage engine object of the given type"""
+    return ENGINES[engine](db_base_path)
@@ -0,0 +1,109 @@
+# Per-phase timing instrumentation
+#
+# DSDatabase splits its operations into phases (globbing, hashing, reading and writing records,
+# ...) and counts what each phase does: files and bytes hashed, objects read and written etc.
+# Anything registered with DSDatabase.add_hook (or directly with the Recorder it uses) is called as
+# each phase ends:
+#
+#   hook(phase, seconds, counters)
+#
+# where nested phases are named 'outer/inner', seconds includes any nested phases and counters
+# only covers the phase itself. With no hooks registered, phases and counters cost a single check.
+
+# system imports
+import json
+import sys
+import time
+
+# -----------------------------------------------------------------------------
+# context manager used when nothing is listening
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+
+# -----------------------------------------------------------------------------
+# a running phase - pushes itself on the given stack so counters go to the innermost phase
+class Phase(object):
+    def __init__(self, stack, hooks, name):
+        self.stack = stack
+        self.hooks = hooks
+        self.name = name
+        self.counters = {}
+
+    def __enter__(self):
+        if self.stack:
+            self.name = self.stack[-1].name + '/' + self.name
+        self.stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.time() - self.start
+        self.stack.pop()
+        for hook in self.hooks:
+            hook(self.name, seconds, self.counters)
+        return False
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+# -----------------------------------------------------------------------------
+# class to hand out phases and pass them to the hooks. Can be shared between DSDatabase objects
+# so an outer phase covers everything they do
+class Recorder(object):
+    def __init__(self):
+        self.hooks = []
+        self.stack = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def phase(self, name):
+        """Return a context manager timing the given phase"""
+        if not self.hooks:
+            return NULL_PHASE
+        return Phase(self.stack, self.hooks, name)
+
+    def count(self, counter, n=1):
+        """Add to a counter of the innermost running phase"""
+        if self.stack:
+            self.stack[-1].count(counter, n)
+
+# -----------------------------------------------------------------------------
+# hook that accumulates the phases for a report
+class Timings(object):
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, phase, seconds, counters):
+        if not phase in self.phases:
+            self.phases[phase] = {'calls':0, 'seconds':0.0, 'counters':{}}
+        totals = self.phases[phase]
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        for counter in counters:
+            totals['counters'][counter] = totals['counters'].get(counter, 0) + counters[counter]
+
+    def report(self):
+        """Return the accumulated phases as a list of dictionaries, nested phases after their parent"""
+        return [dict(self.phases[phase], phase=phase) for phase in sorted(self.phases)]
+
+    def write_json(self, fname):
+        with open(fname, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def write_text(self, out=None):
+        """Write a table of the phases, nested phases indented under their parent"""
+        out = out or sys.stderr
+        out.write("{0:<40} {1:>7} {2:>10}  {3}\n".format("Phase", "Calls", "Seconds", "Counters"))
+        for phase in sorted(self.phases):
+            totals = self.phases[phase]
+            name = "  " * phase.count('/') + phase.split('/')[-1]
+            counters = ", ".join("{0}={1}".format(c, totals['counters'][c]) for c in sorted(totals['counters']))
+            out.write("{0:<40} {1:>7} {2:>10.4f}  {3}\n".format(name, totals['calls'], totals['seconds'], counters))
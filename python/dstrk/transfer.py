@@ -0,0 +1,233 @@
+# Export the records of a DB to a stream and import them into another
+#
+# An export is a stream of (hash, record bytes) for every dataset and file record, or for those
+# of a set of datasets and everything derived from them. It's written in one of two formats,
+# optionally compressed with gzip or xz (told apart by their magic numbers on import):
+#
+#   jsonl       one JSON object per line: {"hash": <hash>, "record": <record text>}, with
+#               "record_base64" instead of "record" for records that aren't text (see the
+#               binary manifest encodings in records.py)
+#   binary      DSTKEXP1 followed by <varint digest length><digest><varint length><record> for
+#               each record and ended by a zero digest length
+#
+# Neither format needs anything but the current record in memory. Importing writes the records
+# in groups: datasets and files that aren't in the DB yet are handed to the storage engine in one
+# go (the loose engine streams them all into one pack, see LooseStorage.bulk_writes), datasets
+# that are already there are skipped and the records of files that are already there gain any new
+# datasets.
+
+# system imports
+import base64
+import binascii
+import functools
+import gzip
+import io
+import itertools
+import json
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# dstrk imports
+from dstrk.exceptions import NotValidFileOrHash
+from dstrk.hashing import algorithm_of
+from dstrk.records import is_ds_record, parse_file_record, format_file_record, merge_file_record, encode_varint
+from dstrk.storage import is_hex
+
+EXPORT_FORMATS = ['jsonl', 'binary']
+EXPORT_COMPRESSION = ['none', 'gzip'] + (['xz'] if lzma else [])
+BINARY_MAGIC = b'DSTKEXP1'
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+# number of records imported in each transaction
+DEFAULT_GROUP_SIZE = 10000
+
+# -----------------------------------------------------------------------------
+def open_export(out_file, compression='none'):
+    """Return a binary file object writing to out_file with the given compression"""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=out_file, mode='wb')
+    if compression == 'xz':
+        return lzma.LZMAFile(out_file, mode='wb')
+    return out_file
+
+def open_import(in_file):
+    """Return a binary file object reading the decompressed export from in_file"""
+    if not hasattr(in_file, 'peek'):
+        in_file = io.BufferedReader(in_file)
+    magic = in_file.peek(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=in_file, mode='rb')
+    if magic.startswith(XZ_MAGIC):
+        if lzma is None:
+            raise ValueError("xz compressed exports need the lzma module")
+        return lzma.LZMAFile(in_file, mode='rb')
+    return in_file
+
+# -----------------------------------------------------------------------------
+def select_datasets(ds, datasets, ancestors=False):
+    """Return the set of hashes of the given datasets (files or hashes) and all their descendants,
+    and their ancestors too if asked"""
+    to_visit = []
+    for dataset in datasets:
+        ds_hash = ds.get_ds_hash_from_file_or_hash(dataset)
+        if not ds_hash:
+            raise NotValidFileOrHash(dataset)
+        to_visit.append(ds_hash)
+
+    selected = set()
+    descendants = list(to_visit)
+    while descendants:
+        ds_hash = descendants.pop()
+        if not ds_hash in selected:
+            selected.add(ds_hash)
+            descendants += ds.storage.get_children(ds_hash)
+
+    while ancestors and to_visit:
+        ds_hash = to_visit.pop()
+        for parent in ds.read_ds_header(ds_hash)['parents']:
+            if not parent in selected and ds.storage.has_dataset(parent):
+                selected.add(parent)
+                to_visit.append(parent)
+
+    return selected
+
+def iter_export(ds, datasets=None, ancestors=False):
+    """Yield (hash, record bytes) for every object in the DB, or for the given datasets, their
+    descendants (and ancestors) and their files. The file records then only list the exported
+    datasets and each is only given once, with the first of its exported datasets"""
+    if not datasets:
+        for obj_hash in ds.storage.iter_objects():
+            data = ds.storage.read_object(obj_hash)
+            if data is not None:
+                ds.count('objects_read')
+                yield obj_hash, data
+        return
+
+    selected = select_datasets(ds, datasets, ancestors)
+    for ds_hash in sorted(selected):
+        ds.count('objects_read')
+        yield ds_hash, ds.storage.read_object(ds_hash)
+        for path, fhash in ds.read_ds_manifest(ds_hash):
+            file_str = ds.read_hash_file(fhash)
+            if file_str is None:
+                continue
+            file_info = parse_file_record(file_str, fhash)
+            ds_list = [d for d in file_info['ds'] if d in selected]
+            if ds_list and min(ds_list) == ds_hash:
+                yield fhash, format_file_record(ds_list, file_info['path'], file_info['size'], file_info['partial']).encode('utf-8')
+
+def export_db(ds, out_file, fmt='jsonl', datasets=None, ancestors=False):
+    """Write the export of the DB (see iter_export) to the binary file object. Returns the number
+    of records written"""
+    if not fmt in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {0}".format(fmt))
+
+    n = 0
+    with ds.phase('export'):
+        if fmt == 'binary':
+            out_file.write(BINARY_MAGIC)
+        for obj_hash, data in iter_export(ds, datasets, ancestors):
+            if fmt == 'binary':
+                digest = binascii.unhexlify(obj_hash)
+                out_file.write(encode_varint(len(digest)) + digest + encode_varint(len(data)))
+                out_file.write(data)
+            else:
+                try:
+                    record = {'hash': obj_hash, 'record': data.decode('utf-8')}
+                except UnicodeDecodeError:
+                    record = {'hash': obj_hash, 'record_base64': base64.b64encode(data).decode('ascii')}
+                out_file.write((json.dumps(record, sort_keys=True) + "\n").encode('utf-8'))
+            n += 1
+        if fmt == 'binary':
+            out_file.write(encode_varint(0))
+    return n
+
+# -----------------------------------------------------------------------------
+def read_varint(in_file):
+    """Return the varint read from the binary file object"""
+    n = shift = 0
+    while True:
+        byte = in_file.read(1)
+        if not byte:
+            raise ValueError("Export is truncated")
+        byte = bytearray(byte)[0]
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n
+        shift += 7
+
+def read_exact(in_file, n):
+    data = in_file.read(n)
+    if len(data) != n:
+        raise ValueError("Export is truncated")
+    return data
+
+def iter_import(in_file):
+    """Yield the (hash, record bytes) from an export in either format (decompressed, see
+    open_import)"""
+    if in_file.peek(len(BINARY_MAGIC))[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        in_file.read(len(BINARY_MAGIC))
+        while True:
+            digest_length = read_varint(in_file)
+            if not digest_length:
+                return
+            obj_hash = binascii.hexlify(read_exact(in_file, digest_length)).decode('ascii')
+            yield obj_hash, read_exact(in_file, read_varint(in_file))
+        return
+
+    for ln in in_file:
+        if not ln.strip():
+            continue
+        record = json.loads(ln.decode('utf-8'))
+        if 'record_base64' in record:
+            yield record['hash'], base64.b64decode(record['record_base64'])
+        else:
+            yield record['hash'], record['record'].encode('utf-8')
+
+def import_db(ds, in_file, group_size=DEFAULT_GROUP_SIZE):
+    """Import the records of an export (see iter_import) into the DB. Returns a dictionary of the
+    number of records 'written', 'merged' into existing file records and 'skipped'. The DB
+    starts looking for files with any other hash algorithms the records were made with"""
+    counts = {'written': 0, 'merged': 0, 'skipped': 0}
+    algorithms = set()
+    objects = iter_import(in_file)
+    with ds.storage.bulk_writes():
+        while True:
+            group = list(itertools.islice(objects, group_size))
+            if not group:
+                break
+            import_group(ds, group, counts, algorithms)
+
+    # the files of records made with other algorithms can then still be found
+    ds.add_hash_algorithms(a for a in algorithms if a)
+    return counts
+
+def import_group(ds, group, counts, algorithms):
+    """Import a list of (hash, record bytes) in one transaction, adding to the counts and the set
+    of hash algorithms seen"""
+    with ds.phase('write'), ds.transaction():
+        new_objects = []
+        for obj_hash, data in group:
+            if not obj_hash or not is_hex(obj_hash):
+                raise ValueError("Not a valid record hash: {0}".format(obj_hash))
+            if not ds.storage.has_object(obj_hash):
+                new_objects.append((obj_hash, data))
+            elif is_ds_record(data) or ds.storage.read_object(obj_hash) == data:
+                counts['skipped'] += 1
+            else:
+                ds.update_hash_file(obj_hash, functools.partial(merge_file_record, file_hash=obj_hash, other_str=data.decode('utf-8')))
+                counts['merged'] += 1
+            algorithms.add(algorithm_of(obj_hash))
+
+        # an export can repeat a record so only the last copy is written
+        new_objects = list(dict(new_objects).items())
+        ds.storage.write_new_objects(new_objects)
+        for obj_hash, data in new_objects:
+            ds.invalidate(obj_hash)
+        ds.count('objects_written', len(new_objects))
+        counts['written'] += len(new_objects)
+
@@ -0,0 +1,76 @@
+# Streaming expansion of the file arguments
+#
+# Each argument is a glob pattern. Matching files are yielded as they are found and, with
+# recursive=True, matching directories are walked with scandir rather than listing the whole tree
+# up front. Include/exclude patterns are fnmatch patterns tested against both the file name and
+# the full path - excludes also stop the walk going into matching directories.
+
+# system imports
+from fnmatch import fnmatch
+import glob
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+# -----------------------------------------------------------------------------
+def matches(path, patterns):
+    """Return true if the path or its file name matches any of the patterns"""
+    name = os.path.basename(path)
+    return any(fnmatch(name, pat) or fnmatch(path, pat) for pat in patterns)
+
+# -----------------------------------------------------------------------------
+def iter_dir(top):
+    """Yield (path, is_dir) for each entry in the directory. Links to directories aren't followed
+    so are skipped"""
+    if scandir is None:
+        for name in os.listdir(top):
+            path = os.path.join(top, name)
+            if os.path.isdir(path) and os.path.islink(path):
+                continue
+            yield path, os.path.isdir(path)
+        return
+
+    for entry in scandir(top):
+        if entry.is_dir() and entry.is_symlink():
+            continue
+        yield entry.path, entry.is_dir()
+
+# -----------------------------------------------------------------------------
+def iter_files(patterns, recursive=False, include=None, exclude=None):
+    """Yield the files matching the given glob patterns, walking into directories if recursive.
+    Directories given without recursive are skipped. Files are yielded once each in the order
+    they're found"""
+    include = include or []
+    exclude = exclude or []
+    seen = set()
+
+    def wanted(path):
+        if path in seen:
+            return False
+        seen.add(path)
+        if include and not matches(path, include):
+            return False
+        return not matches(path, exclude)
+
+    for pattern in patterns:
+        for path in glob.iglob(pattern):
+            if not os.path.isdir(path):
+                if wanted(path):
+                    yield path
+                continue
+
+            if not recursive or matches(path, exclude):
+                continue
+
+            # depth first so only the directories still to visit are held in memory
+            to_visit = [path]
+            while to_visit:
+                for entry_path, is_dir in iter_dir(to_visit.pop()):
+                    if is_dir:
+                        if not matches(entry_path, exclude):
+                            to_visit.append(entry_path)
+                    elif wanted(entry_path):
+                        yield entry_path
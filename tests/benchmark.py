@@ -0,0 +1,305 @@
+# Benchmark dstrk on a synthetic DB
+#
+# Generates a tree of datasets with the given shape, runs each dstrk operation over all of them
+# through the command line entry point and/or the DSDatabase API and prints the timings as JSON:
+#
+#   python tests/benchmark.py --datasets 200 --files 50 --file-size 4096 --depth 10 --fan-in 2
+#
+# Each result gives the number of operations, files and bytes involved, the wall time, the
+# throughput and the peak RSS of the process so far. Operations that fail record the error and
+# the benchmark carries on. To compare hash algorithms, give more than one to --hash: each gets
+# its own DBs and a 'hash' result timing just the hashing of all the files:
+#
+#   python tests/benchmark.py --file-size 10000000 --hash sha1 blake2b xxh128
+
+# Make this as compatible across Python 2 & 3 as possible
+from __future__ import print_function
+from __future__ import division
+
+# system imports
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# allow running from a checkout without setting PYTHONPATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+
+import dstrk.main
+from dstrk.database import DSDatabase
+from dstrk.hashing import hash_files, HASH_ALGORITHMS
+
+# --------------------------------------------------------------------
+def peak_rss_kb():
+    """Return the peak resident set size of this process so far in kB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # reported in bytes rather than kB
+        peak //= 1024
+    return peak
+
+# --------------------------------------------------------------------
+class Devnull(object):
+    """Swallow the output of the dstrk functions while timing them"""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+# --------------------------------------------------------------------
+def generate_data(data_path, params):
+    """Create the files for each dataset and return a list of dataset dictionaries holding the
+    files to add, the extra files to add later and the indices of the parent datasets"""
+    rand = random.Random(params.seed)
+    datasets = []
+    contents = []
+    for i in range(0, params.datasets):
+        ds_path = os.path.join(data_path, "ds_{0}".format(i))
+        os.mkdir(ds_path)
+
+        # datasets are spread over depth layers and take their parents from the layer above
+        layer = i * params.depth // params.datasets
+        candidates = [j for j in range(0, i) if datasets[j]['layer'] == layer - 1]
+        parents = sorted(rand.sample(candidates, min(params.fan_in, len(candidates))))
+
+        ds = {'layer':layer, 'parents':parents, 'files':[], 'extra_files':[], 'bytes':0, 'extra_bytes':0}
+        for j in range(0, params.files + params.extra_files):
+            if contents and rand.random() < params.duplicate_rate and j < params.files:
+                # identical content to an earlier file so it hashes to the same record
+                data = rand.choice(contents)
+            else:
+                data = "{0} {1} ".format(i, j).encode('ascii')
+                data += os.urandom(max(params.file_size - len(data), 0))
+                contents.append(data)
+
+            fname = os.path.join(ds_path, "part{0}.dat".format(j))
+            with open(fname, "wb") as f:
+                f.write(data)
+            if j < params.files:
+                ds['files'].append(fname)
+                ds['bytes'] += len(data)
+            else:
+                ds['extra_files'].append(fname)
+                ds['extra_bytes'] += len(data)
+
+        datasets.append(ds)
+
+    return datasets
+
+# --------------------------------------------------------------------
+class Runner(object):
+    """Run the dstrk operations through either the command line or the DSDatabase API"""
+    def __init__(self, api, db_path, engine, hash_algorithm):
+        self.api = api
+        self.db_path = db_path
+        self.engine = engine
+        self.hash_algorithm = hash_algorithm
+
+    def cli(self, arglist):
+        dstrk.main.main(['--dbpath', self.db_path] + arglist)
+
+    def db(self):
+        return DSDatabase(self.db_path)
+
+    def init_db(self):
+        if self.api == 'cli':
+            self.cli(['initDB', '--engine', self.engine, '--hash', self.hash_algorithm])
+        else:
+            self.db().init_db(engine=self.engine, hash_algorithm=self.hash_algorithm)
+
+    def add_ds(self, files, parents, tags):
+        if self.api == 'cli':
+            arglist = ['addDS'] + files + ['--tags'] + tags
+            if parents:
+                arglist += ['--parentDS'] + parents
+            self.cli(arglist)
+        else:
+            self.db().add_ds(files, parents=parents, tags=tags)
+
+    def add_files(self, files, ds_hash):
+        if self.api == 'cli':
+            self.cli(['addfiles', '--dataset', ds_hash] + files)
+        else:
+            self.db().add_files(files, dataset=ds_hash)
+
+    def ds_info(self, ds_hash):
+        if self.api == 'cli':
+            self.cli(['DSinfo', ds_hash])
+        else:
+            self.db().get_ds_info(ds_hash)
+
+    def tree(self, ds_hash):
+        if self.api == 'cli':
+            self.cli(['tree', ds_hash])
+        else:
+            self.db().get_ds_tree(ds_hash)
+
+    def del_files(self, files):
+        if self.api == 'cli':
+            self.cli(['delfiles'] + files)
+        else:
+            self.db().del_files(files)
+
+    def del_ds(self, ds_hash):
+        if self.api == 'cli':
+            self.cli(['delDS', ds_hash])
+        else:
+            self.db().del_ds(ds_hash)
+
+# --------------------------------------------------------------------
+def time_op(results, api, op, calls, files=0, nbytes=0):
+    """Time the given list of calls and append the result"""
+    result = {'api':api, 'op':op, 'count':len(calls), 'files':files, 'bytes':nbytes}
+    start = time.time()
+    try:
+        with Devnull():
+            for call in calls:
+                call()
+    except Exception as e:
+        result['error'] = "{0}: {1}".format(type(e).__name__, e)
+    seconds = time.time() - start
+
+    result['seconds'] = seconds
+    result['ops_per_sec'] = len(calls) / seconds if seconds else None
+    if files:
+        result['files_per_sec'] = files / seconds if seconds else None
+    if nbytes:
+        result['mb_per_sec'] = nbytes / 1e6 / seconds if seconds else None
+    result['peak_rss_kb'] = peak_rss_kb()
+    results.append(result)
+
+# --------------------------------------------------------------------
+def run_benchmark(runner, datasets, results):
+    """Run every operation over the synthetic datasets"""
+    api = runner.api
+    time_op(results, api, 'initDB', [runner.init_db])
+
+    # datasets have to be added one at a time so the parent hashes are known
+    ds_hashes = []
+    add_results = []
+    for i, ds in enumerate(datasets):
+        parents = [ds_hashes[j] for j in ds['parents']]
+        time_op(add_results, api, 'addDS',
+                [lambda: runner.add_ds(ds['files'], parents, ["Synthetic dataset {0}".format(i)])])
+        if 'error' in add_results[-1]:
+            break
+        ds_hashes.append(runner.db().find_ds_from_file(ds['files'][0]))
+    results.append(merge_results(add_results, datasets))
+    if len(ds_hashes) < len(datasets):
+        return
+
+    extra = [(ds_hash, ds) for ds_hash, ds in zip(ds_hashes, datasets) if ds['extra_files']]
+    time_op(results, api, 'addfiles', [lambda ds_hash=ds_hash, ds=ds: runner.add_files(ds['extra_files'], ds_hash) for ds_hash, ds in extra],
+            sum(len(ds['extra_files']) for ds_hash, ds in extra), sum(ds['extra_bytes'] for ds_hash, ds in extra))
+
+    time_op(results, api, 'DSinfo', [lambda ds_hash=ds_hash: runner.ds_info(ds_hash) for ds_hash in ds_hashes])
+
+    # the deepest layer has the biggest trees
+    last_layer = datasets[-1]['layer']
+    time_op(results, api, 'tree', [lambda ds_hash=ds_hash: runner.tree(ds_hash)
+                                   for ds_hash, ds in zip(ds_hashes, datasets) if ds['layer'] == last_layer])
+
+    time_op(results, api, 'delfiles', [lambda ds=ds: runner.del_files(ds['extra_files']) for ds_hash, ds in extra],
+            sum(len(ds['extra_files']) for ds_hash, ds in extra), sum(ds['extra_bytes'] for ds_hash, ds in extra))
+
+    # delete children before their parents
+    time_op(results, api, 'delDS', [lambda ds_hash=ds_hash: runner.del_ds(ds_hash) for ds_hash in reversed(ds_hashes)],
+            sum(len(ds['files']) for ds in datasets), sum(ds['bytes'] for ds in datasets))
+
+# --------------------------------------------------------------------
+def merge_results(add_results, datasets):
+    """Combine the per dataset addDS timings into one result"""
+    result = {'api':add_results[0]['api'], 'op':'addDS', 'count':len(add_results),
+              'files':sum(len(ds['files']) for ds in datasets[:len(add_results)]),
+              'bytes':sum(ds['bytes'] for ds in datasets[:len(add_results)]),
+              'seconds':sum(r['seconds'] for r in add_results)}
+    for r in add_results:
+        if 'error' in r:
+            result['error'] = r['error']
+
+    seconds = result['seconds']
+    result['ops_per_sec'] = result['count'] / seconds if seconds else None
+    result['files_per_sec'] = result['files'] / seconds if seconds else None
+    result['mb_per_sec'] = result['bytes'] / 1e6 / seconds if seconds else None
+    result['peak_rss_kb'] = add_results[-1]['peak_rss_kb']
+    return result
+
+# --------------------------------------------------------------------
+def main(arglist):
+    """Generate the synthetic data, run the benchmark and return the report dictionary"""
+    parser = argparse.ArgumentParser(description='Benchmark dstrk on a synthetic DB')
+    parser.add_argument('--datasets', type=int, default=50, help='number of datasets')
+    parser.add_argument('--files', type=int, default=20, help='files per dataset')
+    parser.add_argument('--extra-files', type=int, default=2, help='files per dataset added with addfiles and removed with delfiles')
+    parser.add_argument('--file-size', type=int, default=1024, help='size of each file in bytes')
+    parser.add_argument('--depth', type=int, default=5, help='number of generations in the dataset DAG')
+    parser.add_argument('--fan-in', type=int, default=2, help='number of parents of each dataset')
+    parser.add_argument('--duplicate-rate', type=float, default=0.1, help='fraction of files that duplicate an earlier file')
+    parser.add_argument('--engine', default='loose', choices=['loose', 'sqlite'], help='storage engine to benchmark')
+    parser.add_argument('--hash', nargs='+', default=['sha1'], choices=sorted(HASH_ALGORITHMS), help='hash algorithm(s) to benchmark')
+    parser.add_argument('--api', default='both', choices=['cli', 'db', 'both'], help='go through dstrk.main, DSDatabase or both')
+    parser.add_argument('--workdir', help='directory for the data and DBs (default: a new temporary directory)')
+    parser.add_argument('--keep', action='store_true', help="don't remove the data and DBs afterwards")
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the DAG shape and duplicates')
+    parser.add_argument('--output', help='write the JSON report here rather than to stdout')
+    params = parser.parse_args(arglist)
+    params.depth = max(min(params.depth, params.datasets), 1)
+
+    workdir = params.workdir or tempfile.mkdtemp(prefix='dstrk-bench-')
+    data_path = os.path.join(workdir, 'data')
+    if os.path.exists(data_path):
+        shutil.rmtree(data_path)
+    os.makedirs(data_path)
+
+    report = {'params':{k: v for k, v in vars(params).items() if not k in ['output', 'keep', 'workdir']},
+              'python':platform.python_version(), 'platform':platform.platform(), 'results':[]}
+    try:
+        start = time.time()
+        datasets = generate_data(data_path, params)
+        report['generate_seconds'] = time.time() - start
+
+        all_files = [f for ds in datasets for f in ds['files'] + ds['extra_files']]
+        all_bytes = sum(ds['bytes'] + ds['extra_bytes'] for ds in datasets)
+        apis = ['cli', 'db'] if params.api == 'both' else [params.api]
+        for hash_algorithm in params.hash:
+            # the raw hashing throughput, without any DB overhead
+            first = len(report['results'])
+            time_op(report['results'], 'hashing', 'hash', [lambda: hash_files(all_files, algorithm=hash_algorithm)], len(all_files), all_bytes)
+
+            for api in apis:
+                db_path = os.path.join(workdir, 'db-{0}-{1}'.format(api, hash_algorithm))
+                if os.path.exists(db_path):
+                    shutil.rmtree(db_path)
+                run_benchmark(Runner(api, db_path, params.engine, hash_algorithm), datasets, report['results'])
+
+            for result in report['results'][first:]:
+                result['hash'] = hash_algorithm
+    finally:
+        if not params.keep:
+            db_paths = [os.path.join(workdir, 'db-{0}-{1}'.format(api, h)) for api in ['cli', 'db'] for h in params.hash]
+            for path in [data_path] + db_paths:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            if not params.workdir:
+                os.rmdir(workdir)
+
+    report['peak_rss_kb'] = peak_rss_kb()
+    report_str = json.dumps(report, indent=2, sort_keys=True)
+    if params.output:
+        with open(params.output, "w") as f:
+            f.write(report_str + "\n")
+    else:
+        print(report_str)
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -146,6 +146,61 @@ def test_get_ds_info():
                         "72c3e6964b6f85d30013fb0e51b525597d393e7c"]
     dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', os.path.join(test_data_path, "step_1", "part1.txt")])
 
+def test_hash_file_buffered():
+    import hashlib
+    from dstrk.database import DSDatabase
+    fname = os.path.join(test_data_path, "step_1", "part1.txt")
+    expected = hashlib.sha1(open(fname, "rb").read()).hexdigest()
+    assert DSDatabase(test_db_path, buffer_size=3).hash_file(fname) == expected
+    assert DSDatabase(test_db_path, buffer_size=3, use_mmap=True).hash_file(fname) == expected
+    assert DSDatabase(test_db_path).get_file_info(fname)['hash'] == expected
+
+def test_add_dataset_buffersize_option(capsys):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    fname = os.path.join(test_data_path, "step_1", "part1.txt")
+
+    # hashing a few bytes at a time finds the same dataset with the same file hashes
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', test_db_path, '--noserver', '--nocache', 'DSinfo', fname])
+    expected = capsys.readouterr().out
+    dstrk.main.main(['--dbpath', test_db_path, '--noserver', '--nocache', '--buffersize', '5', 'DSinfo', fname])
+    assert capsys.readouterr().out == expected
+    ds_info = DSDatabase(test_db_path, buffer_size=5, use_hash_cache=False).get_ds_info(fname)
+    assert ds_info == DSDatabase(test_db_path, use_hash_cache=False).get_ds_info(fname)
+    assert ds_info['ds_hash'] in expected
+    assert DSDatabase(test_db_path, buffer_size=5, use_hash_cache=False).hash_file(fname) in ds_info['file_hashes']
+
+def test_parallel_hashing():
+    import glob
+    from dstrk.database import DSDatabase
+    files = sorted(glob.glob(os.path.join(test_data_path, "step_*", "*.txt")))
+    assert DSDatabase(test_db_path, jobs=4).hash_files(files) == DSDatabase(test_db_path).hash_files(files)
+
+def test_hash_cache():
+    import hashlib
+    from dstrk.database import DSDatabase
+    fname = os.path.join(test_data_path, "step_5", "part1.txt")
+    orig_hash = hashlib.sha1(open(fname, "rb").read()).hexdigest()
+
+    # recently modified files aren't cached so backdate it
+    os.utime(fname, (1000000000, 1000000000))
+    assert DSDatabase(test_db_path).hash_file(fname) == orig_hash
+    assert DSDatabase(test_db_path).hash_cache.lookup(fname) == orig_hash
+
+    # a change to the file should invalidate the entry
+    open(fname, "w").write("Changed data")
+    os.utime(fname, (1000000010, 1000000010))
+    assert DSDatabase(test_db_path).hash_cache.lookup(fname) == ''
+    assert DSDatabase(test_db_path).hash_file(fname) == hashlib.sha1(b"Changed data").hexdigest()
+
+    # check compaction keeps the latest entries
+    db = DSDatabase(test_db_path, hash_cache_size=1)
+    db.hash_cache.compact()
+    assert len(open(os.path.join(test_db_path, "hashcache")).readlines()) == 1
+    assert DSDatabase(test_db_path).hash_cache.lookup(fname) == hashlib.sha1(b"Changed data").hexdigest()
+    open(fname, "w").write("Data file Step 5 Part 1")
+
 def test_add_dataset_step_2():
     import dstrk.main
     from dstrk.database import DSDatabase
@@ -207,6 +262,43 @@ def test_ls_tree():
     assert tree['parents'][0]['ds_hash'] == ds_hash_step2
     assert tree['parents'][0]['parents'][0]['ds_hash'] == ds_hash_step1
 
+def test_descendants():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    global ds_hash_step1, ds_hash_step2, ds_hash_step3
+
+    dstrk.main.main(['--dbpath', test_db_path, 'descendants', ds_hash_step1[0:7] ])
+
+    tree = DSDatabase(test_db_path).get_ds_descendants(os.path.join(test_data_path, "step_1", "part1.txt"))
+    assert tree['ds_hash'] == ds_hash_step1
+    assert sorted(ds['ds_hash'] for ds in tree['children']) == sorted([ds_hash_step2, ds_hash_step3])
+    step2 = [ds for ds in tree['children'] if ds['ds_hash'] == ds_hash_step2][0]
+    assert step2['tags'] == ['Second Step']
+    assert [ds['ds_hash'] for ds in step2['children']] == [ds_hash_step3]
+    assert DSDatabase(test_db_path).get_ds_descendants(ds_hash_step3)['children'] == []
+
+def test_tree_shared_ancestors():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    global ds_hash_step1, ds_hash_step2, ds_hash_step3
+
+    dstrk.main.main(['--dbpath', test_db_path, 'tree', '--max-depth', '1', ds_hash_step3 ])
+    dstrk.main.main(['--dbpath', test_db_path, 'descendants', '--max-depth', '1', ds_hash_step1 ])
+
+    # step 1 is a parent of both step 2 and step 3 so should only be read once
+    tree = DSDatabase(test_db_path).get_ds_tree(ds_hash_step3)
+    step1 = [ds for ds in tree['parents'] if ds['ds_hash'] == ds_hash_step1][0]
+    step2 = [ds for ds in tree['parents'] if ds['ds_hash'] == ds_hash_step2][0]
+    assert step2['parents'][0] is step1
+    assert not tree['truncated']
+
+    tree = DSDatabase(test_db_path).get_ds_tree(ds_hash_step3, max_depth=1)
+    step2 = [ds for ds in tree['parents'] if ds['ds_hash'] == ds_hash_step2][0]
+    assert step2['parents'] == []
+    assert step2['truncated']
+    assert DSDatabase(test_db_path).get_ds_tree(ds_hash_step3, max_depth=0)['parents'] == []
+    assert DSDatabase(test_db_path).get_ds_header(ds_hash_step3)['tags'] == ['Third Step', 'More third step info']
+
 def test_short_hash():
     import dstrk.main
     from dstrk.database import DSDatabase
@@ -215,8 +307,12 @@ def test_short_hash():
 
     dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', ds_hash_step1 ])
     dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', ds_hash_step1[0:7] ])
+    dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', ds_hash_step1[0:4] ])
     with pytest.raises(NotValidFileOrHash) as pytest_e:
-        dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', ds_hash_step1[0:3] ])
+        dstrk.main.main(['--dbpath', test_db_path, 'DSinfo', 'xyz' ])
+    for bad_hash in ['0x1', 'a_b', '+a', ' ab', '-0', 'ABCDEF']:
+        with pytest.raises(NotValidFileOrHash):
+            dstrk.main.main(['--dbpath', test_db_path, '--noserver', 'DSinfo', bad_hash ])
 
     assert ds_hash_step1 == DSDatabase(test_db_path).get_ds_info(ds_hash_step1[0:7])['ds_hash']
     assert DSDatabase(test_db_path).get_ds_info(ds_hash_step3[0:7])['tags'][0] == 'Third Step'
@@ -243,6 +339,18 @@ def test_add_files_to_dataset():
 
     assert ds_hash_step4 == DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt"))['ds_hash']
     
+def test_add_files_to_dataset_parallel():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    global ds_hash_step4
+
+    # the files are already in the dataset so hashing them again in parallel changes nothing
+    before = DSDatabase(test_db_path).get_ds_info(ds_hash_step4)
+    dstrk.main.main(['--dbpath', test_db_path, '--nocache', 'addfiles', test_data_step2, '--jobs', '2', '--dataset', ds_hash_step4])
+
+    assert DSDatabase(test_db_path).get_ds_info(ds_hash_step4) == before
+    assert ds_hash_step4 == DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part2.txt"))['ds_hash']
+
 def test_git_integration():
     import dstrk.main
     from dstrk.database import DSDatabase
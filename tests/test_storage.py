@@ -0,0 +1,1049 @@
+# system imports
+import pytest
+import glob
+import os
+import shutil
+import sys
+
+test_db_path = os.path.expanduser("~/.dstrk-test-storage")
+test_data_path = os.path.expanduser("~/.dstrk-test-storage-data")
+test_data_step1 = os.path.join(test_data_path, "step_1", "*.txt")
+test_data_step2 = os.path.join(test_data_path, "step_2", "*.txt")
+
+# setup/teardown functions
+def setup_module(module):
+    if os.path.exists(test_db_path):
+        shutil.rmtree(test_db_path)
+
+    # create some test data
+    if os.path.exists(test_data_path):
+        shutil.rmtree(test_data_path)
+    os.mkdir(test_data_path)
+    for i in range(1, 4):
+        os.mkdir(os.path.join(test_data_path, "step_{0}".format(i)))
+        for j in range(1, 4):
+            open(os.path.join(test_data_path, "step_{0}".format(i), "part{0}.txt".format(j)), "w").write("Storage file Step {0} Part {1}".format(i, j))
+
+def teardown_module(module):
+    if os.path.exists(test_db_path):
+        shutil.rmtree(test_db_path)
+
+    if os.path.exists(test_data_path):
+        shutil.rmtree(test_data_path)
+
+# fixtures
+@pytest.fixture(params=['loose', 'sqlite'])
+def engine(request):
+    """Run the test against each storage engine"""
+    return request.param
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A DB path of the test's own, removed along with tmp_path"""
+    return str(tmp_path / "db")
+
+# Test the SQLite engine and migration between engines
+def test_init_sqlite_db():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    dstrk.main.main(['--dbpath', test_db_path, 'initDB', '--engine', 'sqlite'])
+    assert os.path.exists(os.path.join(test_db_path, "dstrk.sqlite"))
+    assert DSDatabase(test_db_path).storage.name == 'sqlite'
+
+def test_sqlite_add_and_query():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    dstrk.main.main(['--dbpath', test_db_path, 'addDS', test_data_step1, '--tags', 'First Step'])
+    ds_hash_step1 = DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_1", "part1.txt"))['ds_hash']
+    dstrk.main.main(['--dbpath', test_db_path, 'addDS', test_data_step2, '--tags', 'Second Step', '--parentDS', ds_hash_step1])
+
+    ds_info = DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part2.txt"))
+    assert ds_info['tags'] == ['Second Step']
+    assert ds_info['parents'] == [ds_hash_step1]
+    assert len(ds_info['file_paths']) == 3
+    assert DSDatabase(test_db_path).get_ds_info(ds_hash_step1[0:7])['ds_hash'] == ds_hash_step1
+
+    # nothing should have been written as loose objects
+    assert not os.path.exists(os.path.join(test_db_path, ds_hash_step1[:2]))
+
+def test_sqlite_delete():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    dstrk.main.main(['--dbpath', test_db_path, 'addDS', os.path.join(test_data_path, "step_3", "*.txt")])
+    dstrk.main.main(['--dbpath', test_db_path, 'delfiles', os.path.join(test_data_path, "step_3", "*.txt")])
+    with pytest.raises(NotValidFileOrHash):
+        DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_3", "part1.txt"))
+
+def test_migrate_to_loose_and_back():
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    before = DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt"))
+
+    dstrk.main.main(['--dbpath', test_db_path, 'migrateDB', '--engine', 'loose'])
+    assert not os.path.exists(os.path.join(test_db_path, "dstrk.sqlite"))
+    assert DSDatabase(test_db_path).storage.name == 'loose'
+    assert DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt")) == before
+    assert os.path.exists(DSDatabase(test_db_path).storage.object_path(before['ds_hash']))
+
+    dstrk.main.main(['--dbpath', test_db_path, 'migrateDB', '--engine', 'sqlite'])
+    assert DSDatabase(test_db_path).storage.name == 'sqlite'
+    assert DSDatabase(test_db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt")) == before
+    assert not os.path.exists(os.path.join(test_db_path, before['ds_hash'][:2]))
+
+def test_gc_packs(db_path):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    dstrk.main.main(['--dbpath', db_path, 'initDB'])
+    dstrk.main.main(['--dbpath', db_path, 'addDS', test_data_step1, '--tags', 'First Step'])
+    before = DSDatabase(db_path).get_ds_info(os.path.join(test_data_path, "step_1", "part1.txt"))
+    dstrk.main.main(['--dbpath', db_path, 'addDS', test_data_step2, '--parentDS', before['ds_hash']])
+
+    # everything should now be in a pack
+    dstrk.main.main(['--dbpath', db_path, 'gc'])
+    assert not os.path.exists(os.path.join(db_path, before['ds_hash'][:2]))
+    assert len(os.listdir(os.path.join(db_path, "packs"))) == 2
+    assert DSDatabase(db_path).get_ds_info(os.path.join(test_data_path, "step_1", "part1.txt")) == before
+    assert DSDatabase(db_path).get_ds_info(before['ds_hash'][0:7]) == before
+    assert DSDatabase(db_path).check_ds_hash(before['ds_hash'])
+
+    # deleting a packed dataset leaves a marker until the next full gc
+    dstrk.main.main(['--dbpath', db_path, 'delfiles', test_data_step2])
+    with pytest.raises(NotValidFileOrHash):
+        DSDatabase(db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt"))
+    dstrk.main.main(['--dbpath', db_path, 'gc', '--full'])
+    assert len(os.listdir(os.path.join(db_path, "packs"))) == 2
+    assert [d for d in os.listdir(db_path) if len(d) == 2] == []
+    with pytest.raises(NotValidFileOrHash):
+        DSDatabase(db_path).get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt"))
+    assert DSDatabase(db_path).get_ds_info(os.path.join(test_data_path, "step_1", "part1.txt")) == before
+
+def test_gc_concurrent_writes(db_path, monkeypatch):
+    import dstrk.storage
+    from dstrk.database import DSDatabase
+    from dstrk.records import format_file_record
+    db = DSDatabase(db_path)
+    db.init_db()
+    ds_hash = db.add_ds([test_data_step1])
+    records = [('{0:040x}'.format(i), format_file_record([ds_hash], '/gc/{0}'.format(i)).encode('utf-8')) for i in range(1, 4)]
+    for obj_hash, data in records[:2]:
+        db.storage.write_object(obj_hash, data)
+
+    # while packing, another process removes one object and writes a new one
+    write_pack = dstrk.storage.write_pack
+    def write_pack_racing(pack_dir, objects):
+        other = DSDatabase(db_path).storage
+        other.delete_object(records[0][0])
+        other.write_object(records[2][0], records[2][1])
+        return write_pack(pack_dir, objects)
+    monkeypatch.setattr(dstrk.storage, 'write_pack', write_pack_racing)
+    db.gc()
+    monkeypatch.undo()
+
+    storage = DSDatabase(db_path).storage
+    assert storage.read_object(records[0][0]) is None
+    assert storage.read_object(records[1][0]) == records[1][1]
+    assert storage.read_object(records[2][0]) == records[2][1]
+    assert DSDatabase(db_path).get_ds_info(ds_hash)['file_paths'] == sorted(glob.glob(test_data_step1))
+
+def test_ambiguous_hash(db_path, engine):
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import AmbiguousHash
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    db.add_ds([test_data_step1], ds_hash='abcd' + '0' * 36)
+    db.add_ds([test_data_step2], ds_hash='abce' + '0' * 36)
+
+    assert DSDatabase(db_path).get_ds_info('abcd')['ds_hash'] == 'abcd' + '0' * 36
+    assert DSDatabase(db_path).get_ds_info('abce0')['ds_hash'] == 'abce' + '0' * 36
+    with pytest.raises(AmbiguousHash):
+        DSDatabase(db_path).get_ds_info('abc')
+
+    # file records don't count as datasets
+    file_hash = DSDatabase(db_path).get_ds_info('abcd')['file_hashes'][0]
+    assert DSDatabase(db_path).expand_hash(file_hash[0:10]) == ''
+
+def test_hash_index_journal(tmp_path):
+    import dstrk.hashindex
+    from dstrk.hashindex import HashIndex
+    index_dir = str(tmp_path / "index")
+
+    index = HashIndex(index_dir, 'test')
+    index.rebuild(['{0:040x}'.format(i * 7919) for i in range(0, 50)])
+    old_threshold = dstrk.hashindex.MERGE_THRESHOLD
+    dstrk.hashindex.MERGE_THRESHOLD = 10
+    try:
+        for i in range(50, 75):
+            index.add('{0:040x}'.format(i * 7919))
+        index.remove('{0:040x}'.format(7919))
+    finally:
+        dstrk.hashindex.MERGE_THRESHOLD = old_threshold
+
+    index = HashIndex(index_dir, 'test')
+    assert sorted(index) == sorted('{0:040x}'.format(i * 7919) for i in range(0, 75) if i != 1)
+    assert index.with_prefix('{0:040x}'.format(74 * 7919)[:38]) == ['{0:040x}'.format(74 * 7919)]
+    assert not index.contains('{0:040x}'.format(7919))
+
+def test_children_index(db_path, engine):
+    from dstrk.database import DSDatabase
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    db.add_ds([test_data_step1])
+    parent = db.get_ds_info(os.path.join(test_data_path, "step_1", "part1.txt"))['ds_hash']
+    db.add_ds([test_data_step2], parents=[parent[0:6]])
+    child = db.get_ds_info(os.path.join(test_data_path, "step_2", "part1.txt"))['ds_hash']
+    assert db.get_ds_info(child)['parents'] == [parent]
+    assert db.storage.get_children(parent) == [child]
+
+    # rebuilding from the records gives the same answer
+    if engine == 'loose':
+        shutil.rmtree(os.path.join(db_path, "index"))
+        assert DSDatabase(db_path).storage.get_children(parent) == [child]
+
+    db.del_files([test_data_step2])
+    assert DSDatabase(db_path).storage.get_children(parent) == []
+
+def test_bad_parent(db_path):
+    import dstrk.hashindex
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    dstrk.main.main(['--dbpath', db_path, 'initDB'])
+    for parent in ['notahash', 'abc', 'ABCDEF']:
+        with pytest.raises(NotValidFileOrHash):
+            dstrk.main.main(['--dbpath', db_path, '--noserver', 'addDS', test_data_step1, '--parentDS', parent])
+
+    # nothing went in the index, even from a record that already has one (e.g. an import), so it
+    # still merges and later datasets can be added
+    old_threshold = dstrk.hashindex.MERGE_THRESHOLD
+    dstrk.hashindex.MERGE_THRESHOLD = 1
+    try:
+        DSDatabase(db_path).write_ds_info({'ds_hash':'', 'creation':'2024-01-01T00:00:00', 'parents':['notahash', 'abc'],
+                                           'tags':[], 'file_paths':[], 'file_hashes':[]})
+        parent = DSDatabase(db_path).add_ds([test_data_step1])
+        child = DSDatabase(db_path).add_ds([test_data_step2], parents=[parent[0:6]])
+    finally:
+        dstrk.hashindex.MERGE_THRESHOLD = old_threshold
+    assert DSDatabase(db_path).get_ds_info(child)['parents'] == [parent]
+    assert DSDatabase(db_path).storage.get_children(parent) == [child]
+
+def test_find(capsys, db_path, engine):
+    import dstrk.main
+    from datetime import datetime, timedelta
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    start = datetime.now() - timedelta(seconds=1)
+    parent = db.add_ds([test_data_step1], tags=["release", "step 1"])
+    child = db.add_ds([test_data_step2], tags=["release"], parents=[parent])
+    assert sorted(db.find_ds(tags=["release"])) == sorted([parent, child])
+    assert list(db.find_ds(tags=["release", "step 1"])) == [parent]
+    assert list(db.find_ds(tags=["missing"])) == []
+    assert list(db.find_ds(parents=[os.path.join(test_data_path, "step_1", "part1.txt")])) == [child]
+    assert sorted(db.find_ds(since=start)) == sorted([parent, child])
+    assert list(db.find_ds(until=start.isoformat())) == []
+    assert list(db.find_ds(tags=["release"], since=datetime.now() + timedelta(hours=1))) == []
+    with pytest.raises(NotValidFileOrHash):
+        db.find_ds(parents=["ffffff"])
+
+    # the loose indexes are rebuilt from the records
+    if engine == 'loose':
+        shutil.rmtree(os.path.join(db_path, "index"))
+        assert list(DSDatabase(db_path).find_ds(tags=["step 1"], since=start)) == [parent]
+
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', db_path, '--noserver', 'find', '--tag', 'release', '--since', '1h', '--has-parent', parent])
+    assert capsys.readouterr().out.split() == [child]
+
+    db.del_ds(parent)
+    assert list(db.find_ds(tags=["step 1"])) == []
+    assert list(db.find_ds(since=start)) == [child]
+
+def test_ds_manifest(db_path, engine):
+    from dstrk.database import DSDatabase
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    ds_hash = db.add_ds([test_data_step1], tags=["Manifest"])
+    ds_info = db.get_ds_info(ds_hash)
+    header, manifest = db.get_ds_record(os.path.join(test_data_path, "step_1", "part2.txt"))
+    assert header == db.get_ds_header(ds_hash)
+    assert header['tags'] == ["Manifest"] and not 'file_paths' in header
+    assert list(manifest) == list(zip(ds_info['file_paths'], ds_info['file_hashes']))
+    assert list(db.read_ds_manifest(ds_hash)) == list(zip(ds_info['file_paths'], ds_info['file_hashes']))
+
+def test_git_info(monkeypatch, tmp_path):
+    import subprocess
+    from dstrk import gitinfo
+    git_path = str(tmp_path / "git repo")
+    os.mkdir(git_path)
+
+    def git(*args, **kwargs):
+        subprocess.check_call(['git', '-C', kwargs.get('path', git_path)] + list(args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def check(path=git_path, native=True):
+        expected = gitinfo.read_git_info_with_git(path)
+        with monkeypatch.context() as m:
+            if native:
+                m.setattr(gitinfo, 'run_git', None)
+            assert gitinfo.read_git_info(path) == expected
+        return expected
+
+    git('init')
+    git('commit', '--allow-empty', '-m', 'first')
+    git('remote', 'add', 'zeta', 'https://example.com/z.git')
+    git('remote', 'add', 'alpha', 'git@example.com:a.git')
+    git('remote', 'set-url', '--add', 'alpha', 'https://example.com/a.git')
+    git('remote', 'set-url', '--push', 'zeta', 'ssh://example.com/z.git')
+    first = check()
+    assert "alpha\tgit@example.com:a.git (fetch)" in first['remote']
+    assert check(os.path.join(git_path, ".git")) == first
+
+    # the cached answer is only used while the repository is unchanged
+    git('checkout', '-b', 'release-1')
+    git('commit', '--allow-empty', '-m', 'second')
+    assert check()['branch'] == 'release-1'
+    git('pack-refs', '--all')
+    assert check()['head'] != first['head']
+    git('checkout', first['head'])
+    assert check()['branch'] == 'HEAD'
+
+    # worktrees need git itself
+    git('worktree', 'add', os.path.join(git_path, "tree"), 'release-1')
+    assert check(os.path.join(git_path, "tree"), native=False)['branch'] == 'release-1'
+
+def test_add_ds_tags_not_shared(db_path, monkeypatch):
+    import dstrk.database
+    from dstrk.database import DSDatabase
+    monkeypatch.setattr(dstrk.database, 'read_git_info', lambda repo_path: {'head':'abcd', 'branch':'main', 'remote':''})
+    db = DSDatabase(db_path)
+    db.init_db()
+
+    # the git tags of one dataset don't turn up in the next or in the caller's list
+    first = db.add_ds([test_data_step1], gitinfo=[test_data_path])
+    assert len(db.get_ds_info(first)['tags']) == 4
+    second = db.add_ds([test_data_step2])
+    assert db.get_ds_info(second)['tags'] == []
+    tags = ["Mine"]
+    db.add_ds([os.path.join(test_data_path, "step_3", "*.txt")], tags=tags, gitinfo=[test_data_path])
+    assert tags == ["Mine"]
+
+def test_recursive_add(db_path):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.walk import iter_files
+    DSDatabase(db_path).init_db()
+
+    # step_1 has the text files plus a nested directory
+    nested_path = os.path.join(test_data_path, "step_1", "nested", "deeper")
+    os.makedirs(nested_path)
+    open(os.path.join(nested_path, "part4.txt"), "w").write("Nested part 4")
+    open(os.path.join(nested_path, "part4.log"), "w").write("Nested log")
+    os.makedirs(os.path.join(test_data_path, "step_1", "skip"))
+    open(os.path.join(test_data_path, "step_1", "skip", "part5.txt"), "w").write("Skipped part 5")
+    try:
+        assert sorted(iter_files([os.path.join(test_data_path, "step_1")])) == []
+        assert sorted(iter_files([test_data_step1, os.path.join(test_data_path, "step_1", "part1.txt")])) == sorted(glob.glob(test_data_step1))
+
+        dstrk.main.main(['--dbpath', db_path, 'addDS', os.path.join(test_data_path, "step_1"), '-r',
+                         '--include', '*.txt', '--exclude', 'skip'])
+        ds_info = DSDatabase(db_path).get_ds_info(os.path.join(nested_path, "part4.txt"))
+        expected = sorted(glob.glob(test_data_step1) + [os.path.join(nested_path, "part4.txt")])
+        assert ds_info['file_paths'] == expected
+
+        dstrk.main.main(['--dbpath', db_path, 'addfiles', '--dataset', ds_info['ds_hash'], nested_path, '-r'])
+        assert DSDatabase(db_path).get_ds_info(ds_info['ds_hash'])['file_paths'] == sorted(expected + [os.path.join(nested_path, "part4.log")])
+
+        dstrk.main.main(['--dbpath', db_path, 'delfiles', os.path.join(test_data_path, "step_1", "nested"), '--recursive'])
+        assert DSDatabase(db_path).get_ds_info(ds_info['ds_hash'])['file_paths'] == sorted(glob.glob(test_data_step1))
+    finally:
+        shutil.rmtree(os.path.join(test_data_path, "step_1", "nested"))
+        shutil.rmtree(os.path.join(test_data_path, "step_1", "skip"))
+
+def test_verify(capsys, tmp_path, db_path):
+    import json
+    import time
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.hashing import RateLimiter
+    verify_data_path = str(tmp_path / "data")
+    shutil.copytree(os.path.join(test_data_path, "step_1"), verify_data_path)
+
+    db = DSDatabase(db_path)
+    db.init_db()
+    ds_hash = db.add_ds([os.path.join(verify_data_path, "*.txt")])
+    other_hash = db.add_ds([os.path.join(test_data_path, "step_2", "*.txt")])
+    assert len(db.verify_ds(ds_hash)['ok']) == 3
+
+    # same size, different contents
+    part1 = os.path.join(verify_data_path, "part1.txt")
+    open(part1, "w").write(open(part1).read().upper())
+    os.remove(os.path.join(verify_data_path, "part2.txt"))
+    result = DSDatabase(db_path).verify_ds(ds_hash, use_cache=False, max_rate=1e6)
+    assert result['modified'] == [part1]
+    assert result['missing'] == [os.path.join(verify_data_path, "part2.txt")]
+    assert result['ok'] == [os.path.join(verify_data_path, "part3.txt")]
+
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        dstrk.main.main(['--dbpath', db_path, 'verify', '--all', '--json', '--jobs', '2'])
+    results = json.loads(capsys.readouterr().out)
+    assert sorted(r['ds_hash'] for r in results) == sorted([ds_hash, other_hash])
+    assert [len(r['ok']) for r in results if r['ds_hash'] == other_hash] == [3]
+    dstrk.main.main(['--dbpath', db_path, 'verify', other_hash])
+    assert 'OK: 3  Modified: 0  Missing: 0' in capsys.readouterr().out
+
+    # the rate limit holds back reads beyond the allowed rate
+    limiter = RateLimiter(1000)
+    start = time.time()
+    limiter.consume(100)
+    limiter.consume(100)
+    assert time.time() - start >= 0.09
+
+def test_locate(capsys, tmp_path, db_path, engine):
+    import json
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.records import format_file_record
+    locate_data_path = str(tmp_path / "data")
+    old_path = os.path.join(locate_data_path, "old")
+    shutil.copytree(os.path.join(test_data_path, "step_1"), old_path)
+    for f in glob.glob(os.path.join(old_path, "*.txt")):
+        # old enough for the hash cache to keep
+        os.utime(f, (1e9, 1e9))
+
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    ds_hash = db.add_ds([os.path.join(old_path, "*.txt")])
+    file_info = db.get_file_info(os.path.join(old_path, "part1.txt"))
+    assert file_info['size'] == len("Storage file Step 1 Part 1")
+    # small files are hashed in full when looking for them so don't need a partial hash
+    assert file_info['partial'] == ''
+
+    # move two of the files and leave a same sized decoy for the partial hash to rule out
+    new_path = os.path.join(locate_data_path, "new", "sub")
+    os.makedirs(new_path)
+    for name in ["part1.txt", "part2.txt"]:
+        os.rename(os.path.join(old_path, name), os.path.join(new_path, name))
+    open(os.path.join(locate_data_path, "new", "decoy.txt"), "w").write("Storage file Step 9 Part 9")
+
+    result = db.locate_ds(ds_hash, [locate_data_path])
+    assert result['found'] == {os.path.join(old_path, name): os.path.join(new_path, name) for name in ["part1.txt", "part2.txt"]}
+    assert result['missing'] == []
+    assert db.get_ds_info(ds_hash)['file_paths'][0] == os.path.join(old_path, "part1.txt")
+
+    # old records without a size fall back on the hash cache
+    fhash = db.hash_file(os.path.join(new_path, "part2.txt"))
+    db.write_hash_file(format_file_record([ds_hash], os.path.join(old_path, "part2.txt")), file_hash=fhash)
+    assert db.get_file_info('', file_hash=fhash)['size'] is None
+    os.remove(os.path.join(old_path, "part3.txt"))
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        dstrk.main.main(['--dbpath', db_path, 'locate', ds_hash, '--search', locate_data_path, '--rewrite', '--json'])
+    result = json.loads(capsys.readouterr().out)
+    assert sorted(result['found'].values()) == [os.path.join(new_path, "part1.txt"), os.path.join(new_path, "part2.txt")]
+    assert result['missing'] == [os.path.join(old_path, "part3.txt")]
+
+    # the moved files are now recorded at their new paths
+    ds_info = DSDatabase(db_path).get_ds_info(ds_hash)
+    assert ds_info['file_paths'] == [os.path.join(new_path, "part1.txt"), os.path.join(new_path, "part2.txt"), os.path.join(old_path, "part3.txt")]
+    assert db.get_file_info(os.path.join(new_path, "part1.txt"))['path'] == os.path.join(new_path, "part1.txt")
+    assert DSDatabase(db_path).verify_ds(ds_hash)['missing'] == [os.path.join(old_path, "part3.txt")]
+
+    # files and datasets added by another process while searching aren't lost by the rewrite
+    moved_path = os.path.join(locate_data_path, "moved")
+    os.makedirs(moved_path)
+    os.rename(os.path.join(new_path, "part1.txt"), os.path.join(moved_path, "part1.txt"))
+    copy_file = os.path.join(locate_data_path, "copy.txt")
+    shutil.copy(os.path.join(moved_path, "part1.txt"), copy_file)
+    extra_file = os.path.join(locate_data_path, "extra.txt")
+    open(extra_file, "w").write("Extra file")
+    added = []
+    def add_while_searching(phase, seconds, counters):
+        if phase == 'locate':
+            other = DSDatabase(db_path)
+            added.append(other.add_ds([copy_file]))
+            other.add_files([extra_file], dataset=ds_hash)
+    db = DSDatabase(db_path)
+    db.add_hook(add_while_searching)
+    assert list(db.locate_ds(ds_hash, [moved_path], rewrite=True)['found'].values()) == [os.path.join(moved_path, "part1.txt")]
+    ds_info = DSDatabase(db_path).get_ds_info(ds_hash)
+    assert os.path.join(moved_path, "part1.txt") in ds_info['file_paths']
+    assert extra_file in ds_info['file_paths']
+    assert sorted(DSDatabase(db_path).get_file_info(copy_file)['ds']) == sorted([ds_hash, added[0]])
+
+def test_locate_big_files(tmp_path, db_path):
+    from dstrk.database import DSDatabase
+    from dstrk.hashing import PARTIAL_HASH_MIN_SIZE
+    big_file = str(tmp_path / "big.bin")
+    open(big_file, "wb").write(b"a" * (PARTIAL_HASH_MIN_SIZE + 1))
+    db = DSDatabase(db_path, use_hash_cache=False)
+    db.init_db()
+    ds_hash = db.add_ds([big_file])
+    assert db.get_file_info(big_file)['partial']
+
+    # the partial hash rules out a same sized file that differs at the end without reading it all
+    os.mkdir(str(tmp_path / "moved"))
+    os.rename(big_file, str(tmp_path / "moved" / "big.bin"))
+    open(str(tmp_path / "moved" / "decoy.bin"), "wb").write(b"a" * PARTIAL_HASH_MIN_SIZE + b"b")
+    phases = []
+    db.add_hook(lambda phase, seconds, counters: phases.append((phase, dict(counters))))
+    assert db.locate_ds(ds_hash, [str(tmp_path / "moved")])['found'] == {big_file: str(tmp_path / "moved" / "big.bin")}
+    counters = dict(phases)
+    assert counters['locate']['partial_hashes'] == 2
+    assert counters['locate/hash']['files_hashed'] == 1
+
+def test_hash_algorithms(db_path, engine):
+    import hashlib
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    step1_part1 = os.path.join(test_data_path, "step_1", "part1.txt")
+    dstrk.main.main(['--dbpath', db_path, 'initDB', '--engine', engine])
+    db = DSDatabase(db_path)
+    sha1_ds = db.add_ds([test_data_step1])
+    assert len(sha1_ds) == 40
+
+    # switching algorithm keeps the old records reachable
+    dstrk.main.main(['--dbpath', db_path, 'migrateDB', '--hash', 'blake2b'])
+    db = DSDatabase(db_path)
+    assert db.hash_algorithms() == ['blake2b', 'sha1']
+    assert db.get_ds_info(step1_part1)['ds_hash'] == sha1_ds
+    blake_ds = db.add_ds([test_data_step2], parents=[sha1_ds])
+    assert len(blake_ds) == 128
+    assert db.get_ds_info(blake_ds)['file_hashes'][0] == hashlib.blake2b(b"Storage file Step 2 Part 1").hexdigest()
+    assert db.get_ds_tree(blake_ds[0:8])['parents'][0]['ds_hash'] == sha1_ds
+
+    # adding to an old dataset mixes the two and everything still checks out
+    db.add_files([os.path.join(test_data_path, "step_3", "part1.txt")], dataset=sha1_ds)
+    assert sorted(len(h) for h in db.get_ds_info(sha1_ds)['file_hashes']) == [40, 40, 40, 128]
+    assert len(DSDatabase(db_path).verify_ds(sha1_ds)['ok']) == 4
+    if engine == 'loose':
+        db.gc()
+        assert len(os.listdir(os.path.join(db_path, "packs"))) == 4
+
+    db.del_files([step1_part1, os.path.join(test_data_path, "step_3", "part1.txt")])
+    assert len(db.get_ds_info(sha1_ds)['file_paths']) == 2
+
+def test_hash_algorithm_on_init(db_path):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+
+    # a new DB can use another algorithm from the start
+    dstrk.main.main(['--dbpath', db_path, 'initDB', '--hash', 'sha256'])
+    ds_hash = DSDatabase(db_path).add_ds([test_data_step1])
+    assert len(ds_hash) == 64
+    assert DSDatabase(db_path).find_ds_from_file(os.path.join(test_data_path, "step_1", "part1.txt")) == ds_hash
+
+def test_hash_cache_after_migration(tmp_path, db_path):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    fname = str(tmp_path / "part1.txt")
+    open(fname, "w").write("Hash cache file")
+    # recently modified files aren't cached so backdate it
+    os.utime(fname, (1000000000, 1000000000))
+
+    dstrk.main.main(['--dbpath', db_path, 'initDB'])
+    ds_hash = DSDatabase(db_path).add_ds([fname])
+    dstrk.main.main(['--dbpath', db_path, 'migrateDB', '--hash', 'sha256'])
+
+    # the file is looked for with both algorithms and then both hashes are cached
+    for expected_hashed in [1, 0, 0]:
+        phases = []
+        db = DSDatabase(db_path)
+        db.add_hook(lambda phase, seconds, counters: phases.append((phase, dict(counters))))
+        assert db.get_ds_info(fname)['ds_hash'] == ds_hash
+        assert sum(counters.get('files_hashed', 0) for phase, counters in phases) == expected_hashed
+    assert db.hash_cache.lookup(fname, algorithm='sha1') == db.get_ds_info(fname)['file_hashes'][0]
+    assert len(db.hash_cache.lookup(fname, algorithm='sha256')) == 64
+
+def test_manifest_round_trip():
+    from dstrk.hashing import hash_string
+    from dstrk.records import encode_ds_record, decode_ds_record, MANIFEST_ENCODINGS
+
+    # records round trip whatever the encoding, even when read a byte at a time
+    ds_info = {'ds_hash':'', 'creation':'2024-01-01T00:00:00', 'parents':['ab' * 20], 'tags':['Encoded'],
+               'file_paths':sorted("/data/run{0}/file_{1}.root".format(i // 10, i) for i in range(50)),
+               'file_hashes':[hash_string(str(i)) for i in range(50)]}
+    for manifest in MANIFEST_ENCODINGS:
+        data = encode_ds_record(ds_info, manifest)
+        assert decode_ds_record(data, '') == ds_info
+    assert len(encode_ds_record(ds_info, 'packed')) < len(encode_ds_record(ds_info, 'text')) // 2
+    from dstrk.records import unpack_manifest, pack_manifest
+    packed = b''.join(pack_manifest(ds_info['file_paths'], ds_info['file_hashes']))
+    assert list(unpack_manifest((packed[i:i + 1] for i in range(len(packed))), 'packed')) == list(zip(ds_info['file_paths'], ds_info['file_hashes']))
+
+def test_manifest_encodings(capsys, db_path, engine):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.hashing import hash_string
+    from dstrk.records import format_ds_record
+    step1_part1 = os.path.join(test_data_path, "step_1", "part1.txt")
+    dstrk.main.main(['--dbpath', db_path, 'initDB', '--engine', engine, '--manifest', 'zlib'])
+    db = DSDatabase(db_path)
+    ds_hash = db.add_ds([test_data_step1], tags=["Compact"])
+    assert not step1_part1.encode('utf-8') in db.storage.read_object(ds_hash)
+
+    # the hash is that of the text record
+    ds_info = db.get_ds_info(step1_part1)
+    assert ds_hash == hash_string(format_ds_record(ds_info))
+    assert db.get_ds_header(ds_hash) == dict((k, ds_info[k]) for k in ['ds_hash', 'creation', 'parents', 'tags'])
+    assert list(db.find_ds(tags=["Compact"])) == [ds_hash]
+
+    # adding and removing files keeps the encoding
+    db.add_files([os.path.join(test_data_path, "step_2", "part1.txt")], dataset=ds_hash)
+    db.del_files([step1_part1])
+    assert len(db.get_ds_info(ds_hash)['file_paths']) == 3
+    assert b"Manifest:  zlib" in db.storage.read_object(ds_hash)
+
+    # converting to text gives back a plain record with the same hash
+    dstrk.main.main(['--dbpath', db_path, 'migrateDB', '--manifest', 'text'])
+    db = DSDatabase(db_path)
+    assert db.storage.read_object(ds_hash).decode('utf-8') == format_ds_record(db.get_ds_info(ds_hash))
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', db_path, '--noserver', 'DSinfo', ds_hash])
+    assert os.path.join(test_data_path, "step_2", "part1.txt") in capsys.readouterr().out
+
+@pytest.mark.parametrize('manifest', ['text', 'zlib'])
+def test_incremental_add_files(capsys, tmp_path, db_path, engine, manifest):
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    append_data_path = str(tmp_path / "data")
+    os.mkdir(append_data_path)
+    data_files = [os.path.join(append_data_path, "file{0}.txt".format(i)) for i in range(4)]
+    for i, f in enumerate(data_files):
+        open(f, "w").write("Appended file {0}".format(i))
+
+    db = DSDatabase(db_path, use_hash_cache=False)
+    db.init_db(engine=engine, manifest=manifest)
+    ds_hash = db.add_ds(data_files[:2])
+    record = db.storage.read_object(ds_hash)
+
+    # the old files can have moved - only the new ones are hashed and written
+    os.remove(data_files[0])
+    phases = []
+    db.add_hook(lambda phase, seconds, counters: phases.append((phase, dict(counters))))
+    assert db.add_files(data_files[2:], dataset=ds_hash) == ds_hash
+    counters = dict(phases)
+    assert counters['scan/hash']['files_hashed'] == 2
+    assert counters['write']['objects_updated'] == 3
+    assert db.storage.read_object(ds_hash).startswith(record)
+    assert db.get_ds_info(ds_hash)['file_paths'] == data_files
+    assert db.find_ds_from_file(data_files[3]) == ds_hash
+
+    # re-adding is a no-op and a changed file replaces its old entry
+    db.add_files(data_files[2:], dataset=ds_hash)
+    old_hash = db.get_ds_info(ds_hash)['file_hashes'][1]
+    open(data_files[1], "w").write("Changed file")
+    db.add_files([data_files[1]], dataset=ds_hash)
+    ds_info = db.get_ds_info(ds_hash)
+    assert ds_info['file_paths'] == data_files
+    assert ds_info['file_hashes'][1] == db.hash_file(data_files[1])
+    # and the old contents are no longer in the dataset
+    assert DSDatabase(db_path).get_file_info('', file_hash=old_hash) == {}
+
+    # a file that sorts before the others still comes first when the list is streamed
+    early_file = os.path.join(append_data_path, "early.txt")
+    open(early_file, "w").write("Early file")
+    db.add_files([early_file], dataset=ds_hash)
+    assert [path for path, fhash in db.read_ds_manifest(ds_hash)] == [early_file] + data_files
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', db_path, 'DSinfo', ds_hash])
+    out = capsys.readouterr().out
+    positions = [out.index(f) for f in [early_file] + data_files]
+    assert positions == sorted(positions)
+
+def test_session_cache(db_path, engine):
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    step1_files = sorted(glob.glob(test_data_step1))
+    step2_files = sorted(glob.glob(test_data_step2))
+    db = DSDatabase(db_path, use_hash_cache=False)
+    db.init_db(engine=engine)
+    ds_hash = db.add_ds(step1_files[:2])
+
+    with db.session(cache_size=5) as cache:
+        # repeated lookups are served from memory and changing the results doesn't change the cache
+        ds_info = db.get_ds_info(ds_hash)
+        ds_info['file_paths'].append('changed')
+        assert db.get_ds_info(ds_hash)['file_paths'] == step1_files[:2]
+        assert db.read_file_info(db.hash_file(step1_files[0]))['ds'] == [ds_hash]
+        reads = db.storage.read_object
+        db.storage.read_object = None
+        assert db.read_file_info(db.hash_file(step1_files[0]))['ds'] == [ds_hash]
+        db.storage.read_object = reads
+        assert cache.hits >= 3
+
+        # writes, updates and deletes through the DB are seen straight away
+        assert db.get_file_info(step2_files[0]) == {}
+        new_hash = db.add_ds(step2_files, parents=[ds_hash])
+        assert db.check_ds_hash(new_hash)
+        assert db.get_file_info(step2_files[0])['ds'] == [new_hash]
+        db.add_files([step1_files[2]], dataset=ds_hash)
+        assert db.get_ds_info(ds_hash)['file_paths'] == step1_files
+        db.del_files([step1_files[0]])
+        assert db.get_ds_info(ds_hash)['file_paths'] == step1_files[1:]
+        assert db.get_file_info(step1_files[0]) == {}
+        db.del_ds(new_hash)
+        assert not db.check_ds_hash(new_hash)
+        with pytest.raises(NotValidFileOrHash):
+            db.get_ds_info(new_hash)
+        assert len(cache.entries) <= 5
+
+    assert db.cache is None
+
+def test_export_import(capsys, monkeypatch, tmp_path):
+    import dstrk.main
+    import dstrk.storage
+    from dstrk.database import DSDatabase
+    from dstrk.records import format_file_record
+    source_path = str(tmp_path / "source")
+    target_path = str(tmp_path / "target")
+    export_path = str(tmp_path / "export.out")
+
+    source = DSDatabase(source_path)
+    source.init_db()
+    step1 = source.add_ds([test_data_step1], tags=["Export 1"])
+    step2 = source.add_ds([test_data_step2], tags=["Export 2"], parents=[step1])
+    step3 = source.add_ds([os.path.join(test_data_path, "step_3", "*.txt")], parents=[step2])
+    source.gc()
+
+    # everything, into the other engine
+    dstrk.main.main(['--dbpath', source_path, 'export', export_path])
+    dstrk.main.main(['--dbpath', target_path, 'initDB', '--engine', 'sqlite'])
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', target_path, 'import', export_path])
+    assert "12 records: 12 written" in capsys.readouterr().out
+    target = DSDatabase(target_path)
+    for ds_hash in [step1, step2, step3]:
+        assert target.get_ds_info(ds_hash) == source.get_ds_info(ds_hash)
+    assert target.get_ds_descendants(step1)['children'][0]['children'][0]['ds_hash'] == step3
+
+    # importing again changes nothing
+    dstrk.main.main(['--dbpath', target_path, 'import', export_path])
+    assert "12 already present" in capsys.readouterr().out
+    shutil.rmtree(target_path)
+
+    # one lineage, compressed, into a DB that already has some of the files in another dataset
+    target = DSDatabase(target_path)
+    target.init_db(manifest='zlib')
+    other = target.add_ds([test_data_step2])
+    dstrk.main.main(['--dbpath', source_path, 'export', export_path, '--format', 'binary', '--compress', 'gzip', '--dataset', step2])
+    assert open(export_path, 'rb').read(2) == b'\x1f\x8b'
+    dstrk.main.main(['--dbpath', target_path, 'import', export_path, '--group-size', '2'])
+    assert "8 records: 5 written, 3 merged" in capsys.readouterr().out
+    target = DSDatabase(target_path)
+    assert sorted(target.iter_ds_hashes()) == sorted([other, step2, step3])
+    assert target.get_file_info(os.path.join(test_data_path, "step_2", "part1.txt"))['ds'] == [other, step2]
+    assert target.get_file_info(os.path.join(test_data_path, "step_3", "part1.txt"))['ds'] == [step3]
+    assert target.get_ds_info(step2)['parents'] == [step1]
+    # the groups all went into one pack
+    assert len(glob.glob(os.path.join(target_path, "packs", "*.idx"))) == 1
+
+    # and a big import is split over packs of a limited size
+    monkeypatch.setattr(dstrk.storage, 'PACK_ROLLOVER_OBJECTS', 2)
+    objects = [('{0:040x}'.format(i), format_file_record([step1], '/bulk/{0}'.format(i)).encode('utf-8')) for i in range(1, 6)]
+    with target.storage.bulk_writes():
+        for obj_hash, data in objects:
+            target.storage.write_new_objects([(obj_hash, data)])
+        assert target.storage.read_object(objects[-1][0]) == objects[-1][1]
+    assert len(glob.glob(os.path.join(target_path, "packs", "*.idx"))) == 4
+    assert all(DSDatabase(target_path).storage.read_object(obj_hash) == data for obj_hash, data in objects)
+
+    # binary manifests survive the trip through JSON
+    capsys.readouterr()
+    dstrk.main.main(['--dbpath', target_path, 'export', '--dataset', other, '--ancestors'])
+    exported = capsys.readouterr().out
+    assert '"record_base64"' in exported and len(exported.splitlines()) == 4
+    shutil.rmtree(target_path)
+    DSDatabase(target_path).init_db()
+    open(export_path, 'w').write(exported)
+    dstrk.main.main(['--dbpath', target_path, 'import', export_path])
+    assert DSDatabase(target_path).get_ds_info(other)['file_paths'] == sorted(glob.glob(test_data_step2))
+
+def test_bulk_deletion(db_path, engine):
+    from dstrk.database import DSDatabase
+    step1_part1 = os.path.join(test_data_path, "step_1", "part1.txt")
+    step2_part1 = os.path.join(test_data_path, "step_2", "part1.txt")
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    ds_a = db.add_ds([test_data_step1])
+    ds_b = db.add_ds([step1_part1, test_data_step2])
+
+    # files that are only in some of their datasets
+    db.del_files([step1_part1, step2_part1])
+    assert len(db.get_ds_info(ds_a)['file_paths']) == 2
+    assert sorted(os.path.basename(f) for f in db.get_ds_info(ds_b)['file_paths']) == ['part2.txt', 'part3.txt']
+    assert db.get_file_info(step1_part1) == {}
+
+    # files only in the deleted dataset go too
+    db.del_ds(ds_b)
+    assert not db.check_ds_hash(ds_b)
+    assert db.get_file_info(os.path.join(test_data_path, "step_2", "part2.txt")) == {}
+    assert db.get_file_info(os.path.join(test_data_path, "step_1", "part2.txt"))['ds'] == [ds_a]
+
+    # removing the last files removes the dataset
+    db.del_files([test_data_step1])
+    assert not db.check_ds_hash(ds_a)
+
+def test_batch(capsys, tmp_path, db_path, engine):
+    import json
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    batch_file = str(tmp_path / "batch.jsonl")
+
+    step1_part1 = os.path.join(test_data_path, "step_1", "part1.txt")
+    step2_part1 = os.path.join(test_data_path, "step_2", "part1.txt")
+    with open(batch_file, "w") as f:
+        f.write(json.dumps({'op':'addDS', 'files':[test_data_step1], 'tags':['batch 1'], 'id':1}) + "\n")
+        f.write(json.dumps({'op':'DSinfo', 'dataset':step1_part1, 'id':2}) + "\n")
+        f.write(json.dumps({'op':'addDS', 'files':[test_data_step2], 'parents':[step1_part1], 'id':3}) + "\n")
+        f.write("\n")
+        f.write(json.dumps({'op':'DSinfo', 'dataset':'xyz', 'id':4}) + "\n")
+        f.write("not json\n")
+        f.write(json.dumps({'op':'delfiles', 'files':[step2_part1], 'id':5}) + "\n")
+
+    DSDatabase(db_path).init_db(engine=engine)
+    capsys.readouterr()
+    with pytest.raises(SystemExit):
+        dstrk.main.main(['--dbpath', db_path, 'batch', batch_file, '--group-size', '2'])
+    results = [json.loads(ln) for ln in capsys.readouterr().out.splitlines()]
+
+    assert [r['ok'] for r in results] == [True, True, True, False, False, True]
+    assert [r.get('id') for r in results] == [1, 2, 3, 4, None, 5]
+    assert results[1]['info']['ds_hash'] == results[0]['ds_hash']
+    assert results[1]['info']['tags'] == ['batch 1']
+    assert results[3]['error'] == 'NotValidFileOrHash'
+
+    db = DSDatabase(db_path)
+    assert db.get_ds_info(results[2]['ds_hash'])['parents'] == [results[0]['ds_hash']]
+    assert len(db.get_ds_info(results[2]['ds_hash'])['file_paths']) == 2
+
+def test_batch_failing_update(db_path, engine, monkeypatch):
+    import io
+    import json
+    import dstrk.database
+    from dstrk.batch import run_batch
+    from dstrk.database import DSDatabase
+    from dstrk.records import add_file_dataset
+    DSDatabase(db_path).init_db(engine=engine)
+
+    # the file records of step 2 can't be updated, which the loose engine only finds out when
+    # the command's writes are made
+    def failing_update(file_str, file_hash, ds_hash, path, size=None, partial=''):
+        if "step_2" in path:
+            raise ValueError("Can't update " + path)
+        return add_file_dataset(file_str, file_hash, ds_hash, path, size, partial)
+    monkeypatch.setattr(dstrk.database, 'add_file_dataset', failing_update)
+
+    step3_files = os.path.join(test_data_path, "step_3", "*.txt")
+    commands = "".join(json.dumps({'op':'addDS', 'files':[files], 'id':i}) + "\n" for i, files in enumerate([test_data_step1, test_data_step2, step3_files]))
+    out = io.StringIO()
+    db = DSDatabase(db_path)
+    assert run_batch(db, io.StringIO(commands), out) == 1
+    results = [json.loads(ln) for ln in out.getvalue().splitlines()]
+    assert [r['ok'] for r in results] == [True, False, True]
+    assert results[1]['message'] == "Can't update " + sorted(glob.glob(test_data_step2))[0]
+
+    # only the commands reported as done were made
+    db = DSDatabase(db_path)
+    assert sorted(db.iter_ds_hashes()) == sorted([results[0]['ds_hash'], results[2]['ds_hash']])
+    assert db.get_file_info(os.path.join(test_data_path, "step_2", "part1.txt")) == {}
+    assert db.get_file_info(os.path.join(test_data_path, "step_3", "part1.txt"))['ds'] == [results[2]['ds_hash']]
+
+def test_grouped_writes(db_path, engine):
+    from dstrk.database import DSDatabase
+    from dstrk.records import format_file_record
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+
+    # writes are visible inside the transaction and a failing nested transaction discards
+    # its own writes but not the earlier ones
+    with db.storage.transaction():
+        db.write_hash_file(format_file_record(['dd' * 20], '/first'), file_hash='aa' * 20)
+        assert db.read_hash_file('aa' * 20) == format_file_record(['dd' * 20], '/first')
+        with pytest.raises(ValueError):
+            with db.storage.transaction():
+                db.write_hash_file(format_file_record(['dd' * 20], '/second'), file_hash='bb' * 20)
+                raise ValueError
+        db.delete_hash_file('aa' * 20)
+        assert db.read_hash_file('aa' * 20) is None
+        db.write_hash_file(format_file_record(['dd' * 20], '/third'), file_hash='cc' * 20)
+
+    db = DSDatabase(db_path)
+    assert db.read_hash_file('aa' * 20) is None
+    assert db.read_hash_file('cc' * 20) == format_file_record(['dd' * 20], '/third')
+    assert db.read_hash_file('bb' * 20) is None
+
+    # a dataset added in a failing transaction leaves nothing behind, even when its records
+    # were streamed into a pack
+    with db.storage.bulk_writes():
+        with pytest.raises(ValueError):
+            with db.transaction():
+                db.add_ds([test_data_step1], ds_hash='ee' * 20, tags=["Rolled back"])
+                assert db.check_ds_hash('ee' * 20)
+                raise ValueError
+    db = DSDatabase(db_path)
+    assert not db.check_ds_hash('ee' * 20)
+    assert list(db.find_ds(tags=["Rolled back"])) == []
+    assert db.read_hash_file('cc' * 20) == format_file_record(['dd' * 20], '/third')
+
+def add_concurrently(db_path, i, shared_ds):
+    from dstrk.database import DSDatabase
+    db = DSDatabase(db_path)
+    db.add_ds([test_data_step1], tags=["Job {0}".format(i)])
+    db.add_files([os.path.join(test_data_path, "step_3", "part{0}.txt".format(i % 3 + 1))], dataset=shared_ds)
+
+def test_concurrent_writers(db_path, engine):
+    import multiprocessing
+    from dstrk.database import DSDatabase
+    jobs = 8
+    db = DSDatabase(db_path)
+    db.init_db(engine=engine)
+    shared_ds = db.add_ds([test_data_step2])
+
+    # every job adds the same files to its own dataset and a file to the shared one
+    procs = [multiprocessing.Process(target=add_concurrently, args=(db_path, i, shared_ds)) for i in range(0, jobs)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+
+    db = DSDatabase(db_path)
+    for f in glob.glob(test_data_step1):
+        assert len(db.get_file_info(f)['ds']) == jobs
+    assert len(db.get_ds_info(shared_ds)['file_paths']) == 6
+    assert len(list(db.iter_ds_hashes())) == jobs + 1
+
+def test_timings(db_path):
+    import json
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    phases = []
+    db = DSDatabase(db_path, use_hash_cache=False)
+    db.init_db()
+    db.add_hook(lambda phase, seconds, counters: phases.append((phase, dict(counters))))
+    with db.phase('test'):
+        db.add_ds([test_data_step1])
+    assert [p[0] for p in phases] == ['test/git', 'test/scan/hash', 'test/scan', 'test/write', 'test']
+    assert phases[1][1]['files_hashed'] == 3
+    assert phases[1][1]['bytes_hashed'] == sum(os.path.getsize(f) for f in glob.glob(test_data_step1))
+    assert phases[2][1] == {'files_found': 3}
+    assert phases[3][1]['objects_written'] == 1
+    assert phases[3][1]['objects_updated'] == 3
+
+    timings_file = os.path.join(db_path, "timings.json")
+    dstrk.main.main(['--dbpath', db_path, '--timings-json', timings_file, 'DSinfo', os.path.join(test_data_path, "step_1", "part1.txt")])
+    report = json.load(open(timings_file))
+    assert [r['phase'] for r in report] == ['DSinfo', 'DSinfo/hash']
+    assert report[0]['counters']['objects_read'] == 2
+
+def test_serve(capsys, db_path):
+    import subprocess
+    import time
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.exceptions import NotValidFileOrHash
+    from dstrk.server import socket_path, forward
+    DSDatabase(db_path).init_db(engine='sqlite')
+
+    # nothing to forward to yet
+    assert not forward(db_path, ['--dbpath', db_path, 'DSinfo', 'abcd'])
+
+    repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    env = dict(os.environ, PYTHONPATH=os.path.join(repo_path, 'python'))
+    server = subprocess.Popen([sys.executable, os.path.join(repo_path, 'bin', 'dstrk'), '--dbpath', db_path, 'serve'], env=env)
+    try:
+        for i in range(0, 100):
+            if os.path.exists(socket_path(db_path)):
+                break
+            time.sleep(0.1)
+
+        dstrk.main.main(['--dbpath', db_path, 'addDS', test_data_step1, '--tags', 'served'])
+        capsys.readouterr()
+        dstrk.main.main(['--dbpath', db_path, 'DSinfo', os.path.join(test_data_path, "step_1", "part1.txt")])
+        assert 'served' in capsys.readouterr().out
+        with pytest.raises(NotValidFileOrHash):
+            dstrk.main.main(['--dbpath', db_path, 'DSinfo', 'xyz'])
+
+        # the server did the work
+        assert forward(db_path, ['--dbpath', db_path, 'DSinfo', os.path.join(test_data_path, "step_1", "part1.txt")])
+        ds_hash = DSDatabase(db_path).find_ds_from_file(os.path.join(test_data_path, "step_1", "part1.txt"))
+        assert ds_hash in capsys.readouterr().out
+    finally:
+        server.terminate()
+        server.wait()
+
+    assert not os.path.exists(socket_path(db_path))
+
+def test_serve_other_users(db_path):
+    import socket
+    import stat
+    from dstrk.database import DSDatabase
+    from dstrk.server import DSServer, socket_path
+    DSDatabase(db_path).init_db()
+    server = DSServer(db_path)
+    try:
+        assert stat.S_IMODE(os.stat(socket_path(db_path)).st_mode) == 0o600
+
+        # only connections from the server's own user are taken
+        client, request = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        assert server.verify_request(request, '')
+        if hasattr(socket, 'SO_PEERCRED'):
+            server.uid += 1
+            assert not server.verify_request(request, '')
+        client.close()
+        request.close()
+    finally:
+        server.server_close()
+
+def test_serve_sees_external_writes(capsys, db_path):
+    import subprocess
+    import time
+    import dstrk.main
+    from dstrk.database import DSDatabase
+    from dstrk.server import socket_path, forward
+    DSDatabase(db_path).init_db()
+
+    repo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    env = dict(os.environ, PYTHONPATH=os.path.join(repo_path, 'python'))
+    server = subprocess.Popen([sys.executable, os.path.join(repo_path, 'bin', 'dstrk'), '--dbpath', db_path, 'serve'], env=env)
+    try:
+        for i in range(0, 100):
+            if os.path.exists(socket_path(db_path)):
+                break
+            time.sleep(0.1)
+
+        # the server loads its indexes
+        step1_hash = DSDatabase(db_path).add_ds([test_data_step1], tags=['first'])
+        assert forward(db_path, ['--dbpath', db_path, 'find', '--tag', 'first'])
+        assert capsys.readouterr().out.split() == [step1_hash]
+
+        # then datasets are added and packed behind its back
+        dstrk.main.main(['--dbpath', db_path, '--noserver', 'addDS', test_data_step2, '--tags', 'second', '--parentDS', step1_hash])
+        step2_hash = DSDatabase(db_path).find_ds_from_file(os.path.join(test_data_path, "step_2", "part1.txt"))
+        capsys.readouterr()
+        assert forward(db_path, ['--dbpath', db_path, 'DSinfo', step2_hash[:8]])
+        assert 'second' in capsys.readouterr().out
+        assert forward(db_path, ['--dbpath', db_path, 'find', '--tag', 'second'])
+        assert capsys.readouterr().out.split() == [step2_hash]
+        DSDatabase(db_path).gc()
+        assert forward(db_path, ['--dbpath', db_path, 'descendants', step1_hash])
+        assert step2_hash in capsys.readouterr().out
+    finally:
+        server.terminate()
+        server.wait()
+
+def test_benchmark(tmp_path):
+    import benchmark
+    bench_path = str(tmp_path)
+
+    report = benchmark.main(['--datasets', '6', '--files', '3', '--depth', '3', '--duplicate-rate', '0', '--hash', 'sha1', 'sha256',
+                             '--workdir', bench_path, '--output', os.path.join(bench_path, 'report.json')])
+    assert [r['op'] for r in report['results'] if r['api'] == 'db' and r['hash'] == 'sha256'] == ['initDB', 'addDS', 'addfiles', 'DSinfo', 'tree', 'delfiles', 'delDS']
+    for r in report['results']:
+        assert not 'error' in r
+    assert [r['count'] for r in report['results'] if r['op'] == 'addDS'] == [6, 6, 6, 6]
+    assert [r['hash'] for r in report['results'] if r['op'] == 'hash'] == ['sha1', 'sha256']
+    assert os.listdir(bench_path) == ['report.json']